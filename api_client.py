@@ -0,0 +1,184 @@
+import json
+import os
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Use environment variable for deployment, default to localhost for dev
+API_URL = os.getenv("API_URL", "http://localhost:8000")
+CONNECT_TIMEOUT = float(os.getenv("API_CONNECT_TIMEOUT", "3"))
+READ_TIMEOUT = float(os.getenv("API_READ_TIMEOUT", "15"))
+# Longest gap allowed between two chunks of a /chat stream
+STREAM_READ_TIMEOUT = float(os.getenv("API_STREAM_READ_TIMEOUT", "60"))
+POOL_SIZE = int(os.getenv("API_POOL_SIZE", "16"))
+# Reconnects to a dropped /chat stream before giving up
+STREAM_RESUME_ATTEMPTS = int(os.getenv("API_STREAM_RESUME_ATTEMPTS", "3"))
+
+
+class ApiError(Exception):
+    def __init__(self, status_code, detail):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class ChatStreamError(ApiError):
+    """
+    A /chat generation that failed after the stream started. `error_type`
+    is the type of the backend's error event (e.g. "upstream_timeout").
+    """
+
+    def __init__(self, error_type, detail, status_code=502):
+        super().__init__(status_code, detail)
+        self.error_type = error_type
+
+
+def _check(resp):
+    if resp.status_code >= 400:
+        try:
+            detail = resp.json().get("detail", resp.text)
+        except ValueError:
+            detail = resp.text
+        raise ApiError(resp.status_code, detail)
+    return resp
+
+
+class ApiClient:
+    """
+    Backend client for the Streamlit app. One keep-alive connection pool is
+    shared by every call (and every Streamlit session using this instance).
+    """
+
+    def __init__(self, base_url=API_URL):
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+        # Only idempotent reads are retried
+        # Once retries run out, the last 502/503/504 is returned (and _check
+        # raises ApiError) rather than urllib3 raising RetryError
+        retry = Retry(total=2, backoff_factor=0.2, status_forcelist=(502, 503, 504), allowed_methods={"GET"}, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _request(self, method, path, **kwargs):
+        kwargs.setdefault("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+        return _check(self.session.request(method, f"{self.base_url}{path}", **kwargs))
+
+    # --- Auth ---
+    @staticmethod
+    def _auth(token):
+        # History calls carry the token /login returned
+        return {"Authorization": f"Bearer {token}"} if token else {}
+
+    def login(self, username, password):
+        return self._request("POST", "/login", json={"username": username, "password": password}).json()
+
+    def register(self, username, password):
+        return self._request("POST", "/register", json={"username": username, "password": password}).json()
+
+    # --- History ---
+    def list_chats(self, username, cursor=None, *, token):
+        params = {"cursor": cursor} if cursor else {}
+        return self._request("GET", f"/history/{username}/chats", params=params, headers=self._auth(token)).json()
+
+    def history_changes(self, username, since, messages=False, *, token):
+        """
+        Chats changed since history version `since`, as
+        {"version", "reset", "chats"}; all pages are fetched. A client that is
+        up to date gets a 304 and an empty list.
+        """
+        headers = {"If-None-Match": f'W/"{since}"', **self._auth(token)}
+        result = {"version": since, "reset": False, "chats": []}
+        while since is not None:
+            resp = self._request("GET", f"/history/{username}/changes", headers=headers,
+                                 params={"since": since, "messages": str(messages).lower()})
+            if resp.status_code == 304:
+                break
+            data = resp.json()
+            result["version"] = data["version"]
+            result["reset"] = result["reset"] or data["reset"]
+            result["chats"].extend(data["chats"])
+            since, headers = data["next_since"], self._auth(token)
+        return result
+
+    def chat_messages(self, username, chat_id, *, token):
+        messages, after = [], -1
+        while after is not None:
+            data = self._request("GET", f"/history/{username}/chats/{chat_id}/messages", params={"after": after},
+                                 headers=self._auth(token)).json()
+            messages.extend(data["messages"])
+            after = data["next_cursor"]
+        return messages
+
+    def save_chat(self, username, chat_id, title, messages, *, token):
+        return self._request("POST", "/history/save", headers=self._auth(token), json={
+            "username": username,
+            "chat_id": chat_id,
+            "title": title,
+            "messages": messages,
+        }).json()
+
+    def branches(self, username, chat_id, *, token):
+        return self._request("GET", f"/history/{username}/chats/{chat_id}/branches", headers=self._auth(token)).json()["branches"]
+
+    def fork_chat(self, username, chat_id, position, messages, *, token):
+        """
+        Edit-and-regenerate: keeps the first `position` messages and continues
+        with `messages` on a new branch, which becomes the active one.
+        """
+        return self._request("POST", f"/history/{username}/chats/{chat_id}/fork", headers=self._auth(token),
+                             json={"position": position, "messages": messages}).json()
+
+    def switch_branch(self, username, chat_id, branch_id, *, token):
+        return self._request("PUT", f"/history/{username}/chats/{chat_id}/branch", headers=self._auth(token),
+                             json={"branch_id": branch_id}).json()
+
+    def clear_history(self, username, *, token):
+        return self._request("DELETE", f"/history/{username}", headers=self._auth(token)).json()
+
+    # --- Chat ---
+    def stream_chat(self, messages, mode, token=None, memory=False, chat_id=None):
+        """
+        Yields reply text from /chat as the backend streams it. If the
+        connection drops mid-reply, reattaches to the same generation from
+        the last token received instead of asking for a new one. Raises
+        ChatStreamError if the generation itself fails. With a session
+        `token` the request counts against the user's rate limit rather
+        than the client address's. `memory` asks the backend to add
+        relevant snippets of the user's other chats (all but `chat_id`).
+        """
+        payload = {"messages": [{"role": m["role"], "content": m["content"]} for m in messages], "mode": mode}
+        if memory:
+            payload.update(memory=True, chat_id=chat_id)
+        headers = {"Accept": "application/x-ndjson", **self._auth(token)}
+        timeout = (CONNECT_TIMEOUT, STREAM_READ_TIMEOUT)
+        generation_id, offset, attempts = None, 0, 0
+        while True:
+            try:
+                if generation_id is None:
+                    resp = self.session.post(f"{self.base_url}/chat", json=payload, headers=headers, stream=True, timeout=timeout)
+                else:
+                    resp = self.session.get(f"{self.base_url}/chat/{generation_id}", params={"offset": offset}, headers=headers, stream=True, timeout=timeout)
+                with resp:
+                    _check(resp)
+                    for line in resp.iter_lines():
+                        if not line:
+                            continue
+                        event = json.loads(line)
+                        if event["event"] == "start":
+                            generation_id = event["generation_id"]
+                        elif event["event"] == "delta":
+                            offset = event["id"]
+                            yield event["text"]
+                        elif event["event"] == "error":
+                            raise ChatStreamError(event["type"], event["message"], event.get("status", 502))
+                        elif event["event"] == "done":
+                            return
+                raise requests.ConnectionError("Stream ended before the reply finished")
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError):
+                # Before the start event there is nothing to resume; a new POST would pay for a second reply
+                if generation_id is None or attempts >= STREAM_RESUME_ATTEMPTS:
+                    raise
+                attempts += 1
+                time.sleep(0.2 * attempts)
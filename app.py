@@ -1,113 +1,197 @@
 import streamlit as st
 import os
+import re
+import time
 import uuid
-import requests
 from dotenv import load_dotenv
-from groq import Groq
 
 # Load environment variables
 load_dotenv()
 
-# Initialize Groq client
-client = Groq(api_key=os.getenv("GROQ_API_KEY"))
+import modes
+from api_client import ApiClient, ApiError
 
 # Api Configuration
-# Use environment variable for deployment, default to localhost for dev
-API_URL = os.getenv("API_URL", "http://localhost:8000")
-
-# System Prompt
-SYSTEM_PROMPT = "You are a helpful AI assistant."
+# One pooled keep-alive client per process, shared by all sessions
+@st.cache_resource(show_spinner=False)
+def get_api():
+    return ApiClient()
 
 st.set_page_config(page_title="AI Chatbot", page_icon="🤖", layout="wide", initial_sidebar_state="expanded")
 
-# --- Global Custom CSS (Login & Base) ---
-st.markdown("""
-<style>
-    /* --- General App Styling --- */
-    
-    /* Reduce main content width for better readability */
-    .main > div {
-        max-width: 800px;
-        margin: auto;
-    }
-
-    /* --- Sidebar Polish --- */
-    section[data-testid="stSidebar"] {
-        padding-top: 2rem;
-        background-color: #121212; /* Darker background */
-    }
-    
-    /* Sidebar Buttons: Rounded & Softer Borders */
-    div[data-testid="stSidebar"] button {
-        border-radius: 12px !important;
-        border: 1px solid #333 !important;
-        transition: all 0.3s ease;
-    }
-    div[data-testid="stSidebar"] button:hover {
-        border-color: #555 !important;
-        background-color: #262730 !important;
-    }
-
-    /* --- Chat Bubbles (Base) --- */
-    div[data-testid="chat-message-user"] {
-        background-color: #2b2c34 !important;
-        color: #ffffff !important;
-        padding: 1rem;
-        border-radius: 15px 15px 0 15px !important;
-        margin-bottom: 1rem;
-        border: 1px solid #3d3d3d;
-        width: fit-content;
-        margin-left: auto;
-        max-width: 80%;
-    }
+api = get_api()
+
+# Log per-rerun server time (APP_PROFILE=1)
+APP_PROFILE = os.getenv("APP_PROFILE", "0") == "1"
+RUN_STARTED = time.perf_counter()
+
+def record_timing(kind, started):
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    st.session_state.setdefault("timings", {}).setdefault(kind, []).append(elapsed_ms)
+    if APP_PROFILE:
+        print(f"PERF: {kind} rerun took {elapsed_ms:.1f} ms")
+
+# --- Static assets (built once per process, shared by all sessions) ---
+@st.cache_resource(show_spinner=False)
+def load_css():
+    with open("assets/style.css") as f:
+        css = f.read()
+    # Strip comments and indentation before it is sent on every full rerun
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.S)
+    css = re.sub(r"\s*\n\s*", "", css)
+    return f"<style>{css}</style>"
+
+@st.cache_resource(show_spinner=False)
+def load_asset(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+@st.cache_resource(show_spinner=False)
+def circular_logo():
+    """
+    Logo cropped to a circle using PIL (No CSS).
+    """
+    from PIL import Image, ImageDraw, ImageOps
+
+    # Open Image
+    original_image = Image.open("assets/logo_circle.jpg")
     
-    div[data-testid="chat-message-assistant"] {
-        background-color: #1e1e1e !important;
-        color: #eeeeee !important;
-        padding: 1rem;
-        border-radius: 15px 15px 15px 0 !important;
-        margin-bottom: 1rem;
-        border: 1px solid #333;
-        width: fit-content;
-        margin-right: auto;
-        max-width: 80%;
-    }
-
-    /* Input Fields (Base) */
-    div[data-testid="stTextInput"] input {
-        background-color: #1E1E1E !important;
-        color: #E0E0E0 !important;
-        border: 1px solid #333333 !important;
-        border-radius: 8px !important;
-    }
-    div[data-testid="stTextInput"] input:focus {
-        border: 1px solid #FF4B4B !important;
-        box-shadow: none !important;
-    }
+    # Create Circular Mask
+    mask = Image.new("L", original_image.size, 0)
+    draw = ImageDraw.Draw(mask)
+    draw.ellipse((0, 0) + original_image.size, fill=255)
     
-    /* Tabs */
-    .stTabs [data-baseweb="tab-list"] {
-        gap: 10px;
-    }
-    .stTabs [data-baseweb="tab-highlight"] {
-        background-color: #FF4B4B !important;
-    }
-
-    .stTabs [data-baseweb="tab-highlight"] {
-        background-color: #FF4B4B !important;
-    }
-</style>
-""", unsafe_allow_html=True)
+    # Apply Mask to a copy converted to RGBA
+    circular_logo = ImageOps.fit(original_image, mask.size, centering=(0.5, 0.5))
+    circular_logo.putalpha(mask)
+    return circular_logo
+
+# --- Global Custom CSS (Login & Base) ---
+st.markdown(load_css(), unsafe_allow_html=True)
 
 # Session State Initialization
 if "user" not in st.session_state:
     st.session_state.user = None
+if "token" not in st.session_state:
+    st.session_state.token = None # Session token from /login, sent with every history call
 if "messages" not in st.session_state:
     st.session_state.messages = []
 if "current_chat_id" not in st.session_state:
     st.session_state.current_chat_id = None
 if "user_chats" not in st.session_state:
     st.session_state.user_chats = {} # Client-side cache for sidebar
+if "chats_cursor" not in st.session_state:
+    st.session_state.chats_cursor = None # Cursor for the next (older) page of chats
+if "history_version" not in st.session_state:
+    st.session_state.history_version = None # Backend history version the sidebar cache reflects
+
+if "mode" not in st.session_state:
+    st.session_state.mode = "Fast AI"
+if "memory" not in st.session_state:
+    st.session_state.memory = False
+
+# --- History API helpers ---
+def logout():
+    st.session_state.user = None
+    st.session_state.token = None
+    st.session_state.messages = []
+    st.session_state.user_chats = {}
+    st.session_state.chats_cursor = None
+    st.session_state.history_version = None
+    st.session_state.current_chat_id = None
+
+def check_session(e):
+    # An expired token (or a backend restarted with a new secret) means logging in again
+    if isinstance(e, ApiError) and e.status_code == 401:
+        logout()
+        st.rerun()
+
+def load_chat_page(username, cursor=None):
+    """
+    Fetches one page of chat titles (newest first) into the sidebar cache.
+    Messages are left unloaded (None) until the chat is opened.
+    """
+    try:
+        data = api.list_chats(username, cursor, token=st.session_state.token)
+    except Exception as e:
+        check_session(e)
+        return
+    # Cache is kept oldest-first so the sidebar can list it in reverse
+    older = {c["chat_id"]: {"title": c["title"], "messages": None} for c in reversed(data["chats"])}
+    older.update(st.session_state.user_chats)
+    st.session_state.user_chats = older
+    st.session_state.chats_cursor = data["next_cursor"]
+    if cursor is None:
+        st.session_state.history_version = data.get("version")
+
+def sync_history(username):
+    """
+    Applies the chats changed since the cached history version: generated
+    titles and chats saved from other sessions. Changed chats move to the
+    top; their cached messages are dropped (refetched when opened), except
+    for the open chat, whose messages this session wrote.
+    """
+    try:
+        delta = api.history_changes(username, st.session_state.history_version, token=st.session_state.token)
+    except Exception as e:
+        check_session(e)
+        return
+    if delta["reset"]:
+        # Cleared from another session
+        st.session_state.user_chats = {}
+        st.session_state.chats_cursor = None
+    cache = st.session_state.user_chats
+    for c in delta["chats"]:
+        chat = cache.pop(c["chat_id"], None) or {"messages": None}
+        chat["title"] = c["title"]
+        chat["branches"] = None # Another session may have forked it
+        if c["chat_id"] != st.session_state.current_chat_id:
+            chat["messages"] = None
+        cache[c["chat_id"]] = chat
+    st.session_state.history_version = delta["version"]
+
+def load_branches(username, chat_id):
+    """
+    The chat's branches (see /branches), cached with the chat until it changes.
+    """
+    chat = st.session_state.user_chats.get(chat_id)
+    if chat is None:
+        return []
+    if chat.get("branches") is None:
+        try:
+            chat["branches"] = api.branches(username, chat_id, token=st.session_state.token)
+        except Exception as e:
+            check_session(e)
+            return []
+    return chat["branches"]
+
+def branch_label(branch):
+    if branch["branch_id"] is None:
+        return "Original"
+    return f"From message {branch['fork_position'] + 1}: {branch['preview'][:40]}"
+
+def switch_branch(username, chat_id, branch_id):
+    try:
+        api.switch_branch(username, chat_id, branch_id, token=st.session_state.token)
+        messages = api.chat_messages(username, chat_id, token=st.session_state.token)
+    except Exception as e:
+        check_session(e)
+        st.error("Failed to switch branch")
+        return
+    chat = st.session_state.user_chats[chat_id]
+    chat["messages"], chat["branches"] = messages, None
+    st.session_state.messages = messages
+    st.rerun()
+
+def start_fork(position, messages):
+    """
+    Edit-and-regenerate: the conversation continues from `position` with
+    `messages` (ending with a user message); the reply is generated and
+    stored as a new branch by chat_turns.
+    """
+    st.session_state.messages = st.session_state.messages[:position] + messages
+    st.session_state.fork_at = position
+    st.rerun()
 
 # --- AUTHENTICATION FLOW ---
 if not st.session_state.user:
@@ -138,31 +222,16 @@ if not st.session_state.user:
             )
             
         with hero_img_col:
-            st.image("assets/robot_saying.png", use_container_width=True)
+            st.image(load_asset("assets/robot_saying.png"), use_container_width=True)
 
     # --- Right Column: Auth Forms ---
     with c2:
         # Centered Robot Logo using columns
         logo_l, logo_c, logo_r = st.columns([1, 2, 1]) # Wider middle column for bigger logo
         with logo_c:
-             # Process Image to be Circular using PIL (No CSS)
-             from PIL import Image, ImageDraw, ImageOps
-             
              try:
-                 # Open Image
-                 original_image = Image.open("assets/logo_circle.jpg")
-                 
-                 # Create Circular Mask
-                 mask = Image.new("L", original_image.size, 0)
-                 draw = ImageDraw.Draw(mask)
-                 draw.ellipse((0, 0) + original_image.size, fill=255)
-                 
-                 # Apply Mask to a copy converted to RGBA
-                 circular_logo = ImageOps.fit(original_image, mask.size, centering=(0.5, 0.5))
-                 circular_logo.putalpha(mask)
-                 
                  # Display Larger and Circular
-                 st.image(circular_logo, width=220)
+                 st.image(circular_logo(), width=220)
              except Exception as e:
                  st.error(f"Logo Error: {e}")
                  st.image("assets/logo_circle.jpg", width=220) # Fallback
@@ -184,18 +253,16 @@ if not st.session_state.user:
                     st.error("Please enter credentials.")
                 else:
                     try:
-                        resp = requests.post(f"{API_URL}/login", json={"username": user_login, "password": pass_login})
-                        if resp.status_code == 200:
-                            st.session_state.user = user_login
-                            st.session_state.logged_in = True
-                            try:
-                                h_resp = requests.get(f"{API_URL}/history/{user_login}")
-                                st.session_state.user_chats = h_resp.json() if h_resp.status_code == 200 else {}
-                            except:
-                                st.session_state.user_chats = {}
-                            st.rerun()
-                        else:
-                            st.error(resp.json().get('detail', 'Login failed'))
+                        session = api.login(user_login, pass_login)
+                        st.session_state.user = user_login
+                        st.session_state.token = session["token"]
+                        st.session_state.logged_in = True
+                        st.session_state.user_chats = {}
+                        st.session_state.chats_cursor = None
+                        load_chat_page(user_login)
+                        st.rerun()
+                    except ApiError as e:
+                        st.error(e.detail or 'Login failed')
                     except Exception as e:
                         st.error(f"Connection error: {e}")
 
@@ -213,11 +280,10 @@ if not st.session_state.user:
                     st.error("Please fill out all fields.")
                 else:
                     try:
-                        resp = requests.post(f"{API_URL}/register", json={"username": new_user, "password": new_pass})
-                        if resp.status_code == 200:
-                            st.success("Account created! Please log in.")
-                        else:
-                            st.error(resp.json().get('detail', 'Sign up failed'))
+                        api.register(new_user, new_pass)
+                        st.success("Account created! Please log in.")
+                    except ApiError as e:
+                        st.error(e.detail or 'Sign up failed')
                     except Exception as e:
                         st.error(f"Connection error: {e}")
 
@@ -248,29 +314,35 @@ else:
             with col_conf1:
                 if st.button("Yes", type="primary", use_container_width=True, key="confirm_yes"):
                     try:
-                        requests.delete(f"{API_URL}/history/{user}")
+                        api.clear_history(user, token=st.session_state.token)
                         st.session_state.messages = []
                         st.session_state.current_chat_id = None
                         st.session_state.user_chats = {} # Clear local cache
+                        st.session_state.chats_cursor = None
+                        st.session_state.history_version = None
                         st.session_state.confirm_clear = False
                         st.rerun()
-                    except:
+                    except Exception as e:
+                        check_session(e)
                         st.error("Failed to clear history")
             with col_conf2:
                 if st.button("No", use_container_width=True, key="confirm_no"):
                     st.session_state.confirm_clear = False
                     st.rerun()
             
+        # Mode picks the backend's system prompt, temperature and context budget
+        st.selectbox("Mode", list(modes.MODES), key="mode")
+        # Lets replies draw on the user's other chats (if the backend has CHAT_MEMORY on)
+        st.toggle("Remember other chats", key="memory")
+
         st.divider()
         st.subheader("Chat History")
         
-        # Use Cached Chats (Sync on load if empty)
-        if not st.session_state.user_chats and st.session_state.current_chat_id is None:
-             try:
-                resp = requests.get(f"{API_URL}/history/{user}")
-                if resp.status_code == 200:
-                    st.session_state.user_chats = resp.json()
-             except: pass
+        # Use Cached Chats: first page on load, then only what changed since
+        if st.session_state.history_version is not None:
+            sync_history(user)
+        elif not st.session_state.user_chats and st.session_state.current_chat_id is None:
+            load_chat_page(user)
 
         chats = st.session_state.user_chats
 
@@ -280,18 +352,27 @@ else:
             title = chat_data.get("title", "New Chat")
             # Highlight current chat
             if st.button(title, key=chat_id, use_container_width=True, type="secondary" if chat_id != st.session_state.current_chat_id else "primary"):
+                if chat_data.get("messages") is None:
+                    try:
+                        chat_data["messages"] = api.chat_messages(user, chat_id, token=st.session_state.token)
+                    except Exception as e:
+                        check_session(e)
+                        st.error("Failed to load chat")
+                        st.stop()
                 st.session_state.current_chat_id = chat_id
                 st.session_state.messages = chat_data["messages"]
                 st.session_state.confirm_clear = False
                 st.rerun()
 
+        if st.session_state.chats_cursor:
+            if st.button("Load older chats", use_container_width=True):
+                load_chat_page(user, st.session_state.chats_cursor)
+                st.rerun()
+
         # Logout at bottom
         st.divider()
         if st.button("Logout", use_container_width=True):
-            st.session_state.user = None
-            st.session_state.messages = []
-            st.session_state.user_chats = {}
-            st.session_state.current_chat_id = None
+            logout()
             st.rerun()
 
     # Chat Interface
@@ -304,69 +385,114 @@ else:
         if not st.session_state.messages:
              st.session_state.messages = [{"role": "assistant", "content": "Hello! How can I help you today?"}]
 
+    # Edit, regenerate and branch picker, once the chat is stored on the backend
+    chat_id = st.session_state.current_chat_id
+    messages = st.session_state.messages
+    user_positions = [i for i, m in enumerate(messages) if m["role"] == "user"]
+    if chat_id in st.session_state.user_chats and user_positions and st.session_state.get("fork_at") is None:
+        col_branch, col_edit, col_regen = st.columns([3, 1, 1], vertical_alignment="bottom")
+        with col_branch:
+            branches = load_branches(user, chat_id)
+            if len(branches) > 1:
+                active = next((i for i, b in enumerate(branches) if b["active"]), 0)
+                # Keyed by the active branch too, so a fork or switch resets the widget to it
+                picked = st.selectbox("Branch", range(len(branches)), index=active, format_func=lambda i: branch_label(branches[i]),
+                                      key=f"branch_{chat_id}_{branches[active]['branch_id']}")
+                if picked != active:
+                    switch_branch(user, chat_id, branches[picked]["branch_id"])
+        with col_edit:
+            with st.popover("✏️ Edit", use_container_width=True):
+                position = st.selectbox("Message", user_positions, index=len(user_positions) - 1,
+                                        format_func=lambda i: messages[i]["content"][:60], key=f"edit_pick_{chat_id}")
+                edited = st.text_area("New text", value=messages[position]["content"], key=f"edit_text_{chat_id}_{position}")
+                if st.button("Send", type="primary", use_container_width=True, disabled=not edited.strip()):
+                    start_fork(position, [{"role": "user", "content": edited}])
+        with col_regen:
+            if messages[-1]["role"] == "assistant" and user_positions[-1] == len(messages) - 2:
+                if st.button("🔄 Regenerate", use_container_width=True):
+                    start_fork(len(messages) - 1, [])
+
     # Display chat
+    # The transcript is rendered only on full reruns; turns sent after that
+    # are rendered by the chat_turns fragment below
+    st.session_state.transcript_len = len(st.session_state.messages)
     for msg in st.session_state.messages:
         with st.chat_message(msg["role"]):
             st.markdown(msg["content"])
 
-    # Chat Input
-    if prompt := st.chat_input("Type your message..."):
-        st.session_state.messages.append({"role": "user", "content": prompt})
-        with st.chat_message("user"):
-            st.markdown(prompt)
-
+    def respond(user, fork_at=None):
+        """
+        Streams the reply to the conversation so far and stores the turn: a
+        save, or with `fork_at`, a new branch from that position.
+        """
         with st.chat_message("assistant"):
             placeholder = st.empty()
             full_response = ""
-            
+        
             try:
-                stream = client.chat.completions.create(
-                    model="llama-3.1-8b-instant",
-                    messages=[
-                        {"role": "system", "content": SYSTEM_PROMPT}
-                    ] + [
-                        {"role": m["role"], "content": m["content"]} 
-                        for m in st.session_state.messages
-                    ],
-                    stream=True
-                )
-                
-                for chunk in stream:
-                    if chunk.choices and chunk.choices[0].delta.content:
-                        content = chunk.choices[0].delta.content
-                        full_response += content
-                        placeholder.markdown(full_response + "▌")
-                
+                # Streamed through the backend's /chat, which applies the mode
+                for content in api.stream_chat(st.session_state.messages, st.session_state.mode, st.session_state.token,
+                                               memory=st.session_state.memory, chat_id=st.session_state.current_chat_id):
+                    full_response += content
+                    placeholder.markdown(full_response + "▌")
+            
                 placeholder.markdown(full_response)
                 st.session_state.messages.append({"role": "assistant", "content": full_response})
-                
+            
                 # --- SYNC LOGIC ---
                 if st.session_state.current_chat_id not in st.session_state.user_chats:
                      st.session_state.user_chats[st.session_state.current_chat_id] = {"title": "New Chat", "messages": []}
-                
-                st.session_state.user_chats[st.session_state.current_chat_id]["messages"] = st.session_state.messages
-                
-                current_title = st.session_state.user_chats[st.session_state.current_chat_id].get("title", "New Chat")
-                
-                if current_title == "New Chat" and len(st.session_state.messages) >= 2:
-                    first_msg = next((m["content"] for m in st.session_state.messages if m["role"] == "user"), "")
-                    if first_msg:
-                        new_title = (first_msg[:20] + '..') if len(first_msg) > 20 else first_msg
-                        st.session_state.user_chats[st.session_state.current_chat_id]["title"] = new_title
-                        requests.post(f"{API_URL}/history/save", json={
-                            "username": user,
-                            "chat_id": st.session_state.current_chat_id,
-                            "title": new_title,
-                            "messages": st.session_state.messages
-                        })
-                        st.rerun()
-                
-                requests.post(f"{API_URL}/history/save", json={
-                    "username": user,
-                    "chat_id": st.session_state.current_chat_id,
-                    "title": st.session_state.user_chats[st.session_state.current_chat_id].get("title", "New Chat"),
-                    "messages": st.session_state.messages
-                })
+            
+                chat = st.session_state.user_chats[st.session_state.current_chat_id]
+                chat["messages"] = st.session_state.messages
+            
+                if fork_at is None:
+                    # The backend titles "New Chat" chats in the background; the
+                    # sidebar picks the title up in its next history sync
+                    api.save_chat(
+                        user,
+                        st.session_state.current_chat_id,
+                        chat.get("title", "New Chat"),
+                        st.session_state.messages,
+                        token=st.session_state.token,
+                    )
+                else:
+                    # Only the new tail is sent; the stored prefix is shared
+                    api.fork_chat(user, st.session_state.current_chat_id, fork_at, st.session_state.messages[fork_at:],
+                                  token=st.session_state.token)
+                    chat["branches"] = None
+                    # Full rerun, so the branch picker lists the new branch
+                    st.rerun()
 
             except Exception as e:
+                check_session(e)
                 placeholder.error(f"Error: {str(e)}")
+
+    @st.fragment
+    def chat_turns(user):
+        """
+        New turns and the input box. Sending a message reruns only this
+        fragment, not the transcript above or the sidebar.
+        """
+        started = time.perf_counter()
+        for msg in st.session_state.messages[st.session_state.transcript_len:]:
+            with st.chat_message(msg["role"]):
+                st.markdown(msg["content"])
+
+        # Chat Input
+        prompt = st.chat_input("Type your message...")
+        # Set by Edit / Regenerate: the transcript already ends with the new user message
+        fork_at = st.session_state.pop("fork_at", None)
+        if fork_at is not None:
+            respond(user, fork_at)
+        elif prompt:
+            st.session_state.messages.append({"role": "user", "content": prompt})
+            with st.chat_message("user"):
+                st.markdown(prompt)
+            respond(user)
+
+        record_timing("chat", started)
+
+    chat_turns(user)
+
+record_timing("full", RUN_STARTED)
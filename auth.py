@@ -1,3 +1,8 @@
+"""
+Legacy JSON-file user store, from before the database backend. Nothing
+imports it any more; `python import_users.py users.json` moves an
+existing users.json into the database.
+"""
 import json
 import os
 import bcrypt
@@ -0,0 +1,86 @@
+"""
+Per-rerun server time of the Streamlit app, measured with AppTest.
+
+Runs app.py headless against a local backend stack and times the login
+page, a full rerun of the chat page with a long transcript, and sending a
+message on that page. AppTest always reruns the whole script, so the
+server-side time of the chat_turns fragment (what a live send costs) is
+read from the timings app.py records in session state.
+
+    python -m benchmarks.bench_app_rerun --messages 200 --repeat 5
+"""
+import argparse
+import json
+import os
+import time
+import uuid
+
+import httpx
+
+from benchmarks.harness import ROOT, LocalStack, summarize
+
+APP = os.path.join(ROOT, "app.py")
+
+
+def timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def run(api_url, n_messages, repeat):
+    os.environ["API_URL"] = api_url
+    from streamlit.testing.v1 import AppTest
+
+    username = f"bench_{uuid.uuid4().hex[:8]}"
+    chat_id = str(uuid.uuid4())
+    messages = [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": f"Message {i} with **markdown** and `code`. " * 5}
+        for i in range(n_messages)
+    ]
+    httpx.post(f"{api_url}/register", json={"username": username, "password": "pw"}).raise_for_status()
+    resp = httpx.post(f"{api_url}/login", json={"username": username, "password": "pw"})
+    resp.raise_for_status()
+    token = resp.json()["token"]
+    httpx.post(f"{api_url}/history/save", headers={"Authorization": f"Bearer {token}"}, json={
+        "username": username, "chat_id": chat_id, "title": "Bench chat", "messages": messages,
+    }).raise_for_status()
+
+    login, full, send, fragment = [], [], [], []
+    for _ in range(repeat):
+        at = AppTest.from_file(APP, default_timeout=60)
+        login.append(timed(at.run))
+
+        at = AppTest.from_file(APP, default_timeout=60)
+        at.session_state.user = username
+        at.session_state.token = token
+        at.session_state.current_chat_id = chat_id
+        at.session_state.messages = list(messages)
+        at.run()
+        full.append(timed(at.run))
+        send.append(timed(at.chat_input[0].set_value("One more question").run))
+        timings = at.session_state["timings"] if "timings" in at.session_state else {}
+        fragment.extend(ms / 1000 for ms in timings.get("chat", [])[-1:])
+
+    return {
+        "messages": n_messages,
+        "login_page_s": summarize(login),
+        "chat_full_rerun_s": summarize(full),
+        "chat_send_message_s": summarize(send),
+        "chat_fragment_only_s": summarize(fragment),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Streamlit per-rerun timing")
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    fake_env = {"FAKE_GROQ_TOKENS": "5", "FAKE_GROQ_FIRST_TOKEN_DELAY": "0"}
+    with LocalStack(fake_env=fake_env) as stack:
+        report = run(stack.api_url, args.messages, args.repeat)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+Branch storage: forks sharing their prefix vs. a full copy per branch.
+
+Starts one chat of --messages messages, then makes --branches edits at
+random positions, each continued with --tail new messages. Later edits
+often land on earlier branches, so the tree nests. Two ways of storing
+the same edits, each in its own process and throwaway SQLite file:
+
+    tree  POST .../fork: the branch stores only its own messages
+    copy  a new chat per edit, holding the whole conversation
+
+Reports message rows and messages-table size as the branch count grows,
+plus per-edit latency and, for the tree, the time to switch branches and
+open the active one.
+
+    python -m benchmarks.bench_branching --messages 100 --branches 50 --tail 6
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.harness import ROOT, summarize
+from benchmarks.bench_compression import message
+
+VARIANTS = ("tree", "copy")
+
+
+def conversation(rng, start, count):
+    roles = ("user" if i % 2 == 0 else "assistant" for i in range(start, start + count))
+    return [{"role": role, "content": message(rng, role)} for role in roles]
+
+
+def table_stats(db):
+    from sqlalchemy import func, text
+    from models import Message
+
+    db.commit()
+    db.execute(text("VACUUM"))
+    size = db.execute(text("SELECT SUM(pgsize) FROM dbstat WHERE name = 'messages'")).scalar()
+    return {"rows": db.query(func.count(Message.id)).scalar(), "messages_table_bytes": size}
+
+
+def run_variant(name, args):
+    """
+    Runs in the variant's own process, against its own database file.
+    """
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, ROOT)
+    from database import SessionLocal
+    from models import User
+    import crud
+    import migrate
+
+    migrate.upgrade_schema()
+    db = SessionLocal()
+    user = User(username="bench", password_hash="x")
+    db.add(user)
+    db.commit()
+
+    rng = random.Random(1)
+    base = conversation(rng, 0, args.messages)
+    crud.store_chat(db, user.id, "chat", "Bench", base)
+    db.commit()
+
+    checkpoints = sorted({0, *(round(args.branches * f) for f in (0.1, 0.25, 0.5, 1.0))})
+    growth = {"0": table_stats(db)}
+    edits, switches, opens = [], [], []
+    # What each branch reads as, so edits can build on any of them
+    branches = [(None, base)]
+    for n in range(1, args.branches + 1):
+        branch_id, messages = rng.choice(branches)
+        position = rng.randrange(len(messages))
+        tail = conversation(rng, position, args.tail)
+        start = time.perf_counter()
+        if name == "tree":
+            chat = crud.get_chat(db, "chat")
+            if chat.branch_id != branch_id:
+                t = time.perf_counter()
+                crud.switch_branch(db, chat, branch_id)
+                switches.append(time.perf_counter() - t)
+                start = time.perf_counter()
+            crud.fork_chat(db, chat, position, tail)
+            branch_id = chat.branch_id
+        else:
+            crud.store_chat(db, user.id, f"chat-{n}", "Bench", messages[:position] + tail)
+            branch_id = n
+        db.commit()
+        edits.append(time.perf_counter() - start)
+        branches.append((branch_id, messages[:position] + tail))
+
+        if name == "tree":
+            t = time.perf_counter()
+            chat = crud.get_chat(db, "chat")
+            page = crud.get_message_page(db, chat, -1, len(messages) + args.tail)
+            opens.append(time.perf_counter() - t)
+            assert [m["content"] for _, m in page] == [m["content"] for m in branches[-1][1]]
+        if n in checkpoints:
+            growth[str(n)] = table_stats(db)
+    db.close()
+
+    return {
+        "growth": growth,
+        "edit_ms": summarize(edits, 1000),
+        "switch_ms": summarize(switches, 1000) if switches else None,
+        "open_ms": summarize(opens, 1000) if opens else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Branch storage benchmark")
+    parser.add_argument("--messages", type=int, default=100, help="length of the original conversation")
+    parser.add_argument("--branches", type=int, default=50)
+    parser.add_argument("--tail", type=int, default=6, help="messages written after each edit")
+    parser.add_argument("--json", help="write the report to this file")
+    args = parser.parse_args()
+
+    variant = os.getenv("BENCH_BRANCHING_VARIANT")
+    if variant:
+        print(json.dumps(run_variant(variant, args)))
+        return
+
+    report = {"config": vars(args), "variants": {}}
+    for name in VARIANTS:
+        env = dict(os.environ, BENCH_BRANCHING_VARIANT=name, PYTHONPATH=ROOT)
+        out = subprocess.run([sys.executable, "-m", "benchmarks.bench_branching"] + sys.argv[1:],
+                             cwd=ROOT, env=env, check=True, capture_output=True, text=True).stdout
+        report["variants"][name] = json.loads(out.strip().splitlines()[-1])
+
+    tree, copy = report["variants"]["tree"], report["variants"]["copy"]
+    print(f"{'branches':>8} {'tree rows':>10} {'copy rows':>10} {'tree MB':>9} {'copy MB':>9}")
+    for n in tree["growth"]:
+        t, c = tree["growth"][n], copy["growth"][n]
+        print(f"{n:>8} {t['rows']:>10} {c['rows']:>10} {t['messages_table_bytes'] / 1e6:>9.2f} {c['messages_table_bytes'] / 1e6:>9.2f}")
+    print(f"edit p50: tree {tree['edit_ms']['p50']:.2f} ms, copy {copy['edit_ms']['p50']:.2f} ms")
+    if tree["switch_ms"]:
+        print(f"tree switch p50 {tree['switch_ms']['p50']:.2f} ms, open active branch p50 {tree['open_ms']['p50']:.2f} ms")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""
+Message compression: on-disk size vs. read latency, and history egress.
+
+Builds the same synthetic chat history (--users x --chats x --messages of
+assistant-style text) once per storage variant, each in its own process and
+throwaway SQLite file:
+
+    plain      MESSAGE_COMPRESSION=off
+    zstd       compressed without a dictionary
+    zstd_dict  dictionary trained by migrate.py, every row recompressed
+
+and reports the messages table, search index and whole file size (after
+VACUUM; the corpus is bulk-loaded, then indexed for search), the time to
+open --opens random chats, and the time to load a user's full history. The
+egress part sizes one user's /history JSON with no encoding, gzip and zstd.
+
+    python -m benchmarks.bench_compression --chats 200 --messages 40
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.harness import ROOT, summarize
+
+VARIANTS = {
+    "plain": {"MESSAGE_COMPRESSION": "off"},
+    "zstd": {"MESSAGE_COMPRESSION": "zstd"},
+    "zstd_dict": {"MESSAGE_COMPRESSION": "zstd"},
+}
+
+TOPICS = ["Python", "SQL", "Docker", "React", "pandas", "FastAPI", "Kubernetes", "regex", "Git", "asyncio"]
+VERBS = ["configure", "debug", "optimize", "deploy", "test", "refactor", "install", "migrate", "profile", "secure"]
+NOUNS = ["the server", "a query", "the database", "your function", "the container", "an endpoint",
+         "the cache", "a list", "the config file", "the request", "the index", "a dataframe"]
+OPENERS = ["Sure! Here's how you can", "Great question. To", "You can", "Here's a step-by-step guide to",
+           "Absolutely. The simplest way to", "Let's break down how to"]
+CODE = [
+    "```python\nimport {m}\n\ndef main():\n    result = {m}.run(config)\n    print(result)\n```",
+    "```bash\npip install {m}\n{m} --help\n```",
+    "```sql\nSELECT id, name FROM {m} WHERE created_at > NOW() - INTERVAL '7 days';\n```",
+]
+
+
+def message(rng, role):
+    topic = rng.choice(TOPICS)
+    if role == "user":
+        return f"How do I {rng.choice(VERBS)} {rng.choice(NOUNS)} in {topic}? {rng.choice(['Thanks!', '', 'It keeps failing.'])}".strip()
+    parts = [f"{rng.choice(OPENERS)} {rng.choice(VERBS)} {rng.choice(NOUNS)} in {topic}:\n"]
+    for step in range(rng.randint(2, 6)):
+        parts.append(f"{step + 1}. **{rng.choice(VERBS).title()} {rng.choice(NOUNS)}** so that "
+                     f"{rng.choice(NOUNS)} can {rng.choice(VERBS)} {rng.choice(NOUNS)} ({rng.randint(1, 999)}).")
+    if rng.random() < 0.5:
+        parts.append(rng.choice(CODE).format(m=topic.lower()))
+    parts.append("Let me know if you'd like more detail on any of these steps!")
+    return "\n".join(parts)
+
+
+def build_corpus(db, users, chats, messages, seed=1):
+    from sqlalchemy import insert
+    from models import User, Chat, Message, utcnow
+
+    rng = random.Random(seed)
+    for u in range(users):
+        user = User(username=f"user{u}", password_hash="x")
+        db.add(user)
+        db.flush()
+        for c in range(chats):
+            chat = Chat(chat_uuid=f"{u}-{c}", user_id=user.id, title=f"Chat {c}", updated_at=utcnow())
+            db.add(chat)
+            db.flush()
+            db.execute(insert(Message), [
+                {"chat_id": chat.id, "position": i, "role": role, "content": message(rng, role)}
+                for i, role in ((i, "user" if i % 2 == 0 else "assistant") for i in range(messages))
+            ])
+        db.commit()
+
+
+def run_variant(name, args):
+    """
+    Runs in the variant's own process (storage settings are read at import).
+    """
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, ROOT)
+    from sqlalchemy import text
+    from database import SessionLocal, engine
+    from models import Chat
+    import codec
+    import crud
+    import migrate
+    import search
+
+    migrate.upgrade_schema()
+    db = SessionLocal()
+    start = time.perf_counter()
+    build_corpus(db, args.users, args.chats, args.messages)
+    build_s = time.perf_counter() - start
+    if name == "zstd_dict":
+        codec.train_dictionary(db)
+        migrate.compress_messages(db, recompress=True)
+    db.close()
+    # The bulk load skips the search index; index everything now, as a
+    # real history would be, so its size counts towards the file
+    search.create_index(engine)
+    with engine.connect() as conn:
+        conn.execute(text("VACUUM"))
+        sizes = dict(conn.execute(text("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name")).all())
+    engine.dispose()
+
+    # Cold-ish reads: a fresh session per open, rows decompressed as they load
+    rng = random.Random(2)
+    chat_uuids = [f"{rng.randrange(args.users)}-{rng.randrange(args.chats)}" for _ in range(args.opens)]
+    opens = []
+    for chat_uuid in chat_uuids:
+        db = SessionLocal()
+        t = time.perf_counter()
+        chat = crud.get_chat(db, chat_uuid)
+        crud.get_message_page(db, chat, -1, args.messages)
+        opens.append(time.perf_counter() - t)
+        db.close()
+
+    db = SessionLocal()
+    t = time.perf_counter()
+    user = crud.get_user(db, "user0")
+    history = [{"chat_id": c.chat_uuid, "title": c.title, "messages": crud.serialize_messages(c)}
+               for c in db.query(Chat).filter(Chat.user_id == user.id)]
+    full_history_ms = (time.perf_counter() - t) * 1000
+    db.close()
+
+    return {
+        "build_s": build_s,
+        "messages_table_bytes": sizes.get("messages"),
+        "search_index_bytes": sum(size for table, size in sizes.items() if table.startswith("messages_fts")),
+        "file_bytes": os.path.getsize("chatbot.db"),
+        "open_chat_ms": summarize(opens, 1000),
+        "full_history_ms": full_history_ms,
+        "history_json": json.dumps({"history": history}),
+    }
+
+
+def egress(body: bytes):
+    import response_compression
+
+    report = {"identity": {"bytes": len(body), "compress_ms": 0.0}}
+    for encoding in ("gzip", "zstd"):
+        t = time.perf_counter()
+        compressed = response_compression.compress(body, encoding)
+        report[encoding] = {"bytes": len(compressed), "compress_ms": (time.perf_counter() - t) * 1000}
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Message compression benchmark")
+    parser.add_argument("--users", type=int, default=5)
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=40)
+    parser.add_argument("--opens", type=int, default=200)
+    parser.add_argument("--variants", default=",".join(VARIANTS))
+    parser.add_argument("--json", help="write the report to this file")
+    args = parser.parse_args()
+
+    variant = os.getenv("BENCH_COMPRESSION_VARIANT")
+    if variant:
+        print(json.dumps(run_variant(variant, args)))
+        return
+
+    report = {"storage": {}}
+    for name in args.variants.split(","):
+        env = dict(os.environ, BENCH_COMPRESSION_VARIANT=name, PYTHONPATH=ROOT, **VARIANTS[name])
+        out = subprocess.run([sys.executable, "-m", "benchmarks.bench_compression"] + sys.argv[1:],
+                             cwd=ROOT, env=env, check=True, capture_output=True, text=True).stdout
+        result = json.loads(out.strip().splitlines()[-1])
+        history_json = result.pop("history_json")
+        report["storage"][name] = result
+        print(f"{name:<10} messages {result['messages_table_bytes'] / 1e6:7.2f} MB  "
+              f"search index {result['search_index_bytes'] / 1e6:7.2f} MB  file {result['file_bytes'] / 1e6:7.2f} MB  "
+              f"open p50 {result['open_chat_ms']['p50']:.2f} ms  p95 {result['open_chat_ms']['p95']:.2f} ms  "
+              f"full history {result['full_history_ms']:.0f} ms")
+
+    report["history_egress"] = egress(history_json.encode())
+    for encoding, r in report["history_egress"].items():
+        print(f"/history {encoding:<9} {r['bytes'] / 1e3:9.1f} kB  {r['compress_ms']:.1f} ms")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
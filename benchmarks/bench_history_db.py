@@ -0,0 +1,202 @@
+"""
+Sync vs async database path under concurrent history traffic.
+
+Serves main:app with the pre-async handlers mounted alongside it under
+/sync (plain `def` endpoints on SessionLocal, so each request holds a
+threadpool slot for its whole DB round trip). Both variants hit the same
+seeded database and the same crud queries; only the session type and the
+way the handler is scheduled differ. Requests carry session tokens issued
+with the server's SESSION_SECRET (the /sync handlers ignore them). At each --concurrency level the same
+read-heavy mix runs against /history/... and then /sync/history/...:
+
+    full       GET  /history/{user}            (every chat with its messages)
+    list       GET  /history/{user}/chats
+    save       POST /history/save              (appends two messages)
+
+    python -m benchmarks.bench_history_db --concurrency 16,64,256 --duration 10
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+
+import httpx
+
+from benchmarks.harness import free_port, migrate, start_server, stop_server, summarize
+
+MIX = {"full": 2, "list": 6, "save": 2}
+
+
+# --- Server side: main:app plus the sync reference handlers ---
+
+def build_app():
+    from fastapi import Depends, HTTPException
+    from sqlalchemy.orm import Session
+    import crud
+    import main
+    from database import get_db
+
+    @main.app.get("/sync/history/{username}")
+    def sync_history(username: str, db: Session = Depends(get_db)):
+        user = crud.get_user(db, username)
+        if not user:
+            return {}
+        return {c.chat_uuid: {"title": c.title, "messages": crud.serialize_messages(c)}
+                for c in crud.get_user_chats(db, user.id)}
+
+    @main.app.get("/sync/history/{username}/chats")
+    def sync_list(username: str, db: Session = Depends(get_db)):
+        user = crud.get_user(db, username)
+        if not user:
+            return {"chats": []}
+        rows = crud.list_chat_summaries(db, user.id, 51)
+        return {"chats": [{"chat_id": r.chat_uuid, "title": r.title} for r in rows[:50]]}
+
+    @main.app.post("/sync/history/save")
+    def sync_save(chat_data: main.ChatData, db: Session = Depends(get_db)):
+        user = crud.get_user(db, chat_data.username)
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
+        crud.store_chat(db, user.id, chat_data.chat_id, chat_data.title, chat_data.messages)
+        db.commit()
+        return {"status": "saved"}
+
+    return main.app
+
+
+if os.getenv("BENCH_HISTORY_SERVER") == "1":
+    app = build_app()
+
+
+# --- Client side ---
+
+def seed(users, chats, messages):
+    from sqlalchemy import insert
+    from database import SessionLocal
+    from models import User, Chat, Message, utcnow
+    import tokens
+
+    db = SessionLocal()
+    names = {}  # username -> session token
+    for u in range(users):
+        user = User(username=f"bench{u}", password_hash="x")
+        db.add(user)
+        db.flush()
+        names[user.username] = tokens.issue(user.id, user.username)
+        for c in range(chats):
+            chat = Chat(chat_uuid=f"bench{u}-{c}", user_id=user.id, title=f"Chat {c}", updated_at=utcnow())
+            db.add(chat)
+            db.flush()
+            db.execute(insert(Message), [
+                {"chat_id": chat.id, "position": i, "role": "user" if i % 2 == 0 else "assistant",
+                 "content": f"message {i} " + "lorem ipsum " * 10}
+                for i in range(messages)
+            ])
+    db.commit()
+    db.close()
+    return names
+
+
+async def run_level(api_url, prefix, users, concurrency, duration, seed_value):
+    rng = random.Random(seed_value)
+    ops = [op for op, weight in MIX.items() for _ in range(weight)]
+    latencies = {op: [] for op in MIX}
+    errors = 0
+    deadline = time.perf_counter() + duration
+
+    names = list(users)
+
+    async def worker(client):
+        nonlocal errors
+        chat_id = f"{prefix.strip('/') or 'async'}-{uuid.uuid4().hex}"
+        messages = []
+        while time.perf_counter() < deadline:
+            op = rng.choice(ops)
+            user = names[0] if op == "save" else rng.choice(names)
+            headers = {"Authorization": f"Bearer {users[user]}"}
+            start = time.perf_counter()
+            try:
+                if op == "full":
+                    resp = await client.get(f"{api_url}{prefix}/history/{user}", headers=headers)
+                elif op == "list":
+                    resp = await client.get(f"{api_url}{prefix}/history/{user}/chats", headers=headers)
+                else:
+                    messages += [{"role": "user", "content": "q"}, {"role": "assistant", "content": "a"}]
+                    resp = await client.post(f"{api_url}{prefix}/history/save", headers=headers, json={
+                        "username": user, "chat_id": chat_id, "title": "Bench", "messages": messages,
+                    })
+                if resp.status_code >= 400:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies[op].append(time.perf_counter() - start)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    total = sum(len(v) for v in latencies.values())
+    return {
+        "requests": total,
+        "errors": errors,
+        "throughput_rps": total / elapsed,
+        "latency_ms": {op: summarize(values, 1000) for op, values in latencies.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sync vs async history endpoints")
+    parser.add_argument("--concurrency", default="16,64,256")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--chats", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--json", help="write the report to this file")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.TemporaryDirectory()
+    env = {
+        "DATABASE_URL": os.getenv("DATABASE_URL") or f"sqlite:///{os.path.join(tmpdir.name, 'bench.db')}",
+        "GROQ_API_KEY": "fake-key",
+        "WRITE_BEHIND": "0",
+        "SESSION_SECRET": uuid.uuid4().hex,
+    }
+    migrate(cwd=tmpdir.name, env=env)
+    os.environ.update(env)
+    users = seed(args.users, args.chats, args.messages)
+
+    port = free_port()
+    proc = start_server("benchmarks.bench_history_db:app", port, cwd=tmpdir.name,
+                        env=dict(env, BENCH_HISTORY_SERVER="1"))
+    api_url = f"http://127.0.0.1:{port}"
+    report = {"database": env["DATABASE_URL"].split(":", 1)[0], "levels": {}}
+    try:
+        for concurrency in [int(c) for c in args.concurrency.split(",")]:
+            level = {}
+            for name, prefix in [("sync", "/sync"), ("async", "")]:
+                level[name] = asyncio.run(run_level(api_url, prefix, users, concurrency, args.duration, concurrency))
+                print(f"c={concurrency:<4} {name:<5} {level[name]['throughput_rps']:8.1f} req/s  "
+                      f"full p95 {level[name]['latency_ms']['full']['p95']:7.1f} ms  "
+                      f"errors {level[name]['errors']}", file=sys.stderr)
+            report["levels"][str(concurrency)] = level
+    finally:
+        stop_server(proc)
+        tmpdir.cleanup()
+
+    output = json.dumps(report, indent=2)
+    if args.json:
+        with open(args.json, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
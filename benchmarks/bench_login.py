@@ -0,0 +1,91 @@
+"""
+Login burst benchmark.
+
+Registers a user, then fires concurrent POST /login requests and reports
+throughput, latency percentiles and how many requests were shed with 503.
+A history listing probe runs alongside to show whether logins starve other
+endpoints.
+
+    python -m benchmarks.bench_login --requests 200 --concurrency 32
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+import httpx
+
+from benchmarks.harness import LocalStack, summarize
+
+
+async def probe_history(client, api_url, username, token, stop, latencies):
+    headers = {"Authorization": f"Bearer {token}"}
+    while not stop.is_set():
+        start = time.perf_counter()
+        await client.get(f"{api_url}/history/{username}/chats", headers=headers)
+        latencies.append(time.perf_counter() - start)
+        await asyncio.sleep(0.05)
+
+
+async def run(api_url, total, concurrency):
+    username = f"bench_{uuid.uuid4().hex[:8]}"
+    creds = {"username": username, "password": "bench-password"}
+    limits = httpx.Limits(max_connections=concurrency + 1)
+    async with httpx.AsyncClient(limits=limits, timeout=120) as client:
+        resp = await client.post(f"{api_url}/register", json=creds)
+        resp.raise_for_status()
+        resp = await client.post(f"{api_url}/login", json=creds)
+        resp.raise_for_status()
+        token = resp.json()["token"]
+
+        latencies, statuses, history = [], {}, []
+        queue = asyncio.Queue()
+        for _ in range(total):
+            queue.put_nowait(None)
+
+        async def worker():
+            while not queue.empty():
+                queue.get_nowait()
+                start = time.perf_counter()
+                r = await client.post(f"{api_url}/login", json=creds)
+                statuses[r.status_code] = statuses.get(r.status_code, 0) + 1
+                if r.status_code == 200:
+                    latencies.append(time.perf_counter() - start)
+
+        stop = asyncio.Event()
+        probe = asyncio.create_task(probe_history(client, api_url, username, token, stop, history))
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+        stop.set()
+        await probe
+
+    return {
+        "requests": total,
+        "concurrency": concurrency,
+        "elapsed_s": elapsed,
+        "logins_per_s": len(latencies) / elapsed,
+        "statuses": statuses,
+        "login_latency": summarize(latencies),
+        "history_latency_during_burst": summarize(history),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent /login benchmark")
+    parser.add_argument("--api-url", help="Target an already running backend instead of a local stack")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=32)
+    args = parser.parse_args()
+
+    if args.api_url:
+        report = asyncio.run(run(args.api_url, args.requests, args.concurrency))
+    else:
+        with LocalStack() as stack:
+            report = asyncio.run(run(stack.api_url, args.requests, args.concurrency))
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
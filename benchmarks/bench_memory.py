@@ -0,0 +1,112 @@
+"""
+Cross-chat memory retrieval latency for a user with a long history.
+
+Seeds one user with --chats chats of --messages messages each (synthetic
+assistant-style text) in a throwaway SQLite file, then measures memory.py:
+
+    build     first recall: index built from the database
+    search    BM25 scoring alone (UserIndex.search) for --queries queries
+    recall    full per-request path: version check, scoring, snippet fetch
+    update    recall right after a save that added two messages to a chat
+
+    python -m benchmarks.bench_memory --chats 3000 --messages 20 --queries 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from benchmarks.harness import ROOT, summarize
+from benchmarks.bench_compression import build_corpus, message
+
+
+async def measure(args):
+    from database import AsyncSessionLocal, SessionLocal
+    import crud
+    import crud_async
+    import memory
+    import migrate
+
+    migrate.upgrade_schema()
+    db = SessionLocal()
+    build_corpus(db, 1, args.chats, args.messages)
+    user = crud.get_user(db, "user0")
+    user_id = user.id
+    db.close()
+
+    store = memory.MemoryStore(lambda _: AsyncSessionLocal)
+    rng = random.Random(3)
+    queries = [[{"role": "user", "content": message(rng, "user")}] for _ in range(args.queries)]
+    budget = memory.budget_for(4096)
+
+    t = time.perf_counter()
+    await store.recall(user_id, queries[0], None, budget)
+    build_s = time.perf_counter() - t
+    index = store._indexes[user_id]
+
+    searches = []
+    for query in queries:
+        query_terms = memory.terms(query[0]["content"])
+        t = time.perf_counter()
+        index.search(query_terms, memory.MEMORY_TOP_K * 2)
+        searches.append(time.perf_counter() - t)
+
+    recalls, snippets = [], []
+    for query in queries:
+        t = time.perf_counter()
+        recalled = await store.recall(user_id, query, "0-0", budget)
+        recalls.append(time.perf_counter() - t)
+        snippets.append(recalled[2] if recalled else 0)
+
+    updates = []
+    for i, query in enumerate(queries[:50]):
+        chat_uuid = f"0-{rng.randrange(args.chats)}"
+        async with AsyncSessionLocal() as adb:
+            await crud_async.append_chat(adb, user_id, chat_uuid, None, [
+                {"role": "user", "content": message(rng, "user")},
+                {"role": "assistant", "content": message(rng, "assistant")},
+            ], None)
+            await adb.commit()
+        t = time.perf_counter()
+        await store.recall(user_id, query, chat_uuid, budget)
+        updates.append(time.perf_counter() - t)
+
+    return {
+        "documents": index.live,
+        "terms": len(index.postings),
+        "build_s": build_s,
+        "search_ms": summarize(searches, 1000),
+        "recall_ms": summarize(recalls, 1000),
+        "recall_after_save_ms": summarize(updates, 1000),
+        "mean_snippets": sum(snippets) / len(snippets),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cross-chat memory retrieval benchmark")
+    parser.add_argument("--chats", type=int, default=3000)
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--json", help="write the report to this file")
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, ROOT)
+    report = asyncio.run(measure(args))
+    print(f"{report['documents']} messages, {report['terms']} terms, index built in {report['build_s']:.2f}s")
+    for name in ("search_ms", "recall_ms", "recall_after_save_ms"):
+        r = report[name]
+        print(f"{name:<21} p50 {r['p50']:6.2f} ms  p95 {r['p95']:6.2f} ms  p99 {r['p99']:6.2f} ms")
+    print(f"snippets per prompt: {report['mean_snippets']:.1f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
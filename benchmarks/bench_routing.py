@@ -0,0 +1,107 @@
+"""
+Model routing: hedging and failover against local stub providers.
+
+Each scenario starts a primary stub (the "groq" provider) and a "backup"
+stub with their own latency/error settings, routes --mode to
+groq -> backup through CHAT_ROUTES, and sends --requests /chat requests
+(--concurrency at a time) with the NDJSON protocol. The report has TTFT
+percentiles and how many replies were served by each model, hedged, or
+failed over.
+
+    python -m benchmarks.bench_routing --requests 100 --concurrency 10
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+import httpx
+
+from benchmarks.harness import LocalStack, summarize
+
+FAST = {"FAKE_GROQ_TOKENS": "16", "FAKE_GROQ_FIRST_TOKEN_DELAY": "0.1", "FAKE_GROQ_TOKEN_INTERVAL": "0.005"}
+# Usually quick, occasionally very slow to start
+JITTERY = dict(FAST, FAKE_GROQ_FIRST_TOKEN_DELAY="0.6", FAKE_GROQ_JITTER="0.95")
+FAILING = dict(FAST, FAKE_GROQ_ERROR_RATE="1")
+
+SCENARIOS = {
+    # name: (primary stub, backup stub, route override)
+    "healthy_primary": (FAST, FAST, {"ttft_slo": 0.5}),
+    "jittery_primary_no_fallback": (JITTERY, FAST, {"fallback": None}),
+    "jittery_primary_hedged": (JITTERY, FAST, {"ttft_slo": 0.3}),
+    "failing_primary": (FAILING, FAST, {"ttft_slo": 0.5}),
+    "failing_primary_slow_fallback": (FAILING, JITTERY, {"ttft_slo": 0.5}),
+}
+
+
+async def one_request(client, api_url, mode):
+    payload = {"messages": [{"role": "user", "content": f"Hello {uuid.uuid4().hex}"}], "mode": mode}
+    start = time.perf_counter()
+    ttft, usage, error = None, None, None
+    async with client.stream("POST", f"{api_url}/chat", json=payload, headers={"Accept": "application/x-ndjson"}) as resp:
+        async for line in resp.aiter_lines():
+            if not line:
+                continue
+            event = json.loads(line)
+            if event["event"] == "delta" and ttft is None:
+                ttft = time.perf_counter() - start
+            elif event["event"] == "usage":
+                usage = event
+            elif event["event"] == "error":
+                error = event["type"]
+    return ttft, usage, error
+
+
+async def run_scenario(api_url, mode, requests, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    async with httpx.AsyncClient(timeout=60) as client:
+        async def limited():
+            async with semaphore:
+                return await one_request(client, api_url, mode)
+        results = await asyncio.gather(*(limited() for _ in range(requests)))
+
+    served, errors = {}, {}
+    for _, usage, error in results:
+        if error is not None:
+            errors[error] = errors.get(error, 0) + 1
+        elif usage is not None:
+            key = f"{usage['provider']}/{usage['model']}"
+            served[key] = served.get(key, 0) + 1
+    return {
+        "ttft_ms": summarize([r[0] for r in results if r[0] is not None], 1000),
+        "served_by": served,
+        "hedged": sum(1 for _, u, _ in results if u and u.get("hedged")),
+        "failed_over": sum(1 for _, u, _ in results if u and u.get("failed_over")),
+        "errors": errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Routing, hedging and failover benchmark")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--mode", default="Fast AI")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--json", help="write the report to this file")
+    args = parser.parse_args()
+
+    report = {}
+    for name in args.scenarios.split(","):
+        primary_env, backup_env, override = SCENARIOS[name]
+        route = {"primary": {"provider": "groq", "model": "primary-model"},
+                 "fallback": {"provider": "backup", "model": "backup-model"}, **override}
+        backend_env = {"CHAT_CACHE": "0", "CHAT_ROUTES": json.dumps({args.mode: route})}
+        with LocalStack(fake_env=primary_env, backend_env=backend_env, providers={"backup": backup_env}) as stack:
+            report[name] = asyncio.run(run_scenario(stack.api_url, args.mode, args.requests, args.concurrency))
+        ttft = report[name]["ttft_ms"]
+        print(f"{name:<32} ttft p50 {ttft['p50'] or 0:7.1f} ms  p99 {ttft['p99'] or 0:7.1f} ms  "
+              f"served {report[name]['served_by']}  errors {report[name]['errors']}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Search latency on a synthetic corpus.
+
+Builds a throwaway database with one heavy user owning --messages messages
+(plus other users' noise), indexes it, and times /search queries of
+different selectivity through search.search_messages.
+
+    python -m benchmarks.bench_search --messages 100000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from benchmarks.harness import ROOT, summarize
+
+QUERIES = {
+    "common_term": "the",
+    "mid_term": "word42",
+    "rare_term": "word4711",
+    "two_terms": "word7 word13",
+    "prefix": "word99*",
+}
+
+
+def build_corpus(db, n_messages, seed=1):
+    from sqlalchemy import insert
+    from models import User, Chat, Message, utcnow
+
+    rng = random.Random(seed)
+    vocab = ["the", "and", "to", "of", "a"] + [f"word{i}" for i in range(5000)]
+    weights = [1.0 / (rank + 1) for rank in range(len(vocab))]
+
+    users = [User(username=f"user{i}", password_hash="x") for i in range(5)]
+    db.add_all(users)
+    db.flush()
+    heavy = users[0]
+
+    per_chat = 50
+    for owner, count in [(heavy, n_messages)] + [(u, n_messages // 20) for u in users[1:]]:
+        for start in range(0, count, per_chat):
+            chat = Chat(chat_uuid=f"{owner.id}-{start}", user_id=owner.id, title=f"Chat {start}", updated_at=utcnow())
+            db.add(chat)
+            db.flush()
+            db.execute(insert(Message), [
+                {"chat_id": chat.id, "position": i, "role": "user" if i % 2 == 0 else "assistant",
+                 "content": " ".join(rng.choices(vocab, weights, k=rng.randint(8, 60)))}
+                for i in range(min(per_chat, count - start))
+            ])
+    db.commit()
+    return heavy.id
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Full-text search benchmark")
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.TemporaryDirectory()
+    os.chdir(tmpdir.name)
+    sys.path.insert(0, ROOT)
+    from database import SessionLocal, engine
+    import migrate
+    import search
+
+    migrate.upgrade_schema()
+    db = SessionLocal()
+    start = time.perf_counter()
+    user_id = build_corpus(db, args.messages)
+    search.create_index(engine)
+    build_s = time.perf_counter() - start
+
+    report = {"messages": args.messages, "build_and_index_s": build_s, "queries": {}}
+    for name, q in QUERIES.items():
+        latencies = []
+        for page in range(args.repeat):
+            offset = (page % 5) * args.limit
+            t = time.perf_counter()
+            hits = search.search_messages(db, user_id, q, args.limit, offset)
+            latencies.append((time.perf_counter() - t) * 1000)
+        report["queries"][name] = {"q": q, "hits_on_page": len(hits), "latency_ms": summarize(latencies)}
+    db.close()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
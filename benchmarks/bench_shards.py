@@ -0,0 +1,109 @@
+"""
+Concurrent writers: one SQLite file vs. users sharded over DB_SHARDS files.
+
+Starts the full stack (fake Groq + main:app with --workers processes) once
+per variant, registers --users users and has each of them save its own chat
+over and over (POST /history/save, two more messages each time) from
+--concurrency clients for --duration seconds. With a single file every
+save queues on the one write lock; sharded, saves of users on different
+shards commit in parallel. Write-behind is off so every save is a commit.
+
+    single     DB_SHARDS unset
+    shards-N   DB_SHARDS=N for each N in --shards
+
+    python -m benchmarks.bench_shards --shards 4,8 --workers 4 --concurrency 64
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+import httpx
+
+from benchmarks.harness import LocalStack, summarize
+
+
+async def register(client, api_url, users):
+    tokens = {}
+    for u in range(users):
+        name = f"shard-bench{u}"
+        creds = {"username": name, "password": "bench-password"}
+        (await client.post(f"{api_url}/register", json=creds)).raise_for_status()
+        resp = await client.post(f"{api_url}/login", json=creds)
+        resp.raise_for_status()
+        tokens[name] = resp.json()["token"]
+    return tokens
+
+
+async def run_writers(api_url, users, concurrency, duration):
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+        tokens = await register(client, api_url, users)
+        names = list(tokens)
+        latencies, errors = [], 0
+        deadline = time.perf_counter() + duration
+
+        async def writer(i):
+            nonlocal errors
+            # Clients spread over the users; each keeps growing its own chat
+            user = names[i % len(names)]
+            headers = {"Authorization": f"Bearer {tokens[user]}"}
+            chat_id, messages = uuid.uuid4().hex, []
+            while time.perf_counter() < deadline:
+                messages += [{"role": "user", "content": "q " * 20}, {"role": "assistant", "content": "a " * 80}]
+                start = time.perf_counter()
+                try:
+                    resp = await client.post(f"{api_url}/history/save", headers=headers, json={
+                        "username": user, "chat_id": chat_id, "title": "Bench", "messages": messages,
+                    })
+                    if resp.status_code >= 400:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(writer(i) for i in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    return {
+        "saves": len(latencies),
+        "errors": errors,
+        "saves_per_s": len(latencies) / elapsed,
+        "latency_ms": summarize(latencies, 1000),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Single-file vs sharded SQLite under concurrent saves")
+    parser.add_argument("--shards", default="4,8", help="comma-separated DB_SHARDS values to compare")
+    parser.add_argument("--workers", type=int, default=4, help="uvicorn worker processes")
+    parser.add_argument("--users", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--json", help="write the report to this file")
+    args = parser.parse_args()
+
+    variants = {"single": {}}
+    for n in args.shards.split(","):
+        variants[f"shards-{n}"] = {"DB_SHARDS": n}
+
+    report = {"config": vars(args), "variants": {}}
+    for name, extra in variants.items():
+        # Cheap password hashes: registering the users is not what is measured
+        env = dict(extra, WRITE_BEHIND="0", BCRYPT_ROUNDS="4")
+        with LocalStack(backend_env=env, workers=args.workers) as stack:
+            result = asyncio.run(run_writers(stack.api_url, args.users, args.concurrency, args.duration))
+        report["variants"][name] = result
+        lat = result["latency_ms"]
+        print(f"{name:<10} {result['saves_per_s']:8.1f} saves/s  p50 {lat['p50']:7.1f} ms  "
+              f"p95 {lat['p95']:7.1f} ms  p99 {lat['p99']:7.1f} ms  errors {result['errors']}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
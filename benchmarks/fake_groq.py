@@ -0,0 +1,111 @@
+"""
+Local stand-in for the Groq chat completions API.
+
+Streams OpenAI-style SSE chunks so main.py can be load tested without an API
+key or network access. Point the backend at it with GROQ_BASE_URL.
+
+    python -m benchmarks.fake_groq --port 9000 --tokens 64 --first-token-delay 0.2
+
+Every knob can also be set per process with FAKE_GROQ_* environment
+variables, which is how the benchmark harness configures it.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+TOKENS = int(os.getenv("FAKE_GROQ_TOKENS", "64"))
+FIRST_TOKEN_DELAY = float(os.getenv("FAKE_GROQ_FIRST_TOKEN_DELAY", "0.2"))
+TOKEN_INTERVAL = float(os.getenv("FAKE_GROQ_TOKEN_INTERVAL", "0.01"))
+# Each delay is drawn uniformly from [delay * (1 - JITTER), delay * (1 + JITTER)]
+JITTER = float(os.getenv("FAKE_GROQ_JITTER", "0"))
+# Share of requests answered with a 500 before any token is sent
+ERROR_RATE = float(os.getenv("FAKE_GROQ_ERROR_RATE", "0"))
+
+app = FastAPI()
+
+
+def _chunk(completion_id, model, content=None, finish_reason=None, usage=None):
+    delta = {"content": content} if content is not None else {}
+    chunk = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    if usage is not None:
+        # Groq reports usage on the last chunk under x_groq
+        chunk["x_groq"] = {"id": completion_id, "usage": usage}
+    return chunk
+
+
+def _delay(seconds):
+    if JITTER:
+        seconds *= random.uniform(1 - JITTER, 1 + JITTER)
+    return asyncio.sleep(max(seconds, 0))
+
+
+@app.get("/")
+def health():
+    return {"status": "running"}
+
+
+@app.post("/openai/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    model = body.get("model", "fake-model")
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    if ERROR_RATE and random.random() < ERROR_RATE:
+        return JSONResponse({"error": {"message": "fake upstream failure", "type": "server_error"}}, status_code=500)
+
+    prompt_tokens = sum(len(str(m.get("content", "")).split()) for m in body.get("messages", []))
+
+    if not body.get("stream"):
+        await _delay(FIRST_TOKEN_DELAY + TOKEN_INTERVAL * (TOKENS - 1))
+        return JSONResponse({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(f"tok{i} " for i in range(TOKENS))}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": TOKENS, "total_tokens": prompt_tokens + TOKENS},
+        })
+
+    async def events():
+        await _delay(FIRST_TOKEN_DELAY)
+        for i in range(TOKENS):
+            if i:
+                await _delay(TOKEN_INTERVAL)
+            yield f"data: {json.dumps(_chunk(completion_id, model, f'tok{i} '))}\n\n"
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": TOKENS, "total_tokens": prompt_tokens + TOKENS}
+        yield f"data: {json.dumps(_chunk(completion_id, model, finish_reason='stop', usage=usage))}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--tokens", type=int, default=TOKENS)
+    parser.add_argument("--first-token-delay", type=float, default=FIRST_TOKEN_DELAY)
+    parser.add_argument("--token-interval", type=float, default=TOKEN_INTERVAL)
+    parser.add_argument("--jitter", type=float, default=JITTER)
+    parser.add_argument("--error-rate", type=float, default=ERROR_RATE)
+    args = parser.parse_args()
+
+    TOKENS = args.tokens
+    FIRST_TOKEN_DELAY = args.first_token_delay
+    TOKEN_INTERVAL = args.token_interval
+    JITTER = args.jitter
+    ERROR_RATE = args.error_rate
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
@@ -0,0 +1,138 @@
+"""
+Helpers shared by the benchmark scripts: free ports, server subprocesses and
+latency summaries.
+"""
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _env(extra):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = ROOT + os.pathsep + env.get("PYTHONPATH", "")
+    env.update(extra or {})
+    return env
+
+
+def migrate(cwd=None, env=None):
+    """
+    Runs migrate.py, as a deploy would before starting the server.
+    """
+    subprocess.run([sys.executable, os.path.join(ROOT, "migrate.py")], cwd=cwd or ROOT,
+                   env=_env(env), check=True, stdout=subprocess.DEVNULL)
+
+
+def start_server(app_spec, port, env=None, cwd=None, workers=1):
+    """
+    Starts `uvicorn app_spec` in a subprocess and waits until it accepts HTTP.
+    """
+    proc_env = _env(env)
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", app_spec, "--host", "127.0.0.1",
+         "--port", str(port), "--log-level", "warning", "--workers", str(workers)],
+        cwd=cwd or ROOT,
+        env=proc_env,
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"{app_spec} exited with code {proc.returncode}")
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/", timeout=0.5)
+            return proc
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError(f"{app_spec} did not start on port {port}")
+
+
+def stop_server(proc):
+    proc.terminate()
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+class LocalStack:
+    """
+    Runs the fake Groq server and main:app side by side, with the backend's
+    SQLite database in a throwaway directory. `providers` maps extra
+    provider names to fake server settings; each gets its own stub and is
+    registered with the backend through LLM_PROVIDERS.
+    """
+
+    def __init__(self, fake_env=None, backend_env=None, workers=1, providers=None):
+        self.fake_env = fake_env or {}
+        self.backend_env = backend_env or {}
+        self.workers = workers
+        self.providers = providers or {}
+        self.procs = []
+
+    def __enter__(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        # Admission limits off unless a benchmark sets them, so load is not throttled;
+        # the reply cache too, so repeated prompts still measure the upstream path
+        env = {"GROQ_API_KEY": "fake-key", "CHAT_RATE_LIMIT": "0", "CHAT_MAX_CONCURRENCY": "0", "CHAT_CACHE": "0"}
+        # One secret for all workers, so a token from one verifies on the others
+        env["SESSION_SECRET"] = os.urandom(16).hex()
+        fake_port = free_port()
+        self.procs.append(start_server("benchmarks.fake_groq:app", fake_port, env=self.fake_env))
+        providers = {}
+        for name, provider_env in self.providers.items():
+            port = free_port()
+            self.procs.append(start_server("benchmarks.fake_groq:app", port, env=provider_env))
+            providers[name] = {"base_url": f"http://127.0.0.1:{port}", "api_key_env": "GROQ_API_KEY"}
+        if providers:
+            env["LLM_PROVIDERS"] = json.dumps(providers)
+        env.update(self.backend_env)
+        migrate(cwd=self.tmpdir.name, env=env)
+        api_port = free_port()
+        env["GROQ_BASE_URL"] = f"http://127.0.0.1:{fake_port}"
+        self.procs.append(start_server("main:app", api_port, env=env, cwd=self.tmpdir.name, workers=self.workers))
+        self.api_url = f"http://127.0.0.1:{api_port}"
+        return self
+
+    def __exit__(self, *exc):
+        for proc in reversed(self.procs):
+            stop_server(proc)
+        self.tmpdir.cleanup()
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * pct / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def summarize(values, scale=1.0):
+    """
+    Count and p50/p95/p99/max of `values`, each multiplied by `scale`
+    (e.g. 1000 to report seconds as milliseconds).
+    """
+    values = [v * scale for v in values]
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
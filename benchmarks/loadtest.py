@@ -0,0 +1,252 @@
+"""
+Mixed-workload load test for main:app.
+
+By default starts the fake Groq server and the backend locally (in a
+throwaway directory), registers a pool of users, then runs --concurrency
+virtual users for --duration seconds. Each iteration picks an operation
+from the weighted --mix:
+
+    login         POST /login
+    history_list  GET  /history/{user}/chats
+    history_save  POST /history/save (the conversation grows by two messages)
+    chat          POST /chat, streamed; records TTFT and inter-token gaps
+
+The report (stdout, or --json FILE) has throughput, error counts and
+p50/p95/p99 latency per endpoint, plus streaming timings for /chat.
+
+    python -m benchmarks.loadtest --concurrency 32 --duration 30 \\
+        --mix login=1,history_list=4,history_save=3,chat=2 --json results.json
+"""
+import argparse
+import asyncio
+import json
+import platform
+import random
+import time
+import uuid
+
+import httpx
+
+from benchmarks.harness import LocalStack, summarize
+
+DEFAULT_MIX = "login=1,history_list=4,history_save=3,chat=2"
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.statuses = {}
+        self.ttft = []
+        self.inter_token = []
+        self.stream = []
+
+    def record(self, name, elapsed, status):
+        self.latencies.setdefault(name, []).append(elapsed)
+        codes = self.statuses.setdefault(name, {})
+        codes[str(status)] = codes.get(str(status), 0) + 1
+        if not isinstance(status, int) or status >= 400:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    def report(self, elapsed):
+        return {
+            "endpoints": {
+                name: {
+                    "requests": len(values),
+                    "errors": self.errors.get(name, 0),
+                    "statuses": self.statuses[name],
+                    "throughput_rps": len(values) / elapsed,
+                    "latency_ms": summarize(values, 1000),
+                }
+                for name, values in sorted(self.latencies.items())
+            },
+            "chat_stream": {
+                "ttft_ms": summarize(self.ttft, 1000),
+                "inter_token_ms": summarize(self.inter_token, 1000),
+                "duration_ms": summarize(self.stream, 1000),
+            },
+        }
+
+
+class VirtualUser:
+    def __init__(self, client, api_url, username, password, recorder):
+        self.client = client
+        self.api_url = api_url
+        self.username = username
+        self.password = password
+        self.recorder = recorder
+        self.chat_id = str(uuid.uuid4())
+        self.messages = []
+        self.headers = {}  # Authorization from the last login
+
+    async def timed(self, name, coro):
+        start = time.perf_counter()
+        try:
+            resp = await coro
+            status = resp.status_code
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+        self.recorder.record(name, time.perf_counter() - start, status)
+
+    async def login(self):
+        start = time.perf_counter()
+        try:
+            resp = await self.client.post(f"{self.api_url}/login", json={"username": self.username, "password": self.password})
+            status = resp.status_code
+            if status == 200:
+                self.headers = {"Authorization": f"Bearer {resp.json()['token']}"}
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+        self.recorder.record("login", time.perf_counter() - start, status)
+
+    async def history_list(self):
+        await self.timed("history_list", self.client.get(f"{self.api_url}/history/{self.username}/chats", headers=self.headers))
+
+    async def history_save(self):
+        turn = len(self.messages) // 2
+        self.messages += [
+            {"role": "user", "content": f"Question {turn} {uuid.uuid4().hex}"},
+            {"role": "assistant", "content": f"Answer {turn} " + "lorem ipsum " * 20},
+        ]
+        await self.timed("history_save", self.client.post(f"{self.api_url}/history/save", headers=self.headers, json={
+            "username": self.username, "chat_id": self.chat_id, "title": "Load test", "messages": self.messages,
+        }))
+
+    async def chat(self, mode):
+        # Unique prompt, so the response cache does not short-circuit upstream
+        payload = {"messages": [{"role": "user", "content": f"Hello {uuid.uuid4().hex}"}], "mode": mode}
+        start = time.perf_counter()
+        status = None
+        try:
+            async with self.client.stream("POST", f"{self.api_url}/chat", json=payload, headers=self.headers) as resp:
+                status = resp.status_code
+                last = None
+                async for chunk in resp.aiter_text():
+                    if not chunk:
+                        continue
+                    now = time.perf_counter()
+                    if last is None:
+                        self.recorder.ttft.append(now - start)
+                    else:
+                        self.recorder.inter_token.append(now - last)
+                    last = now
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+        elapsed = time.perf_counter() - start
+        if status == 200:
+            self.recorder.stream.append(elapsed)
+        self.recorder.record("chat", elapsed, status)
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight or 1)
+    unknown = set(mix) - {"login", "history_list", "history_save", "chat"}
+    if unknown:
+        raise SystemExit(f"Unknown operations in --mix: {', '.join(sorted(unknown))}")
+    return mix
+
+
+async def run(api_url, args):
+    mix = parse_mix(args.mix)
+    ops, weights = list(mix), list(mix.values())
+    recorder = Recorder()
+    limits = httpx.Limits(max_connections=args.concurrency * 2, max_keepalive_connections=args.concurrency)
+
+    async with httpx.AsyncClient(limits=limits, timeout=args.timeout) as client:
+        users = []
+        for i in range(args.users):
+            username = f"load_{uuid.uuid4().hex[:10]}"
+            password = "load-test-password"
+            resp = await client.post(f"{api_url}/register", json={"username": username, "password": password})
+            resp.raise_for_status()
+            users.append((username, password))
+
+        deadline = time.perf_counter() + args.duration
+        rng = random.Random(args.seed)
+
+        async def worker(i):
+            username, password = users[i % len(users)]
+            vu = VirtualUser(client, api_url, username, password, recorder)
+            # History calls need the session token
+            await vu.login()
+            while time.perf_counter() < deadline:
+                op = rng.choices(ops, weights)[0]
+                if op == "chat":
+                    await vu.chat(args.mode)
+                else:
+                    await getattr(vu, op)()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(i) for i in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+
+    report = recorder.report(elapsed)
+    report["config"] = {
+        "api_url": api_url if args.api_url else "local",
+        "concurrency": args.concurrency,
+        "duration_s": args.duration,
+        "elapsed_s": elapsed,
+        "users": args.users,
+        "mix": mix,
+        "mode": args.mode,
+        "fake_groq": None if args.api_url else {
+            "tokens": args.tokens,
+            "first_token_delay": args.first_token_delay,
+            "token_interval": args.token_interval,
+            "jitter": args.jitter,
+        },
+        "workers": args.workers,
+        "python": platform.python_version(),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mixed-workload load test for the chatbot backend")
+    parser.add_argument("--api-url", help="Target an already running backend instead of a local stack")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--users", type=int, default=8)
+    parser.add_argument("--mix", default=DEFAULT_MIX)
+    parser.add_argument("--mode", default="Fast AI")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers for the local backend")
+    parser.add_argument("--tokens", type=int, default=64, help="fake Groq: tokens per reply")
+    parser.add_argument("--first-token-delay", type=float, default=0.2, help="fake Groq: seconds before the first token")
+    parser.add_argument("--token-interval", type=float, default=0.01, help="fake Groq: seconds between tokens")
+    parser.add_argument("--jitter", type=float, default=0.0, help="fake Groq: relative jitter on every delay")
+    parser.add_argument("--bcrypt-rounds", type=int, help="BCRYPT_ROUNDS for the local backend")
+    parser.add_argument("--backend-env", action="append", default=[], metavar="KEY=VALUE",
+                        help="Extra environment for the local backend (repeatable)")
+    parser.add_argument("--json", help="Write the report to this file")
+    args = parser.parse_args()
+
+    if args.api_url:
+        report = asyncio.run(run(args.api_url, args))
+    else:
+        fake_env = {
+            "FAKE_GROQ_TOKENS": str(args.tokens),
+            "FAKE_GROQ_FIRST_TOKEN_DELAY": str(args.first_token_delay),
+            "FAKE_GROQ_TOKEN_INTERVAL": str(args.token_interval),
+            "FAKE_GROQ_JITTER": str(args.jitter),
+        }
+        backend_env = dict(item.split("=", 1) for item in args.backend_env)
+        if args.bcrypt_rounds:
+            backend_env["BCRYPT_ROUNDS"] = str(args.bcrypt_rounds)
+        with LocalStack(fake_env=fake_env, backend_env=backend_env, workers=args.workers) as stack:
+            report = asyncio.run(run(stack.api_url, args))
+
+    output = json.dumps(report, indent=2)
+    if args.json:
+        with open(args.json, "w") as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
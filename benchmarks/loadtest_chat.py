@@ -0,0 +1,81 @@
+"""
+Concurrent streaming load test for POST /chat.
+
+Opens N simultaneous /chat streams for each concurrency level and records the
+time to first token of every stream. With a non-blocking upstream path the
+TTFT distribution should stay close to the upstream's own first-token delay
+no matter how many streams share the worker.
+
+    python -m benchmarks.loadtest_chat --levels 1,10,50,100,200
+    python -m benchmarks.loadtest_chat --api-url http://localhost:8000
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+import httpx
+
+from benchmarks.harness import LocalStack, summarize
+
+
+async def one_stream(client, api_url, mode):
+    # A unique prompt, so a backend with the reply cache on still streams from upstream
+    payload = {"messages": [{"role": "user", "content": f"Hello {uuid.uuid4().hex}"}], "mode": mode}
+    start = time.perf_counter()
+    ttft = None
+    async with client.stream("POST", f"{api_url}/chat", json=payload) as resp:
+        async for chunk in resp.aiter_text():
+            if chunk and ttft is None:
+                ttft = time.perf_counter() - start
+    return ttft, time.perf_counter() - start
+
+
+async def run_level(api_url, concurrency, mode):
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=120) as client:
+        results = await asyncio.gather(*(one_stream(client, api_url, mode) for _ in range(concurrency)))
+    ttfts = [r[0] for r in results if r[0] is not None]
+    totals = [r[1] for r in results]
+    return {"concurrency": concurrency, "ttft": summarize(ttfts), "total": summarize(totals)}
+
+
+async def run(api_url, levels, mode):
+    # Warm the backend's upstream keep-alive pool before measuring
+    await run_level(api_url, 1, mode)
+    report = []
+    for level in levels:
+        result = await run_level(api_url, level, mode)
+        report.append(result)
+        ttft = result["ttft"]
+        print(f"streams={level:4d}  ttft p50={ttft['p50']*1000:7.1f}ms  "
+              f"p95={ttft['p95']*1000:7.1f}ms  max={ttft['max']*1000:7.1f}ms")
+    base = report[0]["ttft"]["p50"]
+    worst = report[-1]["ttft"]["p50"]
+    print(f"TTFT p50 growth from {levels[0]} to {levels[-1]} streams: {worst / base:.2f}x")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent /chat streaming load test")
+    parser.add_argument("--api-url", help="Target an already running backend instead of a local stack")
+    parser.add_argument("--levels", default="1,10,50,100,200")
+    parser.add_argument("--mode", default="Fast AI")
+    parser.add_argument("--json", help="Write the report to this file")
+    args = parser.parse_args()
+    levels = [int(x) for x in args.levels.split(",")]
+
+    if args.api_url:
+        report = asyncio.run(run(args.api_url, levels, args.mode))
+    else:
+        with LocalStack() as stack:
+            report = asyncio.run(run(stack.api_url, levels, args.mode))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""
+Compressed storage for message content.
+
+On SQLite, Message.content is stored as a zstd frame (a BLOB) once it is
+longer than MESSAGE_COMPRESSION_MIN_BYTES; shorter messages stay plain TEXT,
+as do rows written before compression was turned on. Frames are compressed
+with a dictionary trained on this database's own messages (chat text is
+short and repetitive, which plain zstd does poorly on), and the dictionary
+id in each frame's header says which one to decompress with, so a new
+dictionary never invalidates old rows.
+
+Content is only decompressed when a query selects it, i.e. when a chat is
+opened; chat lists and titles never touch it. The search index is
+contentless and stores no text: it is fed the decompressed text when rows
+are indexed or deleted, and result snippets are cut from the Message rows.
+
+Postgres is left alone: it already compresses large values (TOAST) and its
+search index is an expression over the plain text.
+"""
+import os
+import random
+import threading
+import zstandard
+from sqlalchemy import Text, func, inspect, select
+from sqlalchemy.types import TypeDecorator
+
+MESSAGE_COMPRESSION = os.getenv("MESSAGE_COMPRESSION", "zstd")  # zstd | off
+MESSAGE_COMPRESSION_LEVEL = int(os.getenv("MESSAGE_COMPRESSION_LEVEL", "3"))
+# Below this a zstd frame barely pays for its own header
+MESSAGE_COMPRESSION_MIN_BYTES = int(os.getenv("MESSAGE_COMPRESSION_MIN_BYTES", "64"))
+DICTIONARY_SIZE = int(os.getenv("ZSTD_DICTIONARY_SIZE", str(64 * 1024)))
+# Messages sampled to train a dictionary; fewer than the minimum and
+# training is skipped (plain zstd is used until there is enough history)
+DICTIONARY_SAMPLES = 20000
+DICTIONARY_MIN_SAMPLES = 1000
+
+_dictionaries = {}  # dict id -> zstandard.ZstdCompressionDict
+_current = {"id": 0}  # dictionary used for new writes; 0 = none
+_engine = {"bind": None}
+_lock = threading.Lock()
+# Compressor objects are not thread-safe (write-behind flushes off the event loop)
+_local = threading.local()
+
+
+def enabled(dialect) -> bool:
+    return MESSAGE_COMPRESSION == "zstd" and dialect.name == "sqlite"
+
+
+def _cache():
+    if not hasattr(_local, "cache"):
+        _local.cache = {}
+    return _local.cache
+
+
+def _compressor():
+    key = ("c", _current["id"])
+    cache = _cache()
+    if key not in cache:
+        dictionary = _dictionaries.get(_current["id"])
+        cache[key] = zstandard.ZstdCompressor(level=MESSAGE_COMPRESSION_LEVEL, dict_data=dictionary)
+    return cache[key]
+
+
+def _decompressor(dict_id):
+    key = ("d", dict_id)
+    cache = _cache()
+    if key not in cache:
+        dictionary = None
+        if dict_id:
+            dictionary = _dictionaries.get(dict_id)
+            if dictionary is None and _engine["bind"] is not None:
+                # Trained after this worker started
+                load_dictionaries(_engine["bind"])
+                dictionary = _dictionaries.get(dict_id)
+            if dictionary is None:
+                raise LookupError(f"Message was compressed with unknown zstd dictionary {dict_id}")
+        cache[key] = zstandard.ZstdDecompressor(dict_data=dictionary)
+    return cache[key]
+
+
+def compress(text: str):
+    data = text.encode("utf-8")
+    if len(data) < MESSAGE_COMPRESSION_MIN_BYTES:
+        return text
+    frame = _compressor().compress(data)
+    # Incompressible content is cheaper to store (and read) as is
+    return frame if len(frame) < len(data) else text
+
+
+def decompress(value) -> str:
+    if isinstance(value, str):
+        return value
+    dict_id = zstandard.get_frame_parameters(value).dict_id
+    return _decompressor(dict_id).decompress(value).decode("utf-8")
+
+
+class CompressedText(TypeDecorator):
+    """
+    Text column stored through compress()/decompress() where enabled().
+    Reads accept both plain and compressed rows.
+    """
+    impl = Text
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None or not enabled(dialect):
+            return value
+        return compress(value)
+
+    def process_result_value(self, value, dialect):
+        if isinstance(value, (bytes, memoryview)):
+            return decompress(bytes(value))
+        return value
+
+
+# --- Dictionaries ---
+
+def load_dictionaries(engine):
+    """
+    Loads every stored dictionary and makes the newest one current. Called
+    at startup; later frames from an unknown dictionary reload on demand.
+    """
+    from models import CompressionDictionary
+
+    _engine["bind"] = engine
+    if not inspect(engine).has_table(CompressionDictionary.__tablename__):
+        return 0
+    with engine.connect() as conn:
+        rows = conn.execute(
+            select(CompressionDictionary.id, CompressionDictionary.data).order_by(CompressionDictionary.created_at)
+        ).all()
+    with _lock:
+        for dict_id, data in rows:
+            if dict_id not in _dictionaries:
+                dictionary = zstandard.ZstdCompressionDict(data)
+                dictionary.precompute_compress(level=MESSAGE_COMPRESSION_LEVEL)
+                _dictionaries[dict_id] = dictionary
+        if rows:
+            _current["id"] = rows[-1][0]
+    return len(rows)
+
+
+def train_dictionary(db, sample_db=None):
+    """
+    Trains a dictionary on a sample of stored messages (from `sample_db`,
+    e.g. a shard, if given) and saves it in `db` as the current one.
+    Returns its id, or None when there is too little history.
+    """
+    from models import CompressionDictionary, Message
+
+    sample_db = sample_db or db
+    total = sample_db.query(func.count(Message.id)).scalar()
+    if total < DICTIONARY_MIN_SAMPLES:
+        return None
+    # Random ids over the whole table, so old and recent chats are both represented
+    max_id = sample_db.query(func.max(Message.id)).scalar()
+    ids = sorted(random.sample(range(1, max_id + 1), min(DICTIONARY_SAMPLES, max_id)))
+    samples = []
+    for i in range(0, len(ids), 500):
+        batch = ids[i:i + 500]
+        samples.extend(
+            content.encode("utf-8")
+            for (content,) in sample_db.query(Message.content).filter(Message.id.in_(batch))
+            if content
+        )
+    if len(samples) < DICTIONARY_MIN_SAMPLES:
+        return None
+
+    trained = zstandard.train_dictionary(DICTIONARY_SIZE, samples, level=MESSAGE_COMPRESSION_LEVEL)
+    dict_id = trained.dict_id()
+    if db.get(CompressionDictionary, dict_id) is None:
+        db.add(CompressionDictionary(id=dict_id, data=trained.as_bytes()))
+        db.commit()
+    load_dictionaries(db.get_bind())
+    return dict_id
+
+
+def current_dictionary():
+    return _current["id"] or None
@@ -0,0 +1,173 @@
+"""
+Token-budgeted prompt building for /chat.
+
+Token counts are estimated locally (no tokenizer round trip) and cached per
+message, so each turn only counts the messages it has not seen before. When
+the history does not fit the mode's budget, the oldest turns are dropped and
+rolled into a short extractive summary that is cached and extended
+incrementally as more turns fall out of the window.
+"""
+import hashlib
+import math
+import re
+from collections import OrderedDict
+
+# Chat-format overhead per message (role markers, separators)
+MESSAGE_OVERHEAD = 4
+# Share of the budget the rolled-up summary of dropped turns may use
+SUMMARY_SHARE = 0.15
+# Tokens kept from each dropped message in the summary
+SUMMARY_TOKENS_PER_MESSAGE = 40
+SUMMARY_MAX_LINES = 64
+
+_WORD_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
+
+_token_cache = OrderedDict()
+_summary_cache = OrderedDict()
+TOKEN_CACHE_SIZE = 50000
+SUMMARY_CACHE_SIZE = 2000
+
+
+def count_tokens(text: str) -> int:
+    """
+    Approximates BPE token counts: punctuation is one token, words are one
+    token per ~4 characters.
+    """
+    return sum(math.ceil(len(w) / 4) for w in _WORD_RE.findall(text))
+
+
+def _content(message) -> str:
+    # Clients may send "content": null
+    return str(message.get("content") or "")
+
+
+def _with_text(message):
+    # What is sent upstream: the message, with null content as ""
+    return message if isinstance(message.get("content"), str) else dict(message, content=_content(message))
+
+
+def _message_key(message) -> bytes:
+    raw = f"{message.get('role', '')}\x00{_content(message)}".encode("utf-8")
+    return hashlib.blake2b(raw, digest_size=16).digest()
+
+
+def _cache_get(cache, key):
+    value = cache.get(key)
+    if value is not None:
+        cache.move_to_end(key)
+    return value
+
+
+def _cache_put(cache, key, value, size):
+    cache[key] = value
+    cache.move_to_end(key)
+    if len(cache) > size:
+        cache.popitem(last=False)
+
+
+def message_tokens(message, key=None) -> int:
+    key = key or _message_key(message)
+    tokens = _cache_get(_token_cache, key)
+    if tokens is None:
+        tokens = count_tokens(_content(message)) + MESSAGE_OVERHEAD
+        _cache_put(_token_cache, key, tokens, TOKEN_CACHE_SIZE)
+    return tokens
+
+
+def truncate(text: str, max_tokens: int) -> str:
+    words = text.split()
+    out, used = [], 0
+    for word in words:
+        used += count_tokens(word)
+        if used > max_tokens:
+            return " ".join(out) + "..."
+        out.append(word)
+    return " ".join(out)
+
+
+def _summary_line(message) -> str:
+    content = _content(message).strip()
+    first_sentence = _SENTENCE_RE.split(content, 1)[0]
+    speaker = "User" if message.get("role") == "user" else "Assistant"
+    return f"- {speaker}: {truncate(first_sentence, SUMMARY_TOKENS_PER_MESSAGE)}"
+
+
+def _summarize(dropped, keys, max_tokens: int) -> str:
+    """
+    Summary of the dropped prefix. Summaries are cached by a hash chained over
+    the prefix, so a longer prefix extends the longest summary already built.
+    """
+    chain = []
+    digest = b""
+    for key in keys:
+        digest = hashlib.blake2b(digest + key, digest_size=16).digest()
+        chain.append(digest)
+
+    lines, start = [], 0
+    for i in range(len(chain) - 1, -1, -1):
+        cached = _cache_get(_summary_cache, chain[i])
+        if cached is not None:
+            lines, start = list(cached), i + 1
+            break
+    if start < len(dropped):
+        lines.extend(_summary_line(m) for m in dropped[start:])
+        # Older lines never fit once this many newer ones exist
+        lines = lines[-SUMMARY_MAX_LINES:]
+        _cache_put(_summary_cache, chain[-1], tuple(lines), SUMMARY_CACHE_SIZE)
+
+    # Keep the most recent lines that fit
+    kept, used = [], 0
+    for line in reversed(lines):
+        used += count_tokens(line)
+        if used > max_tokens:
+            break
+        kept.append(line)
+    return "\n".join(reversed(kept))
+
+
+def build_prompt(system_prompt: str, messages, budget: int):
+    """
+    Returns (prompt_messages, stats). The latest message is always sent (cut
+    short if it alone exceeds the budget); older ones are kept newest-first
+    until the budget is used up.
+    """
+    keys = [_message_key(m) for m in messages]
+    sizes = [message_tokens(m, k) for m, k in zip(messages, keys)]
+    system_tokens = count_tokens(system_prompt) + MESSAGE_OVERHEAD
+    total = system_tokens + sum(sizes)
+
+    if total <= budget:
+        prompt = [{"role": "system", "content": system_prompt}] + [_with_text(m) for m in messages]
+        return prompt, {"prompt_tokens": total, "original_tokens": total, "dropped_messages": 0}
+
+    if not messages:
+        return [{"role": "system", "content": system_prompt}], {"prompt_tokens": total, "original_tokens": total, "dropped_messages": 0}
+    room = budget - system_tokens - MESSAGE_OVERHEAD
+    if sizes[-1] - MESSAGE_OVERHEAD > room:
+        # Nothing else fits next to it; send the start of the latest message alone
+        latest = dict(messages[-1], content=truncate(_content(messages[-1]), max(room - count_tokens("..."), 0)))
+        prompt_tokens = system_tokens + count_tokens(latest["content"]) + MESSAGE_OVERHEAD
+        prompt = [{"role": "system", "content": system_prompt}, latest]
+        return prompt, {"prompt_tokens": prompt_tokens, "original_tokens": total, "dropped_messages": len(messages) - 1}
+
+    summary_budget = int(budget * SUMMARY_SHARE)
+    available = budget - system_tokens - summary_budget
+    cut = len(messages) - 1
+    used = sizes[cut]
+    while cut > 0 and used + sizes[cut - 1] <= available:
+        cut -= 1
+        used += sizes[cut]
+
+    prompt = [{"role": "system", "content": system_prompt}]
+    prompt_tokens = system_tokens + used
+    summary_header = "Summary of the earlier conversation:\n"
+    # A long latest message can leave less than the summary's share
+    summary_budget = min(summary_budget, budget - prompt_tokens - count_tokens(summary_header) - MESSAGE_OVERHEAD)
+    summary = _summarize(messages[:cut], keys[:cut], summary_budget) if summary_budget > 0 else ""
+    if summary:
+        summary_message = {"role": "system", "content": summary_header + summary}
+        prompt.append(summary_message)
+        prompt_tokens += count_tokens(summary_message["content"]) + MESSAGE_OVERHEAD
+    prompt.extend(_with_text(m) for m in messages[cut:])
+    return prompt, {"prompt_tokens": prompt_tokens, "original_tokens": total, "dropped_messages": cut}
@@ -0,0 +1,350 @@
+from sqlalchemy import func, select, update, or_, and_
+from sqlalchemy.orm import Session, selectinload
+from models import User, Chat, Message, Branch, utcnow
+import search
+
+# Title of a chat nobody has named yet; the backend replaces it (see titles.py)
+DEFAULT_TITLE = "New Chat"
+
+
+def get_user(db: Session, username: str):
+    return db.query(User).filter(User.username == username).first()
+
+
+def get_chat(db: Session, chat_uuid: str):
+    return db.query(Chat).filter(Chat.chat_uuid == chat_uuid).first()
+
+
+class ForeignChat(Exception):
+    """
+    A write addressed a chat id that belongs to another user.
+    """
+
+
+def get_own_chat(db: Session, user_id: int, chat_uuid: str):
+    """
+    The chat, None if it does not exist yet, or ForeignChat if it is someone else's.
+    """
+    chat = get_chat(db, chat_uuid)
+    if chat is not None and chat.user_id != user_id:
+        raise ForeignChat(chat_uuid)
+    return chat
+
+
+def list_chat_summaries(db: Session, user_id: int, limit: int, before=None):
+    """
+    Most recently updated chats first, without touching their messages.
+    `before` is the (updated_at, id) of the last chat on the previous page.
+    """
+    query = db.query(Chat.id, Chat.chat_uuid, Chat.title, Chat.updated_at).filter(Chat.user_id == user_id)
+    if before is not None:
+        updated_at, chat_id = before
+        query = query.filter(or_(
+            Chat.updated_at < updated_at,
+            and_(Chat.updated_at == updated_at, Chat.id < chat_id),
+        ))
+    return query.order_by(Chat.updated_at.desc(), Chat.id.desc()).limit(limit).all()
+
+
+def get_message_page(db: Session, chat: Chat, after: int, limit: int):
+    """
+    Returns [(position, {role, content})] for positions after `after`.
+    """
+    if chat.legacy_messages is not None:
+        legacy = chat.legacy_messages
+        return [(i, legacy[i]) for i in range(max(after + 1, 0), min(after + 1 + limit, len(legacy)))]
+    rows = (
+        db.query(Message)
+        .filter(Message.chat_id == chat.id, Message.active == True, Message.position > after)
+        .order_by(Message.position)
+        .limit(limit)
+        .all()
+    )
+    return [(m.position, {"role": m.role, "content": m.content}) for m in rows]
+
+
+def get_user_chats(db: Session, user_id: int):
+    # One extra query for all messages instead of one per chat
+    return db.query(Chat).options(selectinload(Chat.messages)).filter(Chat.user_id == user_id).order_by(Chat.id).all()
+
+
+def serialize_messages(chat: Chat):
+    """
+    Returns a chat's messages in the [{role, content}] shape the frontend uses.
+    """
+    if chat.legacy_messages is not None and not chat.messages:
+        return chat.legacy_messages
+    return [{"role": m.role, "content": m.content} for m in chat.messages]
+
+
+def next_position(db: Session, chat: Chat) -> int:
+    last = db.query(func.max(Message.position)).filter(Message.chat_id == chat.id, Message.active == True).scalar()
+    return 0 if last is None else last + 1
+
+
+def append_messages(db: Session, chat: Chat, messages, start: int):
+    """
+    Inserts `messages` at positions start, start+1, ... of the active
+    branch. Nothing already stored is read back or rewritten.
+    """
+    rows = [
+        Message(chat_id=chat.id, branch_id=chat.branch_id, position=start + i, role=m.get("role", "user"), content=m.get("content") or "")
+        for i, m in enumerate(messages)
+    ]
+    db.add_all(rows)
+    if rows and search.is_enabled(db):
+        # Index in the same transaction (needs the new row ids)
+        db.flush()
+        search.index_messages(db, chat.user_id, rows)
+
+
+def materialize_legacy(db: Session, chat: Chat):
+    """
+    Moves a chat's legacy JSON blob into message rows (no-op once migrated).
+    """
+    if chat.legacy_messages is None:
+        return
+    if next_position(db, chat) == 0:
+        append_messages(db, chat, chat.legacy_messages, 0)
+    chat.legacy_messages = None
+
+
+def touch(chat: Chat):
+    chat.updated_at = utcnow()
+
+
+def history_version_bump(user_id):
+    """
+    Statement advancing a user's history_version, returning the new value.
+    The row lock it takes lasts until commit, so concurrent writers for one
+    user commit their versions in order.
+    """
+    return (
+        update(User.__table__)
+        .where(User.__table__.c.id == user_id)
+        .values(history_version=User.__table__.c.history_version + 1)
+        .returning(User.__table__.c.history_version)
+    )
+
+
+def mark_changed(db: Session, chat: Chat):
+    """
+    Records a change to `chat` for /history ETags and deltas.
+    """
+    touch(chat)
+    chat.version = db.execute(history_version_bump(chat.user_id)).scalar_one()
+
+
+def create_chat(db: Session, user_id: int, chat_uuid: str, title: str):
+    chat = Chat(chat_uuid=chat_uuid, user_id=user_id, title=title, updated_at=utcnow())
+    db.add(chat)
+    db.flush()
+    return chat
+
+
+def first_difference(db: Session, chat: Chat, messages):
+    """
+    Position of the first message on the active branch that `messages`
+    does not repeat, or None when one is a prefix of the other.
+    """
+    stored = (
+        db.query(Message.role, Message.content)
+        .filter(Message.chat_id == chat.id, Message.active == True)
+        .order_by(Message.position).limit(len(messages))
+    )
+    for position, (role, content) in enumerate(stored):
+        message = messages[position]
+        if role != message.get("role", "user") or (content or "") != (message.get("content") or ""):
+            return position
+    return None
+
+
+def store_chat(db: Session, user_id: int, chat_uuid: str, title: str, messages):
+    """
+    Full-list save used by /history/save. Usually the client has extended
+    the conversation, so only the tail past the stored length is inserted.
+    A shorter list forks: the dropped tail is kept as an inactive branch.
+    A list that differs from the stored messages (e.g. edited on another
+    device) forks where the two part, keeping the stored tail the same way.
+    """
+    chat = get_own_chat(db, user_id, chat_uuid)
+    changed = chat is None
+    if chat is None:
+        chat = create_chat(db, user_id, chat_uuid, title)
+    else:
+        # Clients send the placeholder until they see the generated title; keep the real one
+        if title != DEFAULT_TITLE and title != chat.title:
+            chat.title = title
+            changed = True
+        materialize_legacy(db, chat)
+        db.flush()
+
+    diverged = first_difference(db, chat, messages)
+    if diverged is not None:
+        fork_chat(db, chat, diverged, messages[diverged:])
+        return chat
+    stored = next_position(db, chat)
+    if len(messages) < stored:
+        fork_chat(db, chat, len(messages), [])
+        return chat
+    # A save that repeats what is stored leaves the version (and ETag) alone
+    if len(messages) != stored or changed:
+        mark_changed(db, chat)
+    append_messages(db, chat, messages[stored:], stored)
+    return chat
+
+
+# --- Branches ---
+
+class UnknownBranch(Exception):
+    """
+    A branch id that is not one of the chat's branches.
+    """
+
+
+def branch_chain(db: Session, chat: Chat, branch_id=None):
+    """
+    [(branch id, fork position)] from `branch_id` (default: the active
+    branch) up to the original branch, (None, 0).
+    """
+    branches = {b.id: b for b in db.query(Branch).filter(Branch.chat_id == chat.id)}
+    chain = []
+    branch_id = chat.branch_id if branch_id is None else branch_id
+    while branch_id is not None:
+        branch = branches[branch_id]
+        chain.append((branch.id, branch.fork_position))
+        branch_id = branch.parent_id
+    chain.append((None, 0))
+    return chain
+
+
+def on_chain(chain):
+    """
+    SQL condition for the messages on the path `chain` describes: each
+    branch contributes its messages from its fork position up to where
+    the next branch down forked off it.
+    """
+    conditions, end = [], None
+    for branch_id, fork_position in chain:
+        # Never NULL, so the result can be compared with Message.active
+        condition = [func.coalesce(Message.branch_id, 0) == (branch_id or 0), Message.position >= fork_position]
+        if end is not None:
+            condition.append(Message.position < end)
+        conditions.append(and_(*condition))
+        end = fork_position
+    return or_(*conditions)
+
+
+def activate_branch(db: Session, chat: Chat, branch_id):
+    """
+    Makes `branch_id` the chat's active branch, flipping the active flag of
+    only the messages whose membership changes.
+    """
+    previous = chat.branch_id
+    chat.branch_id = branch_id
+    on_path = on_chain(branch_chain(db, chat))
+    db.query(Message).filter(Message.chat_id == chat.id, Message.active != on_path).update(
+        {Message.active: on_path}, synchronize_session=False
+    )
+    if previous is not None and previous != branch_id:
+        # A branch left before anything was written to it is dropped
+        # (no other branch can fork off it: it owns no messages)
+        if db.query(Message.id).filter(Message.branch_id == previous).first() is None:
+            db.query(Branch).filter(Branch.id == previous).delete(synchronize_session=False)
+    db.expire(chat, ["messages"])
+
+
+def fork_chat(db: Session, chat: Chat, position: int, messages):
+    """
+    Edit-and-regenerate: starts a branch that shares the active branch's
+    first `position` messages and continues with `messages`, and makes it
+    the active one. The replaced tail stays stored as the old branch.
+    Returns (messages on the new branch, error message or None).
+    """
+    materialize_legacy(db, chat)
+    db.flush()
+    length = next_position(db, chat)
+    if position > length:
+        return length, f"Chat has {length} messages, cannot fork at {position}"
+    # The parent is the branch that owns message position - 1 on the active path
+    parent_id = next((b for b, fork_position in branch_chain(db, chat) if fork_position < position), None)
+    branch = Branch(chat_id=chat.id, parent_id=parent_id, fork_position=position, created_at=utcnow())
+    db.add(branch)
+    db.flush()
+    activate_branch(db, chat, branch.id)
+    append_messages(db, chat, messages, position)
+    mark_changed(db, chat)
+    return position + len(messages), None
+
+
+def switch_branch(db: Session, chat: Chat, branch_id):
+    """
+    Makes `branch_id` (None: the original branch) the active one and
+    returns its message count.
+    """
+    if branch_id is not None:
+        branch = db.get(Branch, branch_id)
+        if branch is None or branch.chat_id != chat.id:
+            raise UnknownBranch(branch_id)
+    materialize_legacy(db, chat)
+    if branch_id != chat.branch_id:
+        activate_branch(db, chat, branch_id)
+        mark_changed(db, chat)
+    db.flush()
+    return next_position(db, chat)
+
+
+def list_branches(db: Session, chat: Chat, preview_chars: int = 80):
+    """
+    The chat's branches, original first: where each forked, how many
+    messages it has and the start of its first own message.
+    """
+    branches = db.query(Branch).filter(Branch.chat_id == chat.id).order_by(Branch.id).all()
+    # Keyed by branch id, None for the original branch
+    lengths = dict(
+        db.query(Message.branch_id, func.max(Message.position) + 1)
+        .filter(Message.chat_id == chat.id)
+        .group_by(Message.branch_id)
+    )
+    firsts = dict(
+        db.query(Message.branch_id, Message.content)
+        .filter(Message.chat_id == chat.id, or_(
+            and_(Message.branch_id.is_(None), Message.position == 0),
+            *[and_(Message.branch_id == b.id, Message.position == b.fork_position) for b in branches],
+        ))
+    )
+    result = [{
+        "branch_id": None, "parent_id": None, "fork_position": 0,
+        "length": lengths.get(None, len(chat.legacy_messages or [])),
+        "preview": (firsts.get(None) or "")[:preview_chars],
+        "active": chat.branch_id is None,
+    }]
+    for b in branches:
+        result.append({
+            "branch_id": b.id, "parent_id": b.parent_id, "fork_position": b.fork_position,
+            "length": lengths.get(b.id, b.fork_position),
+            "preview": (firsts.get(b.id) or "")[:preview_chars],
+            "active": chat.branch_id == b.id,
+        })
+    return result
+
+
+def delete_chat_rows(db: Session, user_id: int):
+    """
+    Deletes the user's chats with their messages, branches and search entries.
+    """
+    search.unindex_messages(
+        db, "SELECT m.id FROM messages m JOIN chats c ON c.id = m.chat_id WHERE c.user_id = :user_id",
+        {"user_id": user_id},
+    )
+    chat_ids = select(Chat.id).where(Chat.user_id == user_id)
+    db.query(Message).filter(Message.chat_id.in_(chat_ids)).delete(synchronize_session=False)
+    db.query(Branch).filter(Branch.chat_id.in_(chat_ids)).delete(synchronize_session=False)
+    db.query(Chat).filter(Chat.user_id == user_id).delete(synchronize_session=False)
+
+
+def delete_user_chats(db: Session, user_id: int):
+    delete_chat_rows(db, user_id)
+    # Clients holding an older version must drop their copy, not apply a delta
+    version = db.execute(history_version_bump(user_id)).scalar_one()
+    db.query(User).filter(User.id == user_id).update({"cleared_version": version}, synchronize_session=False)
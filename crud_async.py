@@ -0,0 +1,187 @@
+"""
+AsyncSession versions of the crud helpers used by the history endpoints.
+
+Reads are written against the async API directly and load relationships
+eagerly (an async session cannot lazy-load). Writes reuse the sync helpers in
+crud through AsyncSession.run_sync, which runs them on the event loop as well:
+every statement still awaits the async driver, there is no threadpool hop.
+"""
+from sqlalchemy import and_, or_, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from models import User, Chat, Message
+import crud
+import database
+import search
+
+
+async def get_user(db: AsyncSession, username: str):
+    return (await db.execute(select(User).where(User.username == username))).scalars().first()
+
+
+async def get_user_by_id(db: AsyncSession, user_id: int):
+    return await db.get(User, user_id)
+
+
+_shard_users = set()  # user ids whose shard row this process has seen
+
+
+async def ensure_shard_user(db: AsyncSession, user_id: int, username: str):
+    """
+    Gives the user a row in their shard (`db`), where saves bump the history
+    version without writing to the main database, unless it has one already.
+    No-op without shards.
+    """
+    if user_id in _shard_users or database.shard_for(user_id).is_main:
+        return
+    # Shards are SQLite files
+    await db.execute(sqlite_insert(User).values(id=user_id, username=username).on_conflict_do_nothing())
+    await db.commit()
+    _shard_users.add(user_id)
+
+
+async def get_chat(db: AsyncSession, chat_uuid: str):
+    return (await db.execute(select(Chat).where(Chat.chat_uuid == chat_uuid))).scalars().first()
+
+
+async def get_user_chats(db: AsyncSession, user_id: int):
+    # Messages for every chat in one extra query, instead of lazy user.chats / chat.messages
+    result = await db.execute(
+        select(Chat).options(selectinload(Chat.messages)).where(Chat.user_id == user_id).order_by(Chat.id)
+    )
+    return result.scalars().all()
+
+
+async def get_chat_batch(db: AsyncSession, user_id: int, after_id: int, limit: int):
+    """
+    The user's chats with id > after_id, with messages, in creation order.
+    """
+    result = await db.execute(
+        select(Chat).options(selectinload(Chat.messages))
+        .where(Chat.user_id == user_id, Chat.id > after_id).order_by(Chat.id).limit(limit)
+    )
+    return result.scalars().all()
+
+
+async def get_changed_chats(db: AsyncSession, user_id: int, since: int, limit: int, with_messages: bool):
+    """
+    The user's chats changed after history version `since`, oldest change first.
+    """
+    query = select(Chat).where(Chat.user_id == user_id, Chat.version > since).order_by(Chat.version).limit(limit)
+    if with_messages:
+        query = query.options(selectinload(Chat.messages))
+    return (await db.execute(query)).scalars().all()
+
+
+async def get_changed_chat_heads(db: AsyncSession, user_id: int, since: int):
+    """
+    (id, chat_uuid, title, branch_id) of the user's chats changed after history version `since`.
+    """
+    result = await db.execute(
+        select(Chat.id, Chat.chat_uuid, Chat.title, Chat.branch_id)
+        .where(Chat.user_id == user_id, Chat.version > since).order_by(Chat.version)
+    )
+    return result.all()
+
+
+async def get_memory_rows(db: AsyncSession, user_id: int, starts=None):
+    """
+    (chat_uuid, title, branch_id, message id, position, content) of the
+    messages the chats read as, for memory.py. With `starts` ({chat id:
+    position}), only those chats' messages from that position on.
+    """
+    query = (
+        select(Chat.chat_uuid, Chat.title, Chat.branch_id, Message.id, Message.position, Message.content)
+        .join(Message, Message.chat_id == Chat.id)
+        .where(Chat.user_id == user_id, Message.active == True)
+        .order_by(Chat.id, Message.position)
+    )
+    if starts is not None:
+        whole = [chat_id for chat_id, start in starts.items() if start == 0]
+        conditions = [and_(Message.chat_id == chat_id, Message.position >= start) for chat_id, start in starts.items() if start]
+        if whole:
+            conditions.append(Message.chat_id.in_(whole))
+        query = query.where(or_(*conditions))
+    return (await db.execute(query)).all()
+
+
+async def get_message_contents(db: AsyncSession, message_ids):
+    result = await db.execute(select(Message.id, Message.content).where(Message.id.in_(message_ids)))
+    return result.all()
+
+
+async def list_chat_summaries(db: AsyncSession, user_id: int, limit: int, before=None):
+    return await db.run_sync(lambda s: crud.list_chat_summaries(s, user_id, limit, before))
+
+
+async def get_message_page(db: AsyncSession, chat: Chat, after: int, limit: int):
+    if chat.legacy_messages is not None:
+        return await db.run_sync(lambda s: crud.get_message_page(s, chat, after, limit))
+    result = await db.execute(
+        select(Message.position, Message.role, Message.content)
+        .where(Message.chat_id == chat.id, Message.active == True, Message.position > after)
+        .order_by(Message.position)
+        .limit(limit)
+    )
+    return [(r.position, {"role": r.role, "content": r.content}) for r in result]
+
+
+async def search_enabled(db: AsyncSession):
+    return await db.run_sync(search.is_enabled)
+
+
+async def search_messages(db: AsyncSession, user_id, q: str, limit: int, offset: int):
+    return await db.run_sync(lambda s: search.search_messages(s, user_id, q, limit, offset))
+
+
+async def store_chat(db: AsyncSession, user_id: int, chat_uuid: str, title: str, messages):
+    return await db.run_sync(lambda s: crud.store_chat(s, user_id, chat_uuid, title, messages))
+
+
+async def append_chat(db: AsyncSession, user_id: int, chat_uuid: str, title, messages, start):
+    """
+    Body of /history/append. Returns (stored count, error message or None);
+    raises crud.ForeignChat for another user's chat id.
+    """
+    def _append(s):
+        chat = crud.get_own_chat(s, user_id, chat_uuid)
+        changed = chat is None
+        if chat is None:
+            chat = crud.create_chat(s, user_id, chat_uuid, title or crud.DEFAULT_TITLE)
+        else:
+            if title is not None and title != crud.DEFAULT_TITLE and title != chat.title:
+                chat.title = title
+                changed = True
+            crud.materialize_legacy(s, chat)
+            s.flush()
+
+        position = crud.next_position(s, chat)
+        new = messages
+        if start is not None:
+            if start > position:
+                return position, f"Chat has {position} messages, cannot append at {start}"
+            # Drop the part of a retried append that already landed
+            new = messages[position - start:]
+        if new or changed:
+            crud.mark_changed(s, chat)
+        crud.append_messages(s, chat, new, position)
+        return position + len(new), None
+
+    return await db.run_sync(_append)
+
+
+async def fork_chat(db: AsyncSession, chat: Chat, position: int, messages):
+    return await db.run_sync(lambda s: crud.fork_chat(s, chat, position, messages))
+
+
+async def switch_branch(db: AsyncSession, chat: Chat, branch_id):
+    return await db.run_sync(lambda s: crud.switch_branch(s, chat, branch_id))
+
+
+async def list_branches(db: AsyncSession, chat: Chat):
+    return await db.run_sync(lambda s: crud.list_branches(s, chat))
+
+
+async def delete_user_chats(db: AsyncSession, user_id: int):
+    await db.run_sync(lambda s: crud.delete_user_chats(s, user_id))
@@ -0,0 +1,97 @@
+import asyncio
+import time
+import uuid
+
+
+class Generation:
+    """
+    Output of one upstream completion, shared by every client reading it.
+    The producer publishes chunks as they arrive; readers replay what is
+    already buffered and then wait for more, so a late reader sees the
+    whole stream from the start. A chunk's index is its token offset.
+    """
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.usage = None
+        self.started_at = time.monotonic()
+        self.first_chunk_at = None
+        self.finished_at = None
+        # User ids of the /chat requests reading it (None: sent without a
+        # token); only they may resume it
+        self.owners = set()
+        self._changed = asyncio.Event()
+
+    @classmethod
+    def completed(cls, chunks, usage=None):
+        """
+        An already finished generation, e.g. a reply served from cache.
+        """
+        generation = cls()
+        generation.chunks = list(chunks)
+        generation.first_chunk_at = generation.started_at
+        generation.finish(usage=usage)
+        return generation
+
+    def publish(self, chunk: str):
+        if self.first_chunk_at is None:
+            self.first_chunk_at = time.monotonic()
+        self.chunks.append(chunk)
+        self._notify()
+
+    def finish(self, error=None, usage=None):
+        self.error = error
+        self.usage = usage
+        self.done = True
+        self.finished_at = time.monotonic()
+        self._notify()
+
+    def _notify(self):
+        # Wake current readers; later waits use a fresh event
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def follow(self, start: int = 0):
+        i = start
+        while True:
+            while i < len(self.chunks):
+                yield self.chunks[i]
+                i += 1
+            if self.done:
+                return
+            await self._changed.wait()
+
+    async def follow_frames(self, start: int = 0, max_chars: int = 2048, linger: float = 0.0):
+        """
+        Like follow(), but yields (offset, chunks) batches: everything buffered
+        since the last frame, up to about `max_chars`. After the first frame a
+        reader waits up to `linger` seconds for more chunks before sending a
+        small frame, so fast token streams go out in fewer, larger writes.
+        """
+        loop = asyncio.get_running_loop()
+        i = start
+        while True:
+            if i < len(self.chunks):
+                if linger > 0 and i > start:
+                    deadline = loop.time() + linger
+                    while not self.done and sum(len(c) for c in self.chunks[i:]) < max_chars:
+                        remaining = deadline - loop.time()
+                        if remaining <= 0:
+                            break
+                        try:
+                            await asyncio.wait_for(self._changed.wait(), remaining)
+                        except asyncio.TimeoutError:
+                            break
+                end, size = i, 0
+                while end < len(self.chunks) and (end == i or size + len(self.chunks[end]) <= max_chars):
+                    size += len(self.chunks[end])
+                    end += 1
+                yield i, self.chunks[i:end]
+                i = end
+                continue
+            if self.done:
+                return
+            await self._changed.wait()
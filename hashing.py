@@ -0,0 +1,80 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+import bcrypt
+
+# bcrypt cost factor for new hashes. Raising it makes logins rehash old hashes.
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# Worker processes dedicated to hashing, and how many hash jobs may be queued
+# or running at once before new requests are turned away.
+HASH_POOL_SIZE = int(os.getenv("HASH_POOL_SIZE", str(os.cpu_count() or 1)))
+HASH_MAX_PENDING = int(os.getenv("HASH_MAX_PENDING", str(HASH_POOL_SIZE * 8)))
+
+_executor = None
+_pending = 0
+
+
+class HashPoolBusy(Exception):
+    """Raised when the hashing queue is full."""
+
+
+def _hash_password(password: str, rounds: int) -> str:
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _check_password(password: str, password_hash: str) -> bool:
+    return bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
+
+
+def _noop():
+    return None
+
+
+def start_pool():
+    """
+    Creates the pool and forks every worker up front, before the server
+    starts handing out threads.
+    """
+    global _executor
+    if _executor is None:
+        # fork: spawn/forkserver would re-import the app's __main__ in each worker
+        context = multiprocessing.get_context("fork") if hasattr(os, "fork") else None
+        _executor = ProcessPoolExecutor(max_workers=HASH_POOL_SIZE, mp_context=context)
+        for future in [_executor.submit(_noop) for _ in range(HASH_POOL_SIZE)]:
+            future.result()
+    return _executor
+
+
+def shutdown_pool():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
+
+
+async def _run(fn, *args):
+    global _pending
+    if _pending >= HASH_MAX_PENDING:
+        raise HashPoolBusy()
+    _pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(start_pool(), fn, *args)
+    finally:
+        _pending -= 1
+
+
+async def hash_password(password: str) -> str:
+    return await _run(_hash_password, password, BCRYPT_ROUNDS)
+
+
+async def check_password(password: str, password_hash: str) -> bool:
+    return await _run(_check_password, password, password_hash)
+
+
+def needs_rehash(password_hash: str) -> bool:
+    # bcrypt hashes look like $2b$<cost>$<salt+hash>
+    try:
+        return int(password_hash.split("$")[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return True
@@ -0,0 +1,262 @@
+"""
+One-shot import of the legacy users.json store (auth.py) into the database:
+
+    python import_users.py [path/to/users.json] [--batch-size 500] [--restart]
+
+The file is read incrementally, one chat at a time, so memory stays bounded
+by the largest single chat rather than the file. Chats are inserted in
+batched transactions; each commit also records how far into the file the
+import got, so re-running after an interruption continues from there.
+Users that already exist keep their current password, and chats already
+in the database are skipped, so re-running a finished or partial import
+never duplicates anything.
+"""
+import argparse
+import codecs
+import json
+import os
+import time
+from sqlalchemy import select
+from database import SessionLocal, DB_SHARDS
+from models import User, Chat, Message, ImportCheckpoint, utcnow
+import crud
+import migrate
+import search
+
+BATCH_SIZE = 500  # chats per transaction
+READ_SIZE = 1 << 16
+
+
+class JsonStream:
+    """
+    Incremental reader over a JSON file: walks objects key by key and
+    decodes one value at a time. `offset` is the byte position reached,
+    and a stream can be reopened at such an offset inside an object.
+    """
+
+    def __init__(self, f, offset=0):
+        self.f = f
+        self.f.seek(offset)
+        self.base = offset  # byte offset of buf[0]
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._json = json.JSONDecoder()
+
+    @property
+    def offset(self):
+        return self.base + len(self.buf[:self.pos].encode("utf-8"))
+
+    def _fill(self):
+        # Drop what has been consumed; read at least as much as is buffered,
+        # so a value larger than READ_SIZE needs log(n) retries, not n
+        self.base = self.offset
+        self.buf, self.pos = self.buf[self.pos:], 0
+        data = self.f.read(max(READ_SIZE, len(self.buf)))
+        self.eof = not data
+        self.buf += self._utf8.decode(data, final=self.eof)
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf) or self.eof:
+                return self.buf[self.pos:self.pos + 1]
+            self._fill()
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"Expected {char!r} at byte {self.offset} of {self.f.name}")
+        self.pos += 1
+
+    def value(self):
+        """
+        Decodes the next value whole.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self._json.raw_decode(self.buf, self.pos)
+                # A number at the very end of the buffer may continue past it
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def keys(self, resume=False):
+        """
+        Yields the keys of the object at the current position; the caller
+        reads each value (value() or keys()) before asking for the next key.
+        With `resume`, the stream is positioned just after a value inside
+        the object rather than at its opening brace.
+        """
+        if not resume:
+            self.expect("{")
+            if self.peek() == "}":
+                self.pos += 1
+                return
+        else:
+            if self.peek() == "}":
+                self.pos += 1
+                return
+            self.expect(",")
+        while True:
+            key = self.value()
+            self.expect(":")
+            yield key
+            if self.peek() == ",":
+                self.pos += 1
+            else:
+                self.expect("}")
+                return
+
+
+class Importer:
+    def __init__(self, db, checkpoint, batch_size=BATCH_SIZE):
+        self.db = db
+        self.checkpoint = checkpoint
+        self.batch_size = batch_size
+        self.pending = []  # (user, chat_uuid, chat dict)
+        self.skipped = 0
+        self.started = time.perf_counter()
+
+    def user(self, username):
+        user = crud.get_user(self.db, username)
+        if user is None:
+            user = User(username=username)
+            self.db.add(user)
+            self.db.flush()
+        return user
+
+    def add_chat(self, user, chat_uuid, chat):
+        self.pending.append((user, chat_uuid, chat))
+        if len(self.pending) >= self.batch_size:
+            # Mid-user commit: the checkpoint stays at the start of this user,
+            # a resume re-reads it and skips the chats stored here
+            self.commit()
+
+    def _insert_pending(self):
+        if not self.pending:
+            return
+        uuids = [chat_uuid for _, chat_uuid, _ in self.pending]
+        seen = set(self.db.scalars(select(Chat.chat_uuid).where(Chat.chat_uuid.in_(uuids))))
+        chats = []
+        for user, chat_uuid, data in self.pending:
+            if chat_uuid in seen or not isinstance(data, dict):
+                self.skipped += 1
+                continue
+            seen.add(chat_uuid)
+            chat = Chat(chat_uuid=chat_uuid, user_id=user.id, title=data.get("title") or crud.DEFAULT_TITLE, updated_at=utcnow())
+            chats.append((chat, data.get("messages") or []))
+        self.db.add_all([chat for chat, _ in chats])
+        self.db.flush()
+
+        # One history version per user and batch
+        versions, by_user = {}, {}
+        for chat, rows in chats:
+            if chat.user_id not in versions:
+                versions[chat.user_id] = self.db.execute(crud.history_version_bump(chat.user_id)).scalar_one()
+            chat.version = versions[chat.user_id]
+            by_user.setdefault(chat.user_id, []).extend(
+                Message(chat_id=chat.id, position=i, role=m.get("role", "user"), content=m.get("content") or "")
+                for i, m in enumerate(rows)
+            )
+        messages = [m for rows in by_user.values() for m in rows]
+        self.db.add_all(messages)
+        if messages and search.is_enabled(self.db):
+            # Index in the same transaction (needs the new row ids)
+            self.db.flush()
+            for user_id, rows in by_user.items():
+                search.index_messages(self.db, user_id, rows)
+        self.checkpoint.chats += len(chats)
+        self.checkpoint.messages += len(messages)
+        self.pending = []
+
+    def commit(self, offset=None, users=0):
+        self._insert_pending()
+        if offset is not None:
+            self.checkpoint.offset = offset
+            self.checkpoint.users += users
+        self.db.commit()
+        elapsed = time.perf_counter() - self.started
+        c = self.checkpoint
+        print(f"Imported {c.users} users, {c.chats} chats, {c.messages} messages "
+              f"({c.offset / max(c.size, 1):.0%} of the file, {elapsed:.0f}s)...")
+
+
+def import_file(db, path, batch_size=BATCH_SIZE, restart=False):
+    """
+    Imports `path`, resuming an earlier run unless `restart`. Returns the checkpoint.
+    """
+    source, size = os.path.realpath(path), os.path.getsize(path)
+    checkpoint = db.get(ImportCheckpoint, source)
+    if checkpoint is not None and (restart or checkpoint.size != size):
+        if checkpoint.size != size:
+            print(f"{path} changed since the last run; starting over (already imported chats are skipped).")
+        db.delete(checkpoint)
+        db.flush()
+        checkpoint = None
+    if checkpoint is None:
+        checkpoint = ImportCheckpoint(source=source, size=size, offset=0, users=0, chats=0, messages=0, finished=False)
+        db.add(checkpoint)
+        db.commit()
+    if checkpoint.finished:
+        print(f"{path} was already imported ({checkpoint.users} users, {checkpoint.chats} chats).")
+        return checkpoint
+    if checkpoint.offset:
+        print(f"Resuming at byte {checkpoint.offset} of {size}.")
+
+    importer = Importer(db, checkpoint, batch_size)
+    with open(path, "rb") as f:
+        stream = JsonStream(f, checkpoint.offset)
+        done_users = 0
+        for username in stream.keys(resume=checkpoint.offset > 0):
+            user = importer.user(username)
+            for field in stream.keys():
+                if field == "password":
+                    password = stream.value()
+                    # Users registered in the database since keep that password
+                    if user.password_hash is None:
+                        user.password_hash = password
+                elif field == "chats":
+                    for chat_uuid in stream.keys():
+                        importer.add_chat(user, chat_uuid, stream.value())
+                else:
+                    stream.value()
+            done_users += 1
+            # Commit at user boundaries, where the checkpoint can advance
+            if len(importer.pending) >= batch_size // 2 or done_users >= batch_size:
+                importer.commit(stream.offset, done_users)
+                done_users = 0
+        checkpoint.finished = True
+        importer.commit(stream.offset, done_users)
+    if importer.skipped:
+        print(f"Skipped {importer.skipped} chats already in the database.")
+    return checkpoint
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import the legacy users.json store")
+    parser.add_argument("path", nargs="?", default="users.json")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="chats per transaction")
+    parser.add_argument("--restart", action="store_true", help="ignore the progress of an earlier run")
+    args = parser.parse_args()
+
+    migrate.upgrade_schema()
+    db = SessionLocal()
+    try:
+        checkpoint = import_file(db, args.path, args.batch_size, args.restart)
+        print(f"Done. {checkpoint.users} users, {checkpoint.chats} chats, {checkpoint.messages} messages imported.")
+        if DB_SHARDS:
+            # Imported chats land in the main database, like those from before sharding
+            print("DB_SHARDS is set: run `python rebalance_shards.py` to move the imported history to its shards.")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+import json
+import os
+import httpx
+from groq import AsyncGroq, DefaultAsyncHttpxClient
+
+# Upstream connection pool. One pool per provider is shared by every /chat
+# stream on this worker, so max connections caps concurrent upstream
+# generations and the keep-alive pool lets back-to-back requests skip the
+# TCP/TLS handshake.
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "512"))
+LLM_MAX_KEEPALIVE = int(os.getenv("LLM_MAX_KEEPALIVE", "64"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "30"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+# SDK-level retries per attempt. Routing fails over to the route's fallback
+# model instead, which is quicker than retrying a failing primary.
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "0"))
+
+# Groq-compatible endpoints by name. "groq" is always defined; add more with
+# LLM_PROVIDERS='{"backup": {"base_url": "https://...", "api_key_env": "BACKUP_API_KEY"}}'
+PROVIDERS = {
+    "groq": {"base_url": os.getenv("GROQ_BASE_URL") or None, "api_key_env": "GROQ_API_KEY"},
+}
+PROVIDERS.update(json.loads(os.getenv("LLM_PROVIDERS", "{}")))
+
+_clients = {}
+
+
+def get_client(provider: str = "groq"):
+    """
+    Returns the process-wide async client for `provider`, creating it on first use.
+    """
+    if provider not in _clients:
+        settings = PROVIDERS[provider]
+        http_client = DefaultAsyncHttpxClient(
+            limits=httpx.Limits(
+                max_connections=LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=LLM_MAX_KEEPALIVE,
+                keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+        )
+        _clients[provider] = AsyncGroq(
+            api_key=os.getenv(settings.get("api_key_env", "GROQ_API_KEY")),
+            base_url=settings.get("base_url"),
+            http_client=http_client,
+            max_retries=LLM_MAX_RETRIES,
+        )
+    return _clients[provider]
+
+
+async def close_client():
+    while _clients:
+        _, client = _clients.popitem()
+        await client.close()
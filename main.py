@@ -1,28 +1,118 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Query, Header, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 # Trigger reload
-from sqlalchemy.orm import Session
-from pydantic import BaseModel
-from typing import List, Dict, Any
-import bcrypt
+from sqlalchemy.ext.asyncio import AsyncSession
+from pydantic import BaseModel, Field
+from typing import List, Dict, Any, Optional
+import asyncio
+import logging
 import os
-from groq import Groq
+import time
+from datetime import datetime
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, PlainTextResponse
 import json
 
 load_dotenv()
 
-from database import engine, get_db, Base
-from models import User, Chat
+from database import engine, async_engine, get_async_db, get_async_user_db, shard_for, shards
+import database
+from models import User
+import context
+import codec
+import crud
+import crud_async
+import hashing
+import llm
+import memory
+import metrics
+import modes
+import ratelimit
+import response_cache
+import response_compression
+import routing
+import streaming
+import titles
+import tokens
+from generation import Generation
+import write_behind
 
-# Create Tables
-Base.metadata.create_all(bind=engine)
+logger = logging.getLogger(__name__)
 
-app = FastAPI()
+# Schema changes are applied by `python migrate.py`, not on import, so
+# several workers can start at once without racing on DDL
 
-# Groq Client setup
-client = Groq(api_key=os.getenv("GROQ_API_KEY"))
+# Optional write-behind queue for /history/save
+write_queue = write_behind.WriteBehindQueue(lambda user_id: shard_for(user_id).SessionLocal) if write_behind.WRITE_BEHIND else None
+
+# Chats per query (and per session) when streaming /history/{username}/export
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "50"))
+
+# Cache of /chat replies, shared by identical requests
+chat_cache = response_cache.ResponseCache() if response_cache.CHAT_CACHE else None
+
+# Per-user/mode token buckets and the global cap on upstream calls
+limiter = ratelimit.Limiter()
+
+# In-flight and recently finished generations, for clients resuming a stream
+generations = streaming.GenerationStore()
+
+# Strong references to fire-and-forget tasks so they are not garbage collected
+background_tasks = set()
+
+def spawn(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def sync_pending(user_id: int):
+    """
+    Writes any queued saves for `user_id` so the next read sees them.
+    """
+    if write_queue is not None:
+        # The queue writes through the sync engine, so this one waits in a thread
+        await asyncio.to_thread(write_queue.flush, user_id)
+
+async def sync_pending_users(user_ids):
+    for user_id in user_ids:
+        await sync_pending(user_id)
+
+# Background titling of chats still called "New Chat"
+title_queue = titles.TitleQueue(lambda user_id: shard_for(user_id).AsyncSessionLocal, before_read=sync_pending_users) if titles.AUTO_TITLE != "off" else None
+
+# Cross-chat memory: per-user BM25 indexes over the history, for /chat
+memory_store = memory.MemoryStore(lambda user_id: shard_for(user_id).AsyncSessionLocal, before_read=sync_pending) if memory.CHAT_MEMORY else None
+
+def queue_title(user_id: int, chat_id: str, title: Optional[str]):
+    if title_queue is not None and (title or crud.DEFAULT_TITLE) == crud.DEFAULT_TITLE:
+        title_queue.put(user_id, chat_id)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    hashing.start_pool()
+    if codec.enabled(engine.dialect):
+        codec.load_dictionaries(engine)
+    if write_queue is not None:
+        write_queue.start()
+    if title_queue is not None:
+        title_queue.start()
+    yield
+    if title_queue is not None:
+        await title_queue.stop()
+    # Release pooled upstream connections
+    await llm.close_client()
+    hashing.shutdown_pool()
+    if write_queue is not None:
+        # Durable flush of everything still queued
+        write_queue.stop()
+    await async_engine.dispose()
+    for shard in shards:
+        if not shard.is_main:
+            await shard.async_engine.dispose()
+
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS Middleware
 app.add_middleware(
@@ -33,6 +123,18 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# zstd/gzip for large JSON bodies (history); streamed responses are left alone
+app.add_middleware(response_compression.CompressionMiddleware)
+
+# Per-route latency, in-flight requests and per-request SQL timing
+app.add_middleware(metrics.MetricsMiddleware, router=app.router)
+metrics.instrument_engine(engine)
+metrics.instrument_engine(async_engine.sync_engine)
+for shard in shards:
+    if not shard.is_main:
+        metrics.instrument_engine(shard.engine)
+        metrics.instrument_engine(shard.async_engine.sync_engine)
+
 # --- Data Models (Pydantic) ---
 class UserAuth(BaseModel):
     username: str
@@ -44,139 +146,574 @@ class ChatData(BaseModel):
     title: str
     messages: List[Dict]
 
+class ChatAppend(BaseModel):
+    username: str
+    chat_id: str
+    messages: List[Dict]
+    title: Optional[str] = None
+    # Position of messages[0] in the chat; lets retried appends skip rows already stored
+    start: Optional[int] = None
+
+class ChatFork(BaseModel):
+    # Messages before this position are shared with the current branch
+    position: int = Field(ge=0)
+    # The edited message and whatever follows it on the new branch
+    messages: List[Dict]
+
+class BranchSwitch(BaseModel):
+    # None switches back to the chat's original branch
+    branch_id: Optional[int] = None
+
 class ChatRequest(BaseModel):
     messages: List[Dict]
     mode: str
+    # Ignored (kept for older clients): rate limits are per token user,
+    # requests without a token are limited per client address
+    username: Optional[str] = None
+    # Opt-in cross-chat memory (needs a token and CHAT_MEMORY=1); chat_id
+    # is the chat being continued, left out of the snippets
+    memory: bool = False
+    chat_id: Optional[str] = None
 
 # --- Endpoints ---
 
 @app.get("/")
 def health_check():
-    return {"status": "running", "database": "sqlite"}
+    return {"status": "running", "database": engine.dialect.name, "shards": database.DB_SHARDS}
+
+def hash_pool_busy():
+    return HTTPException(status_code=503, detail="Server busy, please retry", headers={"Retry-After": "1"})
+
+def too_many_requests(e: ratelimit.RateLimited):
+    detail = "Too many requests, please slow down" if e.reason == "rate_limited" else "Server busy, please retry"
+    return HTTPException(status_code=429, detail=detail, headers={"Retry-After": e.retry_after_header})
+
+def history_etag(version: int) -> str:
+    # Weak: the same version may be sent gzip-, zstd- or un-encoded
+    return f'W/"{version}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or any(t.removeprefix("W/") == etag.removeprefix("W/") for t in tags)
+
+def authenticated(authorization: Optional[str] = Header(None)) -> tokens.Claims:
+    """
+    The caller's identity from their /login token; no database lookup.
+    """
+    claims = tokens.from_header(authorization)
+    if claims is None:
+        raise HTTPException(status_code=401, detail="Not logged in or session expired", headers={"WWW-Authenticate": "Bearer"})
+    return claims
+
+def history_owner(username: str, claims: tokens.Claims = Depends(authenticated)) -> tokens.Claims:
+    # The path names whose history this is; the token decides whether the caller may see it
+    if claims.username != username:
+        raise HTTPException(status_code=403, detail="Not your history")
+    return claims
+
+async def history_db(claims: tokens.Claims = Depends(authenticated)):
+    """
+    Session on the database holding the caller's history (their shard).
+    """
+    async for db in get_async_user_db(claims.user_id):
+        # The shard's copy of the user row is made here, on first use, so a
+        # registration never leaves the user without one
+        await crud_async.ensure_shard_user(db, claims.user_id, claims.username)
+        yield db
+
+def require_owner(claims: tokens.Claims, username: str):
+    # Bodies still name the user; it has to be the caller
+    if claims.username != username:
+        raise HTTPException(status_code=403, detail="Not your history")
+
+async def token_user(db: AsyncSession, claims: tokens.Claims) -> User:
+    """
+    The caller's row by primary key, for endpoints that need its history version.
+    """
+    user = await crud_async.get_user_by_id(db, claims.user_id)
+    if user is None:
+        raise HTTPException(status_code=401, detail="Not logged in or session expired", headers={"WWW-Authenticate": "Bearer"})
+    return user
+
+def chat_not_found():
+    # Same answer whether the chat is missing or someone else's
+    return HTTPException(status_code=404, detail="Chat not found")
 
 @app.post("/register")
-def register(user_data: UserAuth, db: Session = Depends(get_db)):
+async def register(user_data: UserAuth, db: AsyncSession = Depends(get_async_db)):
     # Check existing
-    existing_user = db.query(User).filter(User.username == user_data.username).first()
+    existing_user = await crud_async.get_user(db, user_data.username)
     if existing_user:
         raise HTTPException(status_code=400, detail="Username already exists")
     
-    # Hash password
-    hashed = bcrypt.hashpw(user_data.password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    # Hash password in the dedicated process pool, off the event loop
+    try:
+        hashed = await hashing.hash_password(user_data.password)
+    except hashing.HashPoolBusy:
+        raise hash_pool_busy()
     
     # Create user
     new_user = User(username=user_data.username, password_hash=hashed)
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.commit()
     
     return {"message": "User registered successfully"}
 
 @app.post("/login")
-def login(user_data: UserAuth, db: Session = Depends(get_db)):
-    print(f"DEBUG: Login attempt for username='{user_data.username}'")
-    user = db.query(User).filter(User.username == user_data.username).first()
+async def login(user_data: UserAuth, db: AsyncSession = Depends(get_async_db)):
+    logger.debug("Login attempt for %r", user_data.username)
+    user = await crud_async.get_user(db, user_data.username)
     if not user:
-        print(f"DEBUG: User '{user_data.username}' NOT FOUND in database.")
+        logger.debug("Login for %r: no such user", user_data.username)
         raise HTTPException(status_code=404, detail="User not found. Please sign up.")
     
-    if bcrypt.checkpw(user_data.password.encode('utf-8'), user.password_hash.encode('utf-8')):
-        print(f"DEBUG: Password match for '{user_data.username}'. Login successful.")
-        return {"message": "Login successful", "username": user.username}
+    try:
+        matched = await hashing.check_password(user_data.password, user.password_hash)
+    except hashing.HashPoolBusy:
+        raise hash_pool_busy()
+
+    if matched and hashing.needs_rehash(user.password_hash):
+        # Cost factor changed since this hash was made; upgrade it while we have the password
+        try:
+            user.password_hash = await hashing.hash_password(user_data.password)
+            await db.commit()
+            # Usernames stay out of anything logged above debug
+            logger.info("Rehashed a password at cost %d.", hashing.BCRYPT_ROUNDS)
+        except hashing.HashPoolBusy:
+            pass # Retried on a later login
+
+    if matched:
+        logger.debug("Login for %r succeeded", user_data.username)
+        token = tokens.issue(user.id, user.username)
+        return {
+            "message": "Login successful",
+            "username": user.username,
+            "token": token,
+            "expires_in": tokens.SESSION_TTL,
+        }
     
-    print(f"DEBUG: Password Mismatch for '{user_data.username}'.")
+    logger.debug("Login for %r: wrong password", user_data.username)
     raise HTTPException(status_code=401, detail="Invalid credentials (Password mismatch)")
 
 @app.get("/history/{username}")
-def get_history(username: str, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.username == username).first()
-    if not user:
-         # Return empty if user doesn't exist yet (or handle error)
-         return {}
-    
+async def get_history(response: Response, if_none_match: Optional[str] = Header(None), claims: tokens.Claims = Depends(history_owner), db: AsyncSession = Depends(history_db)):
+    await sync_pending(claims.user_id)
+    user = await token_user(db, claims)
+
+    # The version is read before the chats: a write landing in between shows
+    # up again in the next delta instead of being missed
+    etag = history_etag(user.history_version)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+
     # Convert DB objects to nested dict format for frontend: {uuid: {title: ..., messages: ...}}
     history = {}
-    for chat in user.chats:
+    for chat in await crud_async.get_user_chats(db, user.id):
         history[chat.chat_uuid] = {
             "title": chat.title,
-            "messages": chat.messages
+            "messages": crud.serialize_messages(chat)
         }
     return history
 
+@app.get("/history/{username}/changes")
+async def history_changes(response: Response, since: int = Query(0, ge=0), messages: bool = True, limit: int = Query(100, ge=1, le=500), if_none_match: Optional[str] = Header(None), claims: tokens.Claims = Depends(history_owner), db: AsyncSession = Depends(history_db)):
+    """
+    Chats changed after history version `since`, oldest change first. When
+    `next_since` is set there are more: ask again with since=next_since.
+    `reset` means the history was cleared (or the server's is older than the
+    client's), so the client must drop what it has before applying `chats`.
+    """
+    await sync_pending(claims.user_id)
+    user = await token_user(db, claims)
+
+    etag = history_etag(user.history_version)
+    if since == user.history_version and etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+
+    reset = since < user.cleared_version or since > user.history_version
+    if reset:
+        since = 0
+    chats = await crud_async.get_changed_chats(db, user.id, since, limit + 1, messages)
+    next_since = None
+    if len(chats) > limit:
+        chats = chats[:limit]
+        next_since = chats[-1].version
+
+    changed = []
+    for chat in chats:
+        item = {"chat_id": chat.chat_uuid, "title": chat.title, "updated_at": chat.updated_at.isoformat(), "version": chat.version}
+        if messages:
+            item["messages"] = crud.serialize_messages(chat)
+        changed.append(item)
+    return {"version": user.history_version, "reset": reset, "chats": changed, "next_since": next_since}
+
+@app.get("/history/{username}/export")
+async def export_history(claims: tokens.Claims = Depends(history_owner), db: AsyncSession = Depends(history_db)):
+    """
+    The user's whole history as NDJSON: a "user" line, one "chat" line per
+    chat (oldest first) and a closing "done" line with the chat count. Chats
+    are read EXPORT_BATCH_SIZE at a time, each batch in its own session, so
+    neither the history nor a pooled connection is held for the whole download.
+    """
+    await sync_pending(claims.user_id)
+    user = await token_user(db, claims)
+    user_id, username, version = user.id, user.username, user.history_version
+
+    async def lines():
+        yield json.dumps({"type": "user", "username": username, "version": version}, ensure_ascii=False) + "\n"
+        after, count = 0, 0
+        while True:
+            async with shard_for(user_id).AsyncSessionLocal() as batch_db:
+                chats = await crud_async.get_chat_batch(batch_db, user_id, after, EXPORT_BATCH_SIZE)
+                batch = [
+                    json.dumps({
+                        "type": "chat",
+                        "chat_id": chat.chat_uuid,
+                        "title": chat.title,
+                        "updated_at": chat.updated_at.isoformat(),
+                        "messages": crud.serialize_messages(chat),
+                    }, ensure_ascii=False) + "\n"
+                    for chat in chats
+                ]
+            if not chats:
+                break
+            after = chats[-1].id
+            count += len(chats)
+            yield "".join(batch)
+        yield json.dumps({"type": "done", "chats": count}) + "\n"
+
+    headers = {"Content-Disposition": f'attachment; filename="{username}-history.ndjson"'}
+    return StreamingResponse(lines(), media_type=streaming.NDJSON, headers=headers)
+
+@app.get("/history/{username}/chats")
+async def list_chats(limit: int = Query(50, ge=1, le=200), cursor: Optional[str] = None, claims: tokens.Claims = Depends(history_owner), db: AsyncSession = Depends(history_db)):
+    """
+    Sidebar listing: chat ids and titles only, most recently updated first.
+    Pass `next_cursor` back as `cursor` to fetch the next page.
+    """
+    await sync_pending(claims.user_id)
+    user = await token_user(db, claims)
+    # Read before the page, as in /history; clients sync /changes from here
+    version = user.history_version
+
+    before = None
+    if cursor:
+        try:
+            updated_at, chat_id = cursor.rsplit("|", 1)
+            before = (datetime.fromisoformat(updated_at), int(chat_id))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    rows = await crud_async.list_chat_summaries(db, user.id, limit + 1, before)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = f"{rows[-1].updated_at.isoformat()}|{rows[-1].id}"
+
+    return {
+        "chats": [{"chat_id": r.chat_uuid, "title": r.title, "updated_at": r.updated_at.isoformat()} for r in rows],
+        "next_cursor": next_cursor,
+        "version": version,
+    }
+
+@app.get("/history/{username}/chats/{chat_id}/messages")
+async def get_chat_messages(chat_id: str, after: int = -1, limit: int = Query(200, ge=1, le=1000), claims: tokens.Claims = Depends(history_owner), db: AsyncSession = Depends(history_db)):
+    """
+    Messages of one chat in order. Pass `next_cursor` back as `after` to page.
+    """
+    await sync_pending(claims.user_id)
+    chat = await crud_async.get_chat(db, chat_id)
+    if not chat or chat.user_id != claims.user_id:
+        raise chat_not_found()
+
+    page = await crud_async.get_message_page(db, chat, after, limit + 1)
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        next_cursor = page[-1][0]
+
+    return {
+        "chat_id": chat.chat_uuid,
+        "title": chat.title,
+        "messages": [m for _, m in page],
+        "next_cursor": next_cursor,
+    }
+
+@app.get("/history/{username}/chats/{chat_id}/branches")
+async def list_branches(chat_id: str, claims: tokens.Claims = Depends(history_owner), db: AsyncSession = Depends(history_db)):
+    """
+    The chat's edit-and-regenerate branches; `branch_id` null is the original one.
+    """
+    await sync_pending(claims.user_id)
+    chat = await crud_async.get_chat(db, chat_id)
+    if not chat or chat.user_id != claims.user_id:
+        raise chat_not_found()
+    return {"chat_id": chat.chat_uuid, "branches": await crud_async.list_branches(db, chat)}
+
+@app.post("/history/{username}/chats/{chat_id}/fork")
+async def fork_chat(chat_id: str, fork: ChatFork, claims: tokens.Claims = Depends(history_owner), db: AsyncSession = Depends(history_db)):
+    """
+    Replaces the conversation from `position` on with `messages` on a new
+    branch. The first `position` messages are shared, not copied, and the
+    old tail stays available as its own branch.
+    """
+    # Queued saves belong to the branch they were made on
+    await sync_pending(claims.user_id)
+    chat = await crud_async.get_chat(db, chat_id)
+    if not chat or chat.user_id != claims.user_id:
+        raise chat_not_found()
+    count, conflict = await crud_async.fork_chat(db, chat, fork.position, fork.messages)
+    if conflict:
+        await db.rollback()
+        raise HTTPException(status_code=409, detail=conflict)
+    branch_id = chat.branch_id
+    await db.commit()
+    return {"status": "forked", "branch_id": branch_id, "count": count}
+
+@app.put("/history/{username}/chats/{chat_id}/branch")
+async def switch_branch(chat_id: str, switch: BranchSwitch, claims: tokens.Claims = Depends(history_owner), db: AsyncSession = Depends(history_db)):
+    """
+    Makes another branch the one the chat reads as; fetch its messages next.
+    """
+    await sync_pending(claims.user_id)
+    chat = await crud_async.get_chat(db, chat_id)
+    if not chat or chat.user_id != claims.user_id:
+        raise chat_not_found()
+    try:
+        count = await crud_async.switch_branch(db, chat, switch.branch_id)
+    except crud.UnknownBranch:
+        raise HTTPException(status_code=404, detail="Branch not found")
+    await db.commit()
+    return {"status": "switched", "branch_id": switch.branch_id, "count": count}
+
+@app.get("/search/{username}")
+async def search_history(q: str, limit: int = Query(20, ge=1, le=100), offset: int = Query(0, ge=0), claims: tokens.Claims = Depends(history_owner), db: AsyncSession = Depends(history_db)):
+    """
+    Ranked full-text search over one user's messages, with highlighted snippets.
+    """
+    await sync_pending(claims.user_id)
+    if not await crud_async.search_enabled(db):
+        raise HTTPException(status_code=501, detail="Search index not available")
+
+    results = await crud_async.search_messages(db, claims.user_id, q, limit + 1, offset)
+    next_offset = None
+    if len(results) > limit:
+        results = results[:limit]
+        next_offset = offset + limit
+    return {"results": results, "next_offset": next_offset}
+
 @app.post("/history/save")
-def save_chat(chat_data: ChatData, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.username == chat_data.username).first()
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    # Check if chat exists
-    chat = db.query(Chat).filter(Chat.chat_uuid == chat_data.chat_id).first()
-    
-    if chat:
-        # Update existing
-        chat.title = chat_data.title
-        chat.messages = chat_data.messages
-    else:
-        # Create new
-        chat = Chat(
-            chat_uuid=chat_data.chat_id,
-            user_id=user.id,
-            title=chat_data.title,
-            messages=chat_data.messages
-        )
-        db.add(chat)
-    
-    db.commit()
+async def save_chat(chat_data: ChatData, claims: tokens.Claims = Depends(authenticated), db: AsyncSession = Depends(history_db)):
+    require_owner(claims, chat_data.username)
+    if write_queue is not None:
+        # Coalesced with later saves of this chat and written in the next batch
+        # (a chat id that turns out to be someone else's is dropped there)
+        write_queue.put(claims.user_id, chat_data.chat_id, chat_data.title, chat_data.messages)
+        queue_title(claims.user_id, chat_data.chat_id, chat_data.title)
+        return {"status": "queued"}
+
+    # Only the messages past what is already stored get written
+    try:
+        await crud_async.store_chat(db, claims.user_id, chat_data.chat_id, chat_data.title, chat_data.messages)
+    except crud.ForeignChat:
+        raise chat_not_found()
+    await db.commit()
+    queue_title(claims.user_id, chat_data.chat_id, chat_data.title)
     return {"status": "saved"}
 
+@app.post("/history/append")
+async def append_chat(chat_data: ChatAppend, claims: tokens.Claims = Depends(authenticated), db: AsyncSession = Depends(history_db)):
+    """
+    Appends new messages to a chat without resending the conversation.
+    """
+    require_owner(claims, chat_data.username)
+    await sync_pending(claims.user_id)
+    try:
+        count, conflict = await crud_async.append_chat(
+            db, claims.user_id, chat_data.chat_id, chat_data.title, chat_data.messages, chat_data.start
+        )
+    except crud.ForeignChat:
+        raise chat_not_found()
+    if conflict:
+        await db.rollback()
+        raise HTTPException(status_code=409, detail=conflict)
+    await db.commit()
+    queue_title(claims.user_id, chat_data.chat_id, chat_data.title)
+    return {"status": "saved", "count": count}
+
 @app.delete("/history/{username}")
-def clear_history(username: str, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.username == username).first()
-    if user:
-        # Delete all chats for this user
-        db.query(Chat).filter(Chat.user_id == user.id).delete()
-        db.commit()
-        return {"status": "cleared"}
-    
-    raise HTTPException(status_code=404, detail="User not found")
+async def clear_history(claims: tokens.Claims = Depends(history_owner), db: AsyncSession = Depends(history_db)):
+    # Queued saves must land before the delete, not after it
+    await sync_pending(claims.user_id)
+    # Delete all chats (and their messages) for this user
+    await crud_async.delete_user_chats(db, claims.user_id)
+    await db.commit()
+    return {"status": "cleared"}
 
 @app.post("/chat")
-async def chat_endpoint(request: ChatRequest):
+async def chat_endpoint(request: ChatRequest, http_request: Request, accept: Optional[str] = Header(None), authorization: Optional[str] = Header(None)):
     """
     Handles streaming chat responses based on the selected mode.
+    Plain text by default; send Accept: application/x-ndjson or
+    text/event-stream for the resumable event stream (see streaming.py).
     """
+    started = time.perf_counter()
     mode = request.mode
-    messages = request.messages
     
     # Mode-based configuration
-    if mode == "Fast AI":
-        system_prompt = "You are a helpful AI assistant. Provide extremely brief and concise answers."
-        temperature = 0.2
-    elif mode == "Deep Search":
-        system_prompt = "You are a detail-oriented AI assistant. Break down your answer into clear, logical steps and provide in-depth reasoning."
-        temperature = 0.4
-    elif mode == "Creative Mode":
-        system_prompt = "You are a creative and imaginative AI assistant. Use expressive language, metaphors, and vibrant descriptions."
-        temperature = 0.8
+    settings = modes.get_mode(mode)
+    system_prompt = settings["system_prompt"]
+    temperature = settings["temperature"]
+
+    claims = None
+    if authorization is not None:
+        # A body username could name anyone; only a signed token picks the user's budget
+        claims = authenticated(authorization)
+        identity = f"user:{claims.user_id}"
     else:
-        system_prompt = "You are a helpful AI assistant."
-        temperature = 0.5
+        identity = http_request.client.host if http_request.client else "anonymous"
+    try:
+        await limiter.check(identity, mode if mode in modes.MODES else "default", settings)
+    except ratelimit.RateLimited as e:
+        raise too_many_requests(e)
 
-    async def generate_response():
+    # Snippets of the user's other chats, taken out of the mode's budget
+    recalled = None
+    if request.memory and memory_store is not None and claims is not None:
+        recalled = await memory_store.recall(claims.user_id, request.messages, request.chat_id, memory.budget_for(settings["context_budget"]))
+    budget = settings["context_budget"] - (recalled[1] if recalled else 0)
+
+    # Keep the prompt inside the mode's token budget
+    messages, prompt_stats = context.build_prompt(system_prompt, request.messages, budget)
+    if recalled:
+        memory_message, memory_tokens, prompt_stats["memory_snippets"] = recalled
+        messages.insert(1, memory_message)
+        prompt_stats["prompt_tokens"] += memory_tokens
+
+    async def produce(generation: Generation, cache_key: Optional[str], lease):
+        # The mode's route picks the model, hedging/failing over to its fallback
+        completion = routing.RoutedCompletion(routing.get_route(mode), messages, temperature, mode)
         try:
-            stream = client.chat.completions.create(
-                model="llama-3.1-8b-instant",
-                messages=[{"role": "system", "content": system_prompt}] + messages,
-                temperature=temperature,
-                stream=True
-            )
-            for chunk in stream:
-                if chunk.choices and chunk.choices[0].delta.content:
-                    yield chunk.choices[0].delta.content
+            # Async client: awaiting tokens yields the event loop to other requests
+            first_token_at = None
+            chunks = 0
+            async for text in completion.stream():
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                    metrics.chat_ttft.observe(first_token_at - started, mode=mode)
+                chunks += 1
+                generation.publish(text)
+            usage = completion.usage
+            if usage is not None:
+                usage = {"prompt_tokens": usage.prompt_tokens, "completion_tokens": usage.completion_tokens, "total_tokens": usage.total_tokens}
+            else:
+                usage = {"prompt_tokens": prompt_stats["prompt_tokens"], "completion_tokens": chunks}
+            usage.update(model=completion.target["model"], provider=completion.target["provider"],
+                         hedged=completion.hedged, failed_over=completion.failed_over)
+            generation.finish(usage=usage)
+
+            finished_at = time.perf_counter()
+            metrics.chat_stream_duration.observe(finished_at - started, mode=mode)
+            if first_token_at is not None and finished_at > first_token_at:
+                completion_tokens = usage["completion_tokens"]
+                metrics.chat_tokens_per_second.observe(completion_tokens / (finished_at - first_token_at), mode=mode)
         except Exception as e:
-            yield f"Error: {str(e)}"
+            metrics.chat_errors.inc(mode=mode)
+            generation.finish(error=e)
+        finally:
+            if not generation.done:
+                generation.finish(error=asyncio.CancelledError())
+            # Stops any attempt still streaming and hands its connection back to the pool
+            await completion.close()
+            await limiter.release(lease)
+            if cache_key is not None:
+                chat_cache.complete(cache_key, generation)
+
+    # The upstream call runs as its own task, so identical requests arriving
+    # while it streams can read the same generation, and a client that
+    # disconnects can come back for the rest
+    if chat_cache is None:
+        status = "uncached"
+        # Waits (bounded) for a global upstream slot, or turns the request away
+        try:
+            lease = await limiter.acquire()
+        except ratelimit.RateLimited as e:
+            raise too_many_requests(e)
+        generation = Generation()
+        spawn(produce(generation, None, lease))
+    else:
+        key = response_cache.cache_key(mode, temperature, messages)
+        status, found = chat_cache.lookup(key)
+        if status == "hit":
+            generation = Generation.completed(found, usage={"prompt_tokens": prompt_stats["prompt_tokens"], "completion_tokens": len(found)})
+        else:
+            generation = found
+            if status == "miss":
+                try:
+                    lease = await limiter.acquire()
+                except ratelimit.RateLimited as e:
+                    # Requests that joined while this one queued see the rejection too
+                    generation.finish(error=e)
+                    chat_cache.complete(key, generation)
+                    raise too_many_requests(e)
+                spawn(produce(generation, key, lease))
+    metrics.chat_lookups.inc(mode=mode, cache=status)
+    # Identical requests share a generation; each requester may resume it
+    generation.owners.add(claims.user_id if claims is not None else None)
+    generations.add(generation)
+
+    headers = {
+        "X-Generation-Id": generation.id,
+        "X-Prompt-Tokens": str(prompt_stats["prompt_tokens"]),
+        "X-Prompt-Tokens-Original": str(prompt_stats["original_tokens"]),
+        "X-Context-Dropped-Messages": str(prompt_stats["dropped_messages"]),
+    }
+    return stream_response(generation, streaming.negotiate(accept), 0, headers, {"cache": status, "mode": mode, **prompt_stats})
+
+def stream_response(generation: Generation, fmt: str, offset: int, headers, meta=None):
+    if fmt == streaming.TEXT:
+        return StreamingResponse(streaming.text_stream(generation, offset), media_type="text/plain", headers=headers)
+    # No proxy buffering, so each event reaches the client as it is sent
+    headers = {**headers, "Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(streaming.event_stream(generation, fmt, offset, meta), media_type=fmt, headers=headers)
+
+@app.get("/chat/{generation_id}")
+async def resume_chat(generation_id: str, offset: Optional[int] = Query(None, ge=0), accept: Optional[str] = Header(None), last_event_id: Optional[str] = Header(None), authorization: Optional[str] = Header(None)):
+    """
+    Re-attaches to a generation started by /chat, from token `offset` (or an
+    SSE Last-Event-ID). Generations are kept for CHAT_RESUME_TTL seconds
+    after they finish. Needs the session token the /chat request was sent
+    with, if any.
+    """
+    user_id = authenticated(authorization).user_id if authorization is not None else None
+    generation = generations.get(generation_id)
+    # Someone else's generation looks the same as a missing one
+    if generation is None or user_id not in generation.owners:
+        raise HTTPException(status_code=404, detail="Generation not found or expired")
+    if offset is None:
+        try:
+            offset = int(last_event_id) if last_event_id else 0
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid Last-Event-ID")
+    if offset > len(generation.chunks) and generation.done:
+        raise HTTPException(status_code=416, detail=f"Generation has {len(generation.chunks)} tokens")
+    metrics.chat_resumes.inc()
+    return stream_response(generation, streaming.negotiate(accept), offset, {"X-Generation-Id": generation.id}, {"resumed": True})
+
+@app.get("/metrics")
+def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
-    return StreamingResponse(generate_response(), media_type="text/plain")
+@app.get("/cache/stats")
+def cache_stats():
+    if chat_cache is None:
+        return {"enabled": False}
+    return chat_cache.stats()
 
 if __name__ == "__main__":
     import uvicorn
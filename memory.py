@@ -0,0 +1,289 @@
+"""
+Cross-chat memory for /chat: the snippets of a user's other chats most
+relevant to the latest message, found with BM25 over an in-process index,
+are sent along as extra context within a token budget.
+
+Opt-in twice: the server needs CHAT_MEMORY=1, and each request asks for it
+with "memory": true and a session token (whose history to search).
+
+There is one index per user. It is built from the database on the first
+request that needs it and kept for later ones (at most MEMORY_MAX_USERS,
+least recently used dropped). The index records the history version it
+reflects. Each request compares that version with the user's current one
+and reads only the changes since: new messages of chats that stayed on the
+same branch, and whole chats that switched branch. Saves made through
+other workers are picked up the same way. A cleared history is rebuilt.
+Chats still in the legacy JSON column are skipped until migrate.py moves
+them.
+
+Every message is a document. Each term's postings are growable typed
+arrays, so a query scores all of a term's documents in one NumPy
+expression. Only ids and counts are kept in memory; the text of the
+winning snippets is read back from the database.
+"""
+import asyncio
+import math
+import os
+import re
+import time
+from array import array
+from collections import Counter, OrderedDict
+
+import numpy as np
+
+import context
+import crud_async
+import metrics
+from models import User
+
+CHAT_MEMORY = os.getenv("CHAT_MEMORY", "0") == "1"
+MEMORY_TOP_K = int(os.getenv("MEMORY_TOP_K", "5"))
+# Prompt tokens the snippets may use: this many, but no more than
+# MEMORY_SHARE of the mode's context budget
+MEMORY_TOKEN_BUDGET = int(os.getenv("MEMORY_TOKEN_BUDGET", "512"))
+MEMORY_SHARE = float(os.getenv("MEMORY_SHARE", "0.2"))
+MEMORY_SNIPPET_TOKENS = int(os.getenv("MEMORY_SNIPPET_TOKENS", "80"))
+# BM25 score a snippet needs to be sent. Scores grow with the history
+# (rarer terms weigh more), so the default keeps any match
+MEMORY_MIN_SCORE = float(os.getenv("MEMORY_MIN_SCORE", "0"))
+MEMORY_MAX_USERS = int(os.getenv("MEMORY_MAX_USERS", "200"))
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+MAX_QUERY_TERMS = 32
+HEADER = "Excerpts from the user's earlier conversations that may be relevant (they may be out of date):"
+
+_TERM_RE = re.compile(r"\w+", re.UNICODE)
+STOPWORDS = frozenset("""
+a an and are as at be but by can do does for from has have how i if in is it its me my no not of on or
+so that the their them then there these they this to was we what when where which who why will with
+you your
+""".split())
+
+
+def terms(text: str):
+    return [t for t in _TERM_RE.findall(text.lower()) if len(t) > 1 and t not in STOPWORDS]
+
+
+def budget_for(context_budget: int) -> int:
+    return min(MEMORY_TOKEN_BUDGET, int(context_budget * MEMORY_SHARE))
+
+
+class ChatState:
+    __slots__ = ("slot", "title", "branch_id", "count", "docs")
+
+    def __init__(self, slot, title, branch_id):
+        self.slot = slot
+        self.title = title
+        self.branch_id = branch_id
+        self.count = 0  # messages indexed: the next new one is at this position
+        self.docs = []
+
+
+class UserIndex:
+    """
+    BM25 index over one user's messages. Documents are only appended or
+    tombstoned, never renumbered, so postings stay valid as chats change.
+    """
+
+    def __init__(self, version):
+        self.version = version  # user's history_version this index reflects
+        self.postings = {}  # term -> (array of doc ids, array of term counts)
+        self.lengths = array("f")
+        self.message_ids = array("q")
+        self.chat_slots = array("i")
+        self.alive = bytearray()
+        self.chats = {}  # chat uuid -> ChatState
+        self.slots = []  # chat slot -> ChatState
+        self.live = 0
+        self.dead = 0
+        self.total_length = 0.0
+
+    @property
+    def stale(self):
+        # Tombstones only grow; past this, a rebuild is cheaper than scoring them
+        return self.dead > max(self.live, 1000)
+
+    def chat(self, chat_uuid, title, branch_id):
+        state = self.chats.get(chat_uuid)
+        if state is None:
+            state = self.chats[chat_uuid] = ChatState(len(self.slots), title, branch_id)
+            self.slots.append(state)
+        state.title = title
+        return state
+
+    def drop_chat(self, chat_uuid):
+        state = self.chats.get(chat_uuid)
+        if state is None:
+            return
+        for doc in state.docs:
+            self.alive[doc] = 0
+            self.total_length -= self.lengths[doc]
+        self.live -= len(state.docs)
+        self.dead += len(state.docs)
+        state.docs, state.count = [], 0
+
+    def add(self, rows):
+        """
+        Indexes (chat_uuid, title, branch_id, message id, position, content)
+        rows, in position order per chat.
+        """
+        for chat_uuid, title, branch_id, message_id, position, content in rows:
+            state = self.chat(chat_uuid, title, branch_id)
+            if position < state.count:
+                continue  # already indexed
+            doc = len(self.lengths)
+            counts = Counter(terms(content or ""))
+            for term, n in counts.items():
+                entry = self.postings.get(term)
+                if entry is None:
+                    entry = self.postings[term] = (array("i"), array("f"))
+                entry[0].append(doc)
+                entry[1].append(n)
+            length = sum(counts.values())
+            self.lengths.append(length)
+            self.message_ids.append(message_id)
+            self.chat_slots.append(state.slot)
+            self.alive.append(1)
+            state.docs.append(doc)
+            state.count = position + 1
+            self.live += 1
+            self.total_length += length
+
+    def search(self, query_terms, k, exclude_chat=None):
+        """
+        [(score, message id, ChatState)] of the k best documents, best first.
+        """
+        if not self.live:
+            return []
+        # Views over the arrays (no copy); released before the next add()
+        alive = np.frombuffer(self.alive, dtype=np.uint8).view(bool)
+        lengths = np.frombuffer(self.lengths, dtype=np.float32)
+        avgdl = max(self.total_length / self.live, 1.0)
+        # Length normalization of every document, once per query rather than per term
+        norm = (BM25_K1 * (1 - BM25_B) + (BM25_K1 * BM25_B / avgdl) * lengths).astype(np.float32)
+        scores = np.zeros(len(self.lengths), dtype=np.float32)
+        for term in set(query_terms):
+            entry = self.postings.get(term)
+            if entry is None:
+                continue
+            ids = np.frombuffer(entry[0], dtype=np.int32)
+            tf = np.frombuffer(entry[1], dtype=np.float32)
+            df = np.count_nonzero(alive[ids]) if self.dead else len(ids)
+            if not df:
+                continue
+            idf = math.log1p((self.live - df + 0.5) / (df + 0.5))
+            # Doc ids are unique within a posting list, so += needs no add.at
+            scores[ids] += (idf * (BM25_K1 + 1)) * tf / (tf + norm[ids])
+        if self.dead:
+            scores[~alive] = 0
+        excluded = self.chats.get(exclude_chat) if exclude_chat else None
+        if excluded is not None:
+            scores[np.frombuffer(self.chat_slots, dtype=np.int32) == excluded.slot] = 0
+
+        candidates = np.flatnonzero(scores >= max(MEMORY_MIN_SCORE, 1e-6))
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        best = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [(float(scores[d]), self.message_ids[d], self.slots[self.chat_slots[d]]) for d in best.tolist()]
+
+
+def _build(version, rows):
+    index = UserIndex(version)
+    index.add(rows)
+    return index
+
+
+class MemoryStore:
+    """
+    Per-process cache of user indexes, kept current against the user's
+    history version and queried by /chat.
+    """
+
+    def __init__(self, session_factory, before_read=None, max_users=MEMORY_MAX_USERS):
+        # user id -> async sessionmaker of the database holding that user's chats
+        self.session_factory = session_factory
+        # Awaited with the user id before reading, e.g. to flush queued saves
+        self.before_read = before_read
+        self.max_users = max_users
+        self._indexes = OrderedDict()  # user id -> UserIndex, least recently used first
+        self._locks = {}  # user id -> asyncio.Lock, so one request at a time updates an index
+
+    async def recall(self, user_id, messages, exclude_chat, budget):
+        """
+        (system message, its tokens, snippet count) with the snippets of the
+        user's other chats that best match the latest user message, or None.
+        """
+        query = next((str(m.get("content") or "") for m in reversed(messages) if m.get("role") == "user"), "")
+        query_terms = terms(query)[:MAX_QUERY_TERMS]
+        if not query_terms or budget <= context.count_tokens(HEADER) + context.MESSAGE_OVERHEAD:
+            return None
+
+        started = time.perf_counter()
+        if self.before_read is not None:
+            await self.before_read(user_id)
+        lock = self._locks.setdefault(user_id, asyncio.Lock())
+        async with lock:
+            async with self.session_factory(user_id)() as db:
+                index = await self._refresh(db, user_id)
+                # A few spare hits, for when the best ones do not fit the budget
+                hits = index.search(query_terms, MEMORY_TOP_K * 2, exclude_chat) if index is not None else []
+                contents = dict(await crud_async.get_message_contents(db, [message_id for _, message_id, _ in hits])) if hits else {}
+        metrics.chat_memory_recall.observe(time.perf_counter() - started)
+
+        lines, used = [], context.count_tokens(HEADER) + context.MESSAGE_OVERHEAD
+        for _, message_id, chat in hits:
+            content = contents.get(message_id)
+            if not content:
+                continue
+            line = f"- [{chat.title}] {context.truncate(' '.join(content.split()), MEMORY_SNIPPET_TOKENS)}"
+            tokens = context.count_tokens(line)
+            if used + tokens > budget:
+                continue
+            lines.append(line)
+            used += tokens
+            if len(lines) >= MEMORY_TOP_K:
+                break
+        metrics.chat_memory_snippets.observe(len(lines))
+        if not lines:
+            return None
+        return {"role": "system", "content": HEADER + "\n" + "\n".join(lines)}, used, len(lines)
+
+    async def _refresh(self, db, user_id):
+        user = await db.get(User, user_id)
+        if user is None:
+            return None
+        # Read before the chats, as /history/{username}/changes does: a write
+        # landing in between is read again next time, never missed
+        version, cleared = user.history_version, user.cleared_version
+        index = self._indexes.get(user_id)
+        if index is not None and (index.stale or cleared > index.version or version < index.version):
+            index = None
+
+        if index is None:
+            rows = await crud_async.get_memory_rows(db, user_id)
+            # Tokenizing a long history takes a while; keep it off the event loop
+            index = await asyncio.to_thread(_build, version, rows)
+            metrics.chat_memory_builds.inc()
+        elif version > index.version:
+            starts = {}  # chat id -> first position to read
+            for chat_id, chat_uuid, title, branch_id in await crud_async.get_changed_chat_heads(db, user_id, index.version):
+                state = index.chats.get(chat_uuid)
+                if state is not None and state.branch_id != branch_id:
+                    # Another branch reads differently from its fork point on; reindex it whole
+                    index.drop_chat(chat_uuid)
+                state = index.chat(chat_uuid, title, branch_id)
+                state.branch_id = branch_id
+                starts[chat_id] = state.count
+            if starts:
+                index.add(await crud_async.get_memory_rows(db, user_id, starts))
+            index.version = version
+
+        self._indexes[user_id] = index
+        self._indexes.move_to_end(user_id)
+        while len(self._indexes) > self.max_users:
+            evicted, _ = self._indexes.popitem(last=False)
+            lock = self._locks.get(evicted)
+            if lock is not None and not lock.locked():
+                del self._locks[evicted]
+        return index
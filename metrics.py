@@ -0,0 +1,239 @@
+"""
+Minimal Prometheus instrumentation: counters, gauges and histograms with
+labels, rendered in the text exposition format served at /metrics.
+"""
+import contextvars
+import threading
+import time
+from sqlalchemy import event
+from starlette.routing import Match
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+RATE_BUCKETS = (5, 10, 25, 50, 100, 200, 400, 800, 1600)
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.extend(self._render_sample(key, value))
+        return lines
+
+    def _render_sample(self, key, value):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def _render_sample(self, key, state):
+        counts, total, count = state
+        lines, cumulative = [], 0
+        for bound, n in zip(self.buckets, counts):
+            cumulative += n
+            labels = _format_labels(self.labelnames, key, ("le", _format_value(bound)))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# --- HTTP ---
+http_requests = Counter("http_requests_total", "HTTP requests by route, method and status.", ("route", "method", "status"))
+http_latency = Histogram("http_request_duration_seconds", "Time to send the full response, by route.", ("route", "method"))
+http_in_flight = Gauge("http_requests_in_flight", "Requests currently being served, by route.", ("route",))
+http_compression_bytes = Counter("http_compression_bytes_total", "Response bytes before (raw) and after (sent) compression, by encoding.", ("encoding", "stage"))
+
+# --- /chat streaming (measured on the upstream generation) ---
+chat_lookups = Counter("chat_requests_total", "/chat requests by mode and cache result (hit, join, miss, uncached).", ("mode", "cache"))
+chat_ttft = Histogram("chat_time_to_first_token_seconds", "Time from request to the first upstream token.", ("mode",))
+chat_stream_duration = Histogram("chat_stream_duration_seconds", "Time from request to the end of the upstream stream.", ("mode",))
+chat_tokens_per_second = Histogram("chat_tokens_per_second", "Completion tokens per second after the first token.", ("mode",), RATE_BUCKETS)
+chat_errors = Counter("chat_upstream_errors_total", "Upstream generations that failed, by mode.", ("mode",))
+chat_resumes = Counter("chat_stream_resumes_total", "Streams re-attached to a buffered generation via /chat/{id}.")
+chat_served = Counter("chat_generations_served_total", "Generations by the provider and model that served them.", ("mode", "provider", "model"))
+chat_hedges = Counter("chat_hedges_total", "Generations hedged to the fallback model after missing the TTFT SLO.", ("mode",))
+chat_titles = Counter("chat_titles_total", "Chat titles generated in the background, by method (llm, truncate).", ("method",))
+chat_failovers = Counter("chat_failovers_total", "Generations that failed over to the fallback after a primary error.", ("mode",))
+
+# --- Upstream admission control ---
+chat_rejections = Counter("chat_rejected_total", "/chat requests turned away with a 429, by reason (rate_limited, queue_full, queue_timeout).", ("reason",))
+chat_queue_wait = Histogram("chat_queue_wait_seconds", "Time a /chat request waited for an upstream slot.")
+chat_queue_depth = Gauge("chat_queue_depth", "/chat requests waiting for an upstream slot.")
+chat_upstream_active = Gauge("chat_upstream_active", "Upstream generations holding a slot.")
+
+# --- Cross-chat memory ---
+chat_memory_recall = Histogram("chat_memory_recall_seconds", "Time to bring a user's memory index up to date and query it, per /chat request.", (), QUERY_BUCKETS)
+chat_memory_snippets = Histogram("chat_memory_snippets", "Snippets of other chats added to a /chat prompt.", (), COUNT_BUCKETS)
+chat_memory_builds = Counter("chat_memory_index_builds_total", "Memory indexes built from scratch (first use, eviction or a cleared history).")
+
+# --- Database ---
+db_query_duration = Histogram("db_query_duration_seconds", "Duration of individual SQL statements, by route.", ("route",), QUERY_BUCKETS)
+db_queries_per_request = Histogram("db_queries_per_request", "SQL statements executed per request, by route.", ("route",), COUNT_BUCKETS)
+db_time_per_request = Histogram("db_time_per_request_seconds", "Total SQL time per request, by route.", ("route",), QUERY_BUCKETS)
+
+
+class _RequestStats:
+    __slots__ = ("route", "queries", "query_time")
+
+    def __init__(self, route):
+        self.route = route
+        self.queries = 0
+        self.query_time = 0.0
+
+
+# Per-request stats. Starlette copies the context into threadpool workers,
+# so sync handlers and get_db update the same object.
+_request_stats = contextvars.ContextVar("request_stats", default=None)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware timing each request until its last body chunk is sent,
+    so streamed /chat responses are measured end to end. Requests are
+    labelled with their route template (/history/{username}), not the raw
+    path, to keep label cardinality bounded.
+    """
+
+    def __init__(self, app, router):
+        self.app = app
+        self.router = router
+
+    def route_of(self, scope):
+        for route in self.router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.path
+        return "unmatched"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        route = self.route_of(scope)
+        method = scope["method"]
+        stats = _RequestStats(route)
+        token = _request_stats.set(stats)
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        http_in_flight.inc(route=route)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            http_in_flight.dec(route=route)
+            http_latency.observe(time.perf_counter() - start, route=route, method=method)
+            http_requests.inc(route=route, method=method, status=status["code"])
+            db_queries_per_request.observe(stats.queries, route=route)
+            db_time_per_request.observe(stats.query_time, route=route)
+            _request_stats.reset(token)
+
+
+def instrument_engine(engine):
+    """
+    Hooks statement timing into a SQLAlchemy engine. Statements outside a
+    request (e.g. the write-behind thread) are labelled "background".
+    """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        stats = _request_stats.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.query_time += elapsed
+        db_query_duration.observe(elapsed, route=stats.route if stats is not None else "background")
@@ -0,0 +1,184 @@
+"""
+Data migrations for chatbot.db. Safe to run repeatedly:
+
+    python migrate.py
+    python migrate.py --retrain-dictionary   # new zstd dictionary, recompress every message
+
+With DB_SHARDS set, schema changes and compression apply to every shard too.
+"""
+import sys
+from sqlalchemy import bindparam, func, inspect, select, text, update
+from database import engine, SessionLocal, Base, all_databases
+from models import Chat, Message, User
+import codec
+import crud
+import search
+
+
+def add_missing_columns(bind=engine):
+    """
+    create_all only creates missing tables, so columns added to existing
+    tables are applied here.
+    """
+    columns = {c["name"] for c in inspect(bind).get_columns("chats")}
+    user_columns = {c["name"] for c in inspect(bind).get_columns("users")}
+    message_columns = {c["name"] for c in inspect(bind).get_columns("messages")}
+    with bind.begin() as conn:
+        if "updated_at" not in columns:
+            conn.execute(text("ALTER TABLE chats ADD COLUMN updated_at TIMESTAMP"))
+            conn.execute(text("UPDATE chats SET updated_at = CURRENT_TIMESTAMP WHERE updated_at IS NULL"))
+            print("Added chats.updated_at")
+        if "version" not in columns:
+            conn.execute(text("ALTER TABLE chats ADD COLUMN version INTEGER NOT NULL DEFAULT 0"))
+            print("Added chats.version")
+        if "branch_id" not in columns:
+            conn.execute(text("ALTER TABLE chats ADD COLUMN branch_id INTEGER"))
+            print("Added chats.branch_id")
+        if "branch_id" not in message_columns:
+            conn.execute(text("ALTER TABLE messages ADD COLUMN branch_id INTEGER REFERENCES branches(id)"))
+            print("Added messages.branch_id")
+        if "active" not in message_columns:
+            conn.execute(text("ALTER TABLE messages ADD COLUMN active BOOLEAN NOT NULL DEFAULT TRUE"))
+            print("Added messages.active")
+        for name in ("history_version", "cleared_version"):
+            if name not in user_columns:
+                conn.execute(text(f"ALTER TABLE users ADD COLUMN {name} INTEGER NOT NULL DEFAULT 0"))
+                print(f"Added users.{name}")
+    for index in Chat.__table__.indexes:
+        index.create(bind=bind, checkfirst=True)
+
+
+def migrate_json_messages(db, batch_size=200):
+    """
+    Moves Chat.messages JSON blobs into the messages table, one batch per
+    transaction, and returns the number of chats migrated.
+    """
+    migrated = 0
+    while True:
+        chats = db.query(Chat).filter(Chat.legacy_messages.isnot(None)).order_by(Chat.id).limit(batch_size).all()
+        if not chats:
+            return migrated
+        for chat in chats:
+            crud.materialize_legacy(db, chat)
+        db.commit()
+        migrated += len(chats)
+        print(f"Migrated {migrated} chats to the messages table...")
+
+
+def version_chats(db):
+    """
+    Gives chats still at version 0 (saved before history versions existed,
+    e.g. a legacy database) a version past their user's history_version, so
+    /history/{username}/changes sends them. Returns the number versioned.
+    """
+    users = User.__table__
+    chats = Chat.__table__
+    statement = update(chats).where(chats.c.id == bindparam("chat_id")).values(version=bindparam("new_version"))
+    versioned = 0
+    for user_id in list(db.scalars(select(chats.c.user_id).where(chats.c.version == 0).distinct())):
+        chat_ids = list(db.scalars(select(chats.c.id).where(chats.c.user_id == user_id, chats.c.version == 0).order_by(chats.c.id)))
+        # One version per chat, so a page of changes can end after any of them
+        last = db.execute(
+            update(users).where(users.c.id == user_id)
+            .values(history_version=users.c.history_version + len(chat_ids)).returning(users.c.history_version)
+        ).scalar_one_or_none()
+        if last is None:
+            continue  # no users row in this shard yet; rebalance_shards.py adds it
+        first = last - len(chat_ids) + 1
+        db.execute(statement, [{"chat_id": chat_id, "new_version": first + i} for i, chat_id in enumerate(chat_ids)])
+        db.commit()
+        versioned += len(chat_ids)
+    return versioned
+
+
+def compress_messages(db, recompress=False, batch_size=500):
+    """
+    Rewrites stored message content through codec.CompressedText: plain
+    TEXT rows long enough to compress, or with `recompress` every row
+    (e.g. after training a new dictionary). Returns the number rewritten.
+    """
+    if not codec.enabled(engine.dialect):
+        return 0
+    table = Message.__table__
+    query = select(table.c.id, table.c.content).order_by(table.c.id).limit(batch_size)
+    if not recompress:
+        query = query.where(
+            func.typeof(table.c.content) == "text",
+            func.length(table.c.content) >= codec.MESSAGE_COMPRESSION_MIN_BYTES,
+        )
+    statement = update(table).where(table.c.id == bindparam("row_id")).values(content=bindparam("new_content"))
+    rewritten, last = 0, 0
+    while True:
+        rows = db.execute(query.where(table.c.id > last)).all()
+        if not rows:
+            return rewritten
+        db.execute(statement, [{"row_id": r.id, "new_content": r.content} for r in rows])
+        db.commit()
+        rewritten += len(rows)
+        last = rows[-1].id
+        print(f"Compressed {rewritten} messages...")
+
+
+def upgrade_schema():
+    for target in all_databases():
+        Base.metadata.create_all(bind=target.engine)
+        add_missing_columns(target.engine)
+        search.create_index(target.engine)
+
+
+def largest_history():
+    """
+    The database (main or shard) holding the most messages.
+    """
+    counts = {}
+    for target in all_databases():
+        with target.engine.connect() as conn:
+            counts[target] = conn.execute(select(func.count(Message.id))).scalar()
+    return max(counts, key=counts.get)
+
+
+def run():
+    upgrade_schema()
+    db = SessionLocal()
+    try:
+        count = migrate_json_messages(db)
+        print(f"Done. {count} chats migrated.")
+        versioned = 0
+        for target in all_databases():
+            target_db = target.SessionLocal()
+            try:
+                versioned += version_chats(target_db)
+            finally:
+                target_db.close()
+        if versioned:
+            print(f"Gave {versioned} chats a history version.")
+        if codec.enabled(engine.dialect):
+            retrain = "--retrain-dictionary" in sys.argv
+            codec.load_dictionaries(engine)
+            dict_id = None
+            if retrain or codec.current_dictionary() is None:
+                # Dictionaries live in the main database; with shards, the sample comes from the biggest one
+                sample_db = largest_history().SessionLocal()
+                try:
+                    dict_id = codec.train_dictionary(db, sample_db)
+                finally:
+                    sample_db.close()
+                if dict_id is not None:
+                    print(f"Trained zstd dictionary {dict_id}")
+            # A new dictionary is only worth having if existing rows use it too
+            compressed = 0
+            for target in all_databases():
+                target_db = target.SessionLocal()
+                try:
+                    compressed += compress_messages(target_db, recompress=dict_id is not None)
+                finally:
+                    target_db.close()
+            if compressed:
+                # SQLite keeps the freed pages until VACUUM
+                print(f"Done. {compressed} messages compressed; run VACUUM to shrink the file.")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    run()
@@ -1,14 +1,24 @@
-from sqlalchemy import Column, Integer, String, Text, ForeignKey, JSON
+from sqlalchemy import Column, Integer, BigInteger, Boolean, String, ForeignKey, JSON, Index, DateTime, LargeBinary
 from sqlalchemy.orm import relationship
 from database import Base
+from codec import CompressedText
+from datetime import datetime, timezone
 import uuid
 
+def utcnow():
+    # Naive UTC, so values compare the same on SQLite and Postgres
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
 class User(Base):
     __tablename__ = "users"
 
     id = Column(Integer, primary_key=True, index=True)
     username = Column(String, unique=True, index=True)
     password_hash = Column(String)
+    # Bumped by every change to this user's chats; served as the /history ETag
+    history_version = Column(Integer, default=0, nullable=False)
+    # history_version of the last clear; deltas from before it must start over
+    cleared_version = Column(Integer, default=0, nullable=False)
     
     chats = relationship("Chat", back_populates="owner", cascade="all, delete-orphan")
 
@@ -19,6 +29,89 @@ class Chat(Base):
     chat_uuid = Column(String, unique=True, index=True, default=lambda: str(uuid.uuid4()))
     user_id = Column(Integer, ForeignKey("users.id"))
     title = Column(String, default="New Chat")
-    messages = Column(JSON, default=list)
+    # Legacy JSON blob of the whole conversation. New writes go to the messages
+    # table; migrate.py moves old blobs over and nulls this column.
+    legacy_messages = Column("messages", JSON(none_as_null=True), nullable=True)
+    updated_at = Column(DateTime, default=utcnow, nullable=False)
+    # Owner's history_version when this chat last changed
+    version = Column(Integer, default=0, nullable=False)
+    # Branch the conversation currently follows; NULL is the original branch
+    branch_id = Column(Integer, nullable=True)
 
     owner = relationship("User", back_populates="chats")
+    # The active branch only: what the chat reads as to every history endpoint
+    messages = relationship(
+        "Message", back_populates="chat", order_by="Message.position",
+        primaryjoin="and_(Chat.id == Message.chat_id, Message.active == True)",
+        cascade="all, delete-orphan",
+    )
+
+    __table_args__ = (
+        # Keyset pagination of a user's chats by recency
+        Index("ix_chats_user_updated", "user_id", "updated_at", "id"),
+        # Chats changed since a given version (/history/{username}/changes)
+        Index("ix_chats_user_version", "user_id", "version"),
+    )
+
+class Message(Base):
+    __tablename__ = "messages"
+
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(Integer, ForeignKey("chats.id"), nullable=False)
+    position = Column(Integer, nullable=False)
+    role = Column(String, nullable=False)
+    # zstd-compressed on SQLite, see codec.py
+    content = Column(CompressedText, nullable=False, default="")
+    # Branch that owns this message (NULL: the chat's original branch), and
+    # whether it is on the chat's active branch. Shared prefixes are stored
+    # once, by the branch they were written on.
+    branch_id = Column(Integer, ForeignKey("branches.id"), nullable=True)
+    active = Column(Boolean, default=True, nullable=False)
+
+    chat = relationship("Chat", back_populates="messages")
+
+    __table_args__ = (
+        Index("ix_messages_chat_position", "chat_id", "position"),
+    )
+
+class Branch(Base):
+    """
+    An edit-and-regenerate branch of a chat. It shares the first
+    `fork_position` messages with its parent branch (NULL: the original
+    branch) and owns the messages from there on.
+    """
+    __tablename__ = "branches"
+
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(Integer, ForeignKey("chats.id"), nullable=False, index=True)
+    parent_id = Column(Integer, ForeignKey("branches.id"), nullable=True)
+    fork_position = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=utcnow, nullable=False)
+
+class CompressionDictionary(Base):
+    """
+    zstd dictionaries for message content, keyed by the id zstd writes into
+    each frame. Kept forever: old rows still reference them.
+    """
+    __tablename__ = "compression_dictionaries"
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    data = Column(LargeBinary, nullable=False)
+    created_at = Column(DateTime, default=utcnow, nullable=False)
+
+class ImportCheckpoint(Base):
+    """
+    Progress of import_users.py through a legacy users.json, committed with
+    each batch so an interrupted import resumes where it stopped.
+    """
+    __tablename__ = "import_checkpoints"
+
+    source = Column(String, primary_key=True)
+    size = Column(BigInteger, nullable=False)
+    # Byte offset just past the last fully imported user
+    offset = Column(BigInteger, default=0, nullable=False)
+    users = Column(Integer, default=0, nullable=False)
+    chats = Column(Integer, default=0, nullable=False)
+    messages = Column(Integer, default=0, nullable=False)
+    finished = Column(Boolean, default=False, nullable=False)
+    updated_at = Column(DateTime, default=utcnow, onupdate=utcnow, nullable=False)
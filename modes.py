@@ -0,0 +1,51 @@
+import json
+import os
+
+# Per-mode prompt settings. context_budget is the most prompt tokens (system
+# prompt + history) sent upstream for one /chat request. rate_per_minute and
+# burst size each user's token bucket for the mode (0 = unlimited).
+MODES = {
+    "Fast AI": {
+        "system_prompt": "You are a helpful AI assistant. Provide extremely brief and concise answers.",
+        "temperature": 0.2,
+        "context_budget": 2048,
+        "rate_per_minute": 30,
+        "burst": 10,
+    },
+    "Deep Search": {
+        "system_prompt": "You are a detail-oriented AI assistant. Break down your answer into clear, logical steps and provide in-depth reasoning.",
+        "temperature": 0.4,
+        "context_budget": 6144,
+        "rate_per_minute": 10,
+        "burst": 3,
+    },
+    "Creative Mode": {
+        "system_prompt": "You are a creative and imaginative AI assistant. Use expressive language, metaphors, and vibrant descriptions.",
+        "temperature": 0.8,
+        "context_budget": 4096,
+        "rate_per_minute": 20,
+        "burst": 5,
+    },
+}
+
+DEFAULT_MODE = {
+    "system_prompt": "You are a helpful AI assistant.",
+    "temperature": 0.5,
+    "context_budget": 4096,
+    "rate_per_minute": 20,
+    "burst": 5,
+}
+
+# Budget overrides, e.g. CONTEXT_BUDGETS='{"Fast AI": 1024, "default": 3000}'
+for _name, _budget in json.loads(os.getenv("CONTEXT_BUDGETS", "{}")).items():
+    (DEFAULT_MODE if _name == "default" else MODES[_name])["context_budget"] = int(_budget)
+
+# Rate limit overrides, e.g. CHAT_RATE_LIMITS='{"Deep Search": {"rate_per_minute": 5, "burst": 2}}'
+for _name, _limits in json.loads(os.getenv("CHAT_RATE_LIMITS", "{}")).items():
+    (DEFAULT_MODE if _name == "default" else MODES[_name]).update(
+        {k: float(v) for k, v in _limits.items() if k in ("rate_per_minute", "burst")}
+    )
+
+
+def get_mode(name):
+    return MODES.get(name, DEFAULT_MODE)
@@ -0,0 +1,262 @@
+import asyncio
+import logging
+import math
+import os
+import time
+import uuid
+from collections import deque
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Admission control for upstream LLM calls: a token bucket per (user, mode)
+# sized by the mode's rate_per_minute/burst, and a global cap on generations
+# in flight with a bounded wait queue. Anything over a limit is turned away
+# at once with a 429 and Retry-After instead of piling up upstream.
+CHAT_RATE_LIMIT = os.getenv("CHAT_RATE_LIMIT", "1") == "1"
+CHAT_MAX_CONCURRENCY = int(os.getenv("CHAT_MAX_CONCURRENCY", "128")) # 0 = no global cap
+CHAT_MAX_QUEUE = int(os.getenv("CHAT_MAX_QUEUE", "256"))
+CHAT_QUEUE_TIMEOUT = float(os.getenv("CHAT_QUEUE_TIMEOUT", "5"))
+# "memory" (limits per worker) or a redis:// URL (limits shared by all workers)
+RATE_LIMIT_STORE = os.getenv("RATE_LIMIT_STORE", "memory")
+# A shared slot whose worker died is reclaimed after this long
+CHAT_SLOT_LEASE_TTL = float(os.getenv("CHAT_SLOT_LEASE_TTL", "300"))
+SLOT_POLL_INTERVAL = 0.05
+
+
+class RateLimited(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self):
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+class MemoryStore:
+    """
+    Buckets and slots held in this process, so every worker enforces the
+    limits on its own.
+    """
+
+    MAX_BUCKETS = 100000
+
+    def __init__(self):
+        self._buckets = {} # key -> (tokens, updated_at)
+        self._slots = {} # name -> set of leases
+
+    async def take(self, key, rate, burst):
+        """
+        Takes one token; returns 0 on success, else seconds until one is available.
+        """
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / rate
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.MAX_BUCKETS:
+            self._prune(now)
+        return wait
+
+    def _prune(self, now):
+        # Drop buckets idle for an hour; they have refilled and a new one starts full
+        for key, (tokens, updated) in list(self._buckets.items()):
+            if now - updated > 3600:
+                del self._buckets[key]
+
+    async def acquire_slot(self, name, limit, lease):
+        held = self._slots.setdefault(name, set())
+        if len(held) >= limit:
+            return False
+        held.add(lease)
+        return True
+
+    async def release_slot(self, name, lease):
+        self._slots.get(name, set()).discard(lease)
+
+
+# Bucket state lives in a hash; time comes from the Redis server so workers
+# on different hosts agree on it
+_TAKE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens'))
+local updated = tonumber(redis.call('HGET', KEYS[1], 'updated'))
+if tokens == nil then
+    tokens, updated = burst, now
+end
+tokens = math.min(burst, tokens + (now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+# Slots are a sorted set of leases scored by acquire time; stale leases expire
+_ACQUIRE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - tonumber(ARGV[3]))
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], now, ARGV[2])
+return 1
+"""
+
+
+class RedisStore:
+    """
+    Buckets and slots in Redis, shared by every worker and host. If Redis is
+    unreachable requests are let through rather than failed.
+    """
+
+    def __init__(self, url, prefix="ratelimit:"):
+        import redis.asyncio
+
+        self.redis = redis.asyncio.from_url(url)
+        self.prefix = prefix
+        self._take = self.redis.register_script(_TAKE_SCRIPT)
+        self._acquire = self.redis.register_script(_ACQUIRE_SCRIPT)
+
+    async def take(self, key, rate, burst):
+        try:
+            return float(await self._take(keys=[f"{self.prefix}bucket:{key}"], args=[rate, burst]))
+        except Exception as e:
+            logger.warning("Rate limit store unavailable (%s), allowing request.", e)
+            return 0.0
+
+    async def acquire_slot(self, name, limit, lease):
+        try:
+            return bool(await self._acquire(keys=[f"{self.prefix}slots:{name}"], args=[limit, lease, CHAT_SLOT_LEASE_TTL]))
+        except Exception as e:
+            logger.warning("Rate limit store unavailable (%s), allowing request.", e)
+            return True
+
+    async def release_slot(self, name, lease):
+        try:
+            await self.redis.zrem(f"{self.prefix}slots:{name}", lease)
+        except Exception:
+            pass # The lease expires on its own
+
+
+def make_store(spec=RATE_LIMIT_STORE):
+    if spec.startswith(("redis://", "rediss://", "unix://")):
+        return RedisStore(spec)
+    return MemoryStore()
+
+
+class ConcurrencyGate:
+    """
+    Caps generations in flight across the store. Requests over the cap wait
+    in a FIFO of at most `max_queue`; a full queue or a wait longer than
+    `timeout` raises RateLimited. With a shared store the head of the queue
+    also polls, since slots freed by other workers do not wake it.
+    """
+
+    def __init__(self, store, limit, max_queue=CHAT_MAX_QUEUE, timeout=CHAT_QUEUE_TIMEOUT, name="chat"):
+        self.store = store
+        self.limit = limit
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.name = name
+        self._waiters = deque()
+
+    @property
+    def queued(self):
+        return len(self._waiters)
+
+    async def acquire(self):
+        """
+        Returns a lease to hand back to release().
+        """
+        lease = uuid.uuid4().hex
+        if not self._waiters and await self.store.acquire_slot(self.name, self.limit, lease):
+            metrics.chat_queue_wait.observe(0.0)
+            metrics.chat_upstream_active.inc()
+            return lease
+        if len(self._waiters) >= self.max_queue:
+            raise RateLimited("queue_full", 1)
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        started = time.perf_counter()
+        wakeup = asyncio.Event()
+        self._waiters.append(wakeup)
+        metrics.chat_queue_depth.inc()
+        try:
+            while True:
+                # Cleared before trying, so a release during the attempt is not lost
+                wakeup.clear()
+                head = self._waiters[0] is wakeup
+                if head and await self.store.acquire_slot(self.name, self.limit, lease):
+                    metrics.chat_queue_wait.observe(time.perf_counter() - started)
+                    metrics.chat_upstream_active.inc()
+                    return lease
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise RateLimited("queue_timeout", 1)
+                try:
+                    await asyncio.wait_for(wakeup.wait(), min(remaining, SLOT_POLL_INTERVAL) if head else remaining)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            metrics.chat_queue_depth.dec()
+            was_head = self._waiters[0] is wakeup
+            self._waiters.remove(wakeup)
+            if was_head and self._waiters:
+                # Let the next request try for a slot right away
+                self._waiters[0].set()
+
+    async def release(self, lease):
+        await self.store.release_slot(self.name, lease)
+        metrics.chat_upstream_active.dec()
+        if self._waiters:
+            self._waiters[0].set()
+
+
+class Limiter:
+    def __init__(self, store=None):
+        self.store = store or make_store()
+        self.gate = ConcurrencyGate(self.store, CHAT_MAX_CONCURRENCY) if CHAT_MAX_CONCURRENCY > 0 else None
+
+    async def check(self, identity: str, mode_name: str, settings):
+        """
+        Charges one request to the (identity, mode) bucket. Raises RateLimited
+        when it is empty.
+        """
+        rate = float(settings.get("rate_per_minute", 0)) / 60.0
+        if not CHAT_RATE_LIMIT or rate <= 0:
+            return
+        wait = await self.store.take(f"{identity}|{mode_name}", rate, float(settings.get("burst", 1)))
+        if wait > 0:
+            metrics.chat_rejections.inc(reason="rate_limited")
+            raise RateLimited("rate_limited", wait)
+
+    async def acquire(self):
+        """
+        Waits for a global upstream slot; returns its lease (None when uncapped).
+        """
+        if self.gate is None:
+            return None
+        try:
+            return await self.gate.acquire()
+        except RateLimited as e:
+            metrics.chat_rejections.inc(reason=e.reason)
+            raise
+
+    async def release(self, lease):
+        if lease is not None:
+            await self.gate.release(lease)
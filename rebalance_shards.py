@@ -0,0 +1,215 @@
+"""
+Moves each user's history to the database DB_SHARDS assigns it to:
+
+    python rebalance_shards.py [--dry-run]
+
+Run it with the backend stopped, after turning DB_SHARDS on (history moves
+out of the main database), after changing DB_SHARDS (shard files beyond the
+new count are emptied and can then be deleted), after turning it off again
+(everything moves back to the main database) and after import_users.py.
+Users are placed by a jump consistent hash of their id, so going from n to
+n + 1 shards moves only about 1/(n + 1) of them.
+
+Each user is copied to the target in one transaction and only then removed
+from the source, so an interrupted run is finished by running it again:
+chats already copied are recognised by chat id and not copied twice.
+"""
+import argparse
+import glob
+import os
+import re
+import time
+from sqlalchemy import insert, select, update
+from database import DB_SHARD_DIR, DB_SHARDS, Shard, all_databases, engine, main_shard, shard_for
+from models import User, Chat, Message, Branch
+import codec
+import crud
+import migrate
+import search
+
+BATCH_SIZE = 1000  # messages per INSERT
+
+
+def stray_shards():
+    """
+    Shard files in DB_SHARD_DIR that the current DB_SHARDS does not use,
+    e.g. after lowering it. Their users still need moving.
+    """
+    in_use = {target.url for target in all_databases()}
+    found = []
+    for path in sorted(glob.glob(os.path.join(DB_SHARD_DIR, "shard-*.db"))):
+        match = re.fullmatch(r"shard-(\d+)\.db", os.path.basename(path))
+        url = f"sqlite:///{path}"
+        if match and url not in in_use:
+            found.append(Shard(int(match.group(1)), url))
+    return found
+
+
+def users_with_history(db, is_main):
+    if is_main:
+        # The main database keeps every user's login; only those with chats here move
+        return list(db.scalars(select(Chat.user_id).distinct().order_by(Chat.user_id)))
+    return list(db.scalars(select(User.id).order_by(User.id)))
+
+
+def move_user(source_db, target_db, user_id, source_is_main):
+    """
+    Copies the user's chats, branches and messages into `target_db`, commits,
+    then deletes them from `source_db`. Returns the number of chats copied.
+    """
+    user = source_db.get(User, user_id)
+    known = set(target_db.scalars(select(Chat.chat_uuid).where(Chat.user_id == user_id)))
+    chats = [
+        row for row in source_db.execute(select(Chat.__table__).where(Chat.user_id == user_id).order_by(Chat.id)).mappings()
+        if row["chat_uuid"] not in known
+    ]
+
+    # Clients must pick the moved chats up as changes, so they get a version
+    # newer than anything either side has handed out
+    target_user = target_db.get(User, user_id)
+    version = max(user.history_version, target_user.history_version if target_user else 0) + 1
+    cleared = max(user.cleared_version, target_user.cleared_version if target_user else 0)
+    if target_user is None:
+        target_db.execute(insert(User).values(id=user_id, username=user.username,
+                                              history_version=version, cleared_version=cleared))
+    else:
+        target_db.execute(update(User).where(User.id == user_id).values(history_version=version, cleared_version=cleared))
+
+    chat_ids, branch_ids = {}, {}
+    for row in chats:
+        values = {k: v for k, v in row.items() if k not in ("id", "branch_id", "version")}
+        chat_ids[row["id"]] = target_db.execute(
+            insert(Chat.__table__).values(**values, version=version).returning(Chat.id)
+        ).scalar_one()
+    if chat_ids:
+        # Id order puts every parent branch before its children
+        for row in source_db.execute(select(Branch.__table__).where(Branch.chat_id.in_(chat_ids)).order_by(Branch.id)).mappings():
+            branch_ids[row["id"]] = target_db.execute(
+                insert(Branch).values(chat_id=chat_ids[row["chat_id"]], parent_id=branch_ids.get(row["parent_id"]),
+                                      fork_position=row["fork_position"], created_at=row["created_at"]).returning(Branch.id)
+            ).scalar_one()
+        for row in chats:
+            if row["branch_id"] is not None:
+                target_db.execute(update(Chat).where(Chat.id == chat_ids[row["id"]]).values(branch_id=branch_ids[row["branch_id"]]))
+
+        batch = []
+        rows = source_db.execute(select(Message.__table__).where(Message.chat_id.in_(chat_ids)).order_by(Message.id)).mappings()
+        for row in rows:
+            batch.append({
+                "chat_id": chat_ids[row["chat_id"]], "position": row["position"], "role": row["role"],
+                "content": row["content"], "branch_id": branch_ids.get(row["branch_id"]), "active": row["active"],
+            })
+            if len(batch) >= BATCH_SIZE:
+                target_db.execute(insert(Message), batch)
+                batch = []
+        if batch:
+            target_db.execute(insert(Message), batch)
+        if search.is_enabled(target_db):
+            moved = target_db.query(Message.id, Message.content).filter(Message.chat_id.in_(chat_ids.values())).all()
+            search.index_messages(target_db, user_id, moved)
+    target_db.commit()
+
+    crud.delete_chat_rows(source_db, user_id)
+    if not source_is_main:
+        source_db.query(User).filter(User.id == user_id).delete(synchronize_session=False)
+    source_db.commit()
+    return len(chats)
+
+
+def mirror_users(db):
+    """
+    Gives every shard a users row for each of its users that has none yet
+    (registered while DB_SHARDS was off, or imported). Returns how many.
+    """
+    by_shard = {}
+    for user_id, username in db.execute(select(User.id, User.username)):
+        target = shard_for(user_id)
+        if not target.is_main:
+            by_shard.setdefault(target, []).append({"id": user_id, "username": username})
+    added = 0
+    for target, users in by_shard.items():
+        target_db = target.SessionLocal()
+        try:
+            present = set(target_db.scalars(select(User.id)))
+            missing = [u for u in users if u["id"] not in present]
+            if missing:
+                target_db.execute(insert(User), missing)
+                target_db.commit()
+            added += len(missing)
+        finally:
+            target_db.close()
+    return added
+
+
+def rebalance(dry_run=False):
+    """
+    Moves every misplaced user and returns (users moved, users that failed).
+    """
+    moved, failed = 0, []
+    for source in all_databases() + stray_shards():
+        source_db = source.SessionLocal()
+        try:
+            plan = {}
+            for user_id in users_with_history(source_db, source.is_main):
+                target = shard_for(user_id)
+                if target.url != source.url:
+                    plan.setdefault(target, []).append(user_id)
+            for target, user_ids in plan.items():
+                print(f"{source.url}: {len(user_ids)} users to move to {target.url}")
+                if dry_run:
+                    continue
+                target_db = target.SessionLocal()
+                try:
+                    for user_id in user_ids:
+                        started = time.perf_counter()
+                        try:
+                            chats = move_user(source_db, target_db, user_id, source.is_main)
+                        except Exception as e:
+                            # E.g. one of the user's chat ids taken by someone else on the target
+                            target_db.rollback()
+                            source_db.rollback()
+                            failed.append(user_id)
+                            print(f"User {user_id} was not moved: {e}")
+                            continue
+                        moved += 1
+                        print(f"Moved user {user_id} ({chats} chats, {time.perf_counter() - started:.2f}s)")
+                finally:
+                    target_db.close()
+        finally:
+            source_db.close()
+    return moved, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move users' history to their DB_SHARDS shard")
+    parser.add_argument("--dry-run", action="store_true", help="only report what would move")
+    args = parser.parse_args()
+
+    migrate.upgrade_schema()
+    for target in stray_shards():
+        migrate.add_missing_columns(target.engine)
+    db = main_shard.SessionLocal()
+    try:
+        # Only the main database can hold legacy JSON chats; give them message rows before they move
+        if not args.dry_run:
+            migrate.migrate_json_messages(db)
+        # Moved rows are copied compressed as they are read, so the main database's dictionaries must be known
+        if codec.enabled(engine.dialect):
+            codec.load_dictionaries(engine)
+        moved, failed = rebalance(args.dry_run)
+        if DB_SHARDS and not args.dry_run:
+            mirrored = mirror_users(db)
+            if mirrored:
+                print(f"Added {mirrored} users to their shard's user table.")
+    finally:
+        db.close()
+    print(f"Done. {moved} users moved, {len(failed)} failed.")
+    if failed:
+        print(f"Failed users (fix and re-run): {failed}")
+    leftovers = [target.url for target in stray_shards()]
+    if leftovers and not args.dry_run and not failed:
+        print(f"These shard files are no longer used and can be deleted: {leftovers}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from generation import Generation
+
+CHAT_CACHE = os.getenv("CHAT_CACHE", "1") == "1"
+CHAT_CACHE_MAX_ENTRIES = int(os.getenv("CHAT_CACHE_MAX_ENTRIES", "1024"))
+CHAT_CACHE_TTL = float(os.getenv("CHAT_CACHE_TTL", "300"))
+CHAT_CACHE_MAX_BYTES = int(os.getenv("CHAT_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+
+def cache_key(mode: str, temperature: float, messages) -> str:
+    """
+    Hash of everything that decides the reply. `messages` is the prompt as
+    sent upstream (system prompt first); whitespace at the ends of a message
+    does not change the key.
+    """
+    normalized = {
+        "mode": mode,
+        "temperature": round(float(temperature), 3),
+        "messages": [[m.get("role", ""), str(m.get("content") or "").strip()] for m in messages],
+    }
+    raw = json.dumps(normalized, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    LRU + TTL cache of completed replies (as their original chunk lists),
+    capped by entry count and total bytes. Also tracks in-flight generations
+    so identical concurrent requests share one upstream call.
+    """
+
+    def __init__(self, max_entries=CHAT_CACHE_MAX_ENTRIES, ttl=CHAT_CACHE_TTL, max_bytes=CHAT_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict() # key -> (expires_at, size, chunks)
+        self._inflight = {}
+        self.bytes = 0
+        self.hits = 0
+        self.joins = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        """
+        Returns ("hit", chunks), ("join", generation) or ("miss", generation).
+        On a miss the caller must produce into the returned generation and
+        then call complete().
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return "hit", entry[2]
+            self._evict(key)
+
+        generation = self._inflight.get(key)
+        if generation is not None:
+            self.joins += 1
+            return "join", generation
+
+        self.misses += 1
+        generation = Generation()
+        self._inflight[key] = generation
+        return "miss", generation
+
+    def complete(self, key, generation):
+        self._inflight.pop(key, None)
+        if generation.error is not None or not generation.chunks:
+            return
+        size = sum(len(c.encode("utf-8")) for c in generation.chunks)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._evict(key)
+        self._entries[key] = (time.monotonic() + self.ttl, size, list(generation.chunks))
+        self.bytes += size
+        while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+            self._evict(next(iter(self._entries)))
+
+    def _evict(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.bytes -= size
+
+    def stats(self):
+        lookups = self.hits + self.joins + self.misses
+        return {
+            "enabled": True,
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "joins": self.joins,
+            "misses": self.misses,
+            "hit_ratio": (self.hits + self.joins) / lookups if lookups else 0.0,
+            "inflight": len(self._inflight),
+        }
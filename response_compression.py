@@ -0,0 +1,117 @@
+"""
+Negotiated response compression (zstd or gzip) for large JSON payloads
+such as /history/{username}.
+
+Only complete responses with a Content-Length are compressed. Streamed
+responses (/chat, exports) pass through untouched: compressing them would
+hold tokens back until a compression block fills up.
+"""
+import asyncio
+import gzip
+import os
+import zstandard
+import metrics
+
+RESPONSE_COMPRESSION = os.getenv("RESPONSE_COMPRESSION", "1") == "1"
+# Small bodies fit in a packet either way
+RESPONSE_COMPRESSION_MIN_SIZE = int(os.getenv("RESPONSE_COMPRESSION_MIN_SIZE", "1024"))
+RESPONSE_ZSTD_LEVEL = int(os.getenv("RESPONSE_ZSTD_LEVEL", "3"))
+RESPONSE_GZIP_LEVEL = int(os.getenv("RESPONSE_GZIP_LEVEL", "5"))
+# Bodies larger than this are compressed off the event loop
+THREAD_THRESHOLD = 256 * 1024
+
+# Preferred first when the client accepts both equally
+ENCODINGS = ("zstd", "gzip")
+COMPRESSIBLE_TYPES = ("application/json", "text/plain", "text/html", "text/csv")
+
+
+def negotiate(accept_encoding: str):
+    """
+    Picks the encoding to use for an Accept-Encoding header value, or None.
+    """
+    weights = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[name.strip()] = q
+    best, best_q = None, 0.0
+    for name in ENCODINGS:
+        q = weights.get(name, weights.get("*", 0.0))
+        if q > best_q:
+            best, best_q = name, q
+    return best
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=RESPONSE_ZSTD_LEVEL).compress(body)
+    return gzip.compress(body, compresslevel=RESPONSE_GZIP_LEVEL, mtime=0)
+
+
+class CompressionMiddleware:
+    """
+    ASGI middleware compressing eligible responses with the encoding the
+    client prefers. Adds Vary: Accept-Encoding to everything it could have
+    compressed, so caches keep the variants apart.
+    """
+
+    def __init__(self, app, minimum_size=RESPONSE_COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not RESPONSE_COMPRESSION:
+            return await self.app(scope, receive, send)
+        accept = ""
+        for name, value in scope["headers"]:
+            if name == b"accept-encoding":
+                accept = value.decode("latin-1")
+        encoding = negotiate(accept) if accept else None
+        if encoding is None:
+            return await self.app(scope, receive, send)
+
+        state = {"start": None, "passthrough": False}
+
+        async def send_wrapper(message):
+            if state["passthrough"]:
+                return await send(message)
+            if message["type"] == "http.response.start":
+                headers = {k.lower(): v for k, v in message.get("headers", [])}
+                content_type = headers.get(b"content-type", b"").decode("latin-1").split(";")[0].strip()
+                # Streaming responses have no Content-Length: send them on as they come
+                if (b"content-encoding" in headers or b"content-length" not in headers
+                        or content_type not in COMPRESSIBLE_TYPES):
+                    state["passthrough"] = True
+                    return await send(message)
+                state["start"] = message
+                return
+            # First body message decides
+            start, state["passthrough"] = state["start"], True
+            body = message.get("body", b"")
+            if message.get("more_body", False) or len(body) < self.minimum_size:
+                start["headers"] = list(start.get("headers", [])) + [(b"vary", b"Accept-Encoding")]
+                await send(start)
+                return await send(message)
+
+            if len(body) > THREAD_THRESHOLD:
+                compressed = await asyncio.to_thread(compress, body, encoding)
+            else:
+                compressed = compress(body, encoding)
+            metrics.http_compression_bytes.inc(len(body), encoding=encoding, stage="raw")
+            metrics.http_compression_bytes.inc(len(compressed), encoding=encoding, stage="sent")
+            headers = [(k, v) for k, v in start.get("headers", []) if k.lower() != b"content-length"]
+            headers += [
+                (b"content-encoding", encoding.encode()),
+                (b"content-length", str(len(compressed)).encode()),
+                (b"vary", b"Accept-Encoding"),
+            ]
+            await send({**start, "headers": headers})
+            await send({"type": "http.response.body", "body": compressed})
+
+        await self.app(scope, receive, send_wrapper)
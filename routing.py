@@ -0,0 +1,175 @@
+import asyncio
+import json
+import os
+import llm
+import metrics
+
+# Which model serves each mode. A route has a primary and an optional
+# fallback target ({provider, model}; providers are defined in llm.py) and a
+# time-to-first-token SLO in seconds:
+#   - primary fails before its first token -> fail over to the fallback
+#   - primary has no first token after ttft_slo -> hedge: start the fallback
+#     too and keep whichever produces a token first
+PRIMARY_MODEL = {"provider": "groq", "model": "llama-3.1-8b-instant"}
+FALLBACK_MODEL = {"provider": "groq", "model": "llama-3.3-70b-versatile"}
+
+ROUTES = {
+    "Fast AI": {"primary": PRIMARY_MODEL, "fallback": FALLBACK_MODEL, "ttft_slo": 0.8},
+    "Deep Search": {"primary": PRIMARY_MODEL, "fallback": FALLBACK_MODEL, "ttft_slo": 2.0},
+    "Creative Mode": {"primary": PRIMARY_MODEL, "fallback": FALLBACK_MODEL, "ttft_slo": 1.5},
+}
+
+DEFAULT_ROUTE = {"primary": PRIMARY_MODEL, "fallback": FALLBACK_MODEL, "ttft_slo": 1.5}
+
+# Route overrides, merged per mode, e.g.
+# CHAT_ROUTES='{"Fast AI": {"fallback": {"provider": "backup", "model": "llama-3.1-8b-instant"}, "ttft_slo": 0.5}}'
+# A "fallback" of null turns hedging and failover off for that mode.
+for _name, _route in json.loads(os.getenv("CHAT_ROUTES", "{}")).items():
+    if _name == "default":
+        DEFAULT_ROUTE = {**DEFAULT_ROUTE, **_route}
+    else:
+        ROUTES[_name] = {**ROUTES.get(_name, DEFAULT_ROUTE), **_route}
+
+for _route in list(ROUTES.values()) + [DEFAULT_ROUTE]:
+    for _target in (_route["primary"], _route.get("fallback")):
+        if _target is not None and _target["provider"] not in llm.PROVIDERS:
+            raise ValueError(f"Route uses unknown provider {_target['provider']!r}")
+
+
+def get_route(mode):
+    return ROUTES.get(mode, DEFAULT_ROUTE)
+
+
+class _Attempt:
+    """
+    One upstream stream, read by a task into a queue of
+    ("token", text), ("done", usage) or ("error", exception) events.
+    """
+
+    def __init__(self, target, messages, temperature):
+        self.target = target
+        self.events = asyncio.Queue()
+        self.task = asyncio.create_task(self._run(messages, temperature))
+        self._next = None
+
+    async def _run(self, messages, temperature):
+        stream = None
+        try:
+            stream = await llm.get_client(self.target["provider"]).chat.completions.create(
+                model=self.target["model"],
+                messages=messages,
+                temperature=temperature,
+                stream=True,
+            )
+            usage = None
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    self.events.put_nowait(("token", chunk.choices[0].delta.content))
+                x_groq = getattr(chunk, "x_groq", None)
+                if x_groq is not None and getattr(x_groq, "usage", None) is not None:
+                    usage = x_groq.usage
+            self.events.put_nowait(("done", usage))
+        except Exception as e:
+            self.events.put_nowait(("error", e))
+        finally:
+            # Hand the connection back to the pool (also when cancelled as the losing hedge)
+            if stream is not None:
+                await stream.close()
+
+    def next_event(self):
+        """
+        Future for the next event; the same one until it has completed.
+        """
+        if self._next is None or self._next.done():
+            self._next = asyncio.ensure_future(self.events.get())
+        return self._next
+
+    async def cancel(self):
+        if self._next is not None:
+            self._next.cancel()
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+
+class RoutedCompletion:
+    """
+    Streams a completion for `route`, hedging and failing over as described
+    above. After the stream ends `target`, `usage`, `hedged` and
+    `failed_over` describe what happened.
+    """
+
+    def __init__(self, route, messages, temperature, mode=""):
+        self.route = route
+        self.messages = messages
+        self.temperature = temperature
+        self.mode = mode
+        self.target = None
+        self.usage = None
+        self.hedged = False
+        self.failed_over = False
+        self._attempts = []
+
+    def _start(self, target):
+        attempt = _Attempt(target, self.messages, self.temperature)
+        self._attempts.append(attempt)
+        return attempt
+
+    async def stream(self):
+        loop = asyncio.get_running_loop()
+        fallback = self.route.get("fallback")
+        live = [self._start(self.route["primary"])]
+        slo = self.route.get("ttft_slo")
+        # No SLO: fail over on errors but never hedge
+        hedge_at = loop.time() + float(slo) if fallback is not None and slo is not None else None
+        winner, first, last_error = None, None, None
+
+        # Race until one attempt produces its first token (or finishes empty)
+        while winner is None:
+            timeout = None
+            if hedge_at is not None and len(self._attempts) == 1:
+                timeout = max(hedge_at - loop.time(), 0)
+            waits = {attempt: attempt.next_event() for attempt in live}
+            done, _ = await asyncio.wait(waits.values(), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                self.hedged = True
+                metrics.chat_hedges.inc(mode=self.mode)
+                live.append(self._start(fallback))
+                continue
+            for attempt in list(live):
+                if waits[attempt] not in done:
+                    continue
+                kind, value = waits[attempt].result()
+                if kind == "error":
+                    last_error = value
+                    live.remove(attempt)
+                    if fallback is not None and len(self._attempts) == 1:
+                        self.failed_over = True
+                        metrics.chat_failovers.inc(mode=self.mode)
+                        live.append(self._start(fallback))
+                    continue
+                winner, first = attempt, (kind, value)
+                break
+            if winner is None and not live:
+                raise last_error
+
+        for attempt in live:
+            if attempt is not winner:
+                await attempt.cancel()
+        self.target = winner.target
+        metrics.chat_served.inc(mode=self.mode, provider=self.target["provider"], model=self.target["model"])
+
+        kind, value = first
+        while kind == "token":
+            yield value
+            kind, value = await winner.events.get()
+        if kind == "error":
+            raise value
+        self.usage = value
+
+    async def close(self):
+        for attempt in self._attempts:
+            if not attempt.task.done():
+                await attempt.cancel()
@@ -0,0 +1,220 @@
+import re
+import unicodedata
+from sqlalchemy import select, text
+from models import Chat, Message
+
+# Full-text index over message content. On SQLite this is an FTS5 table
+# (rowid is messages.id) maintained by crud; on Postgres a GIN expression
+# index that the database maintains itself.
+# The owner column holds a "u<user_id>" token, so scoping a query to one user
+# is a posting-list intersection instead of a per-match row lookup.
+# The table is contentless: it keeps only the index, not a second, plain-text
+# copy of every (compressed) message. Snippets are cut from the messages
+# table instead, and a row is removed by handing FTS5 the text it indexed.
+FTS_TABLE_SQL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts "
+    "USING fts5(content, owner, content='', tokenize='unicode61 remove_diacritics 2')"
+)
+
+PG_INDEX_SQL = (
+    "CREATE INDEX IF NOT EXISTS ix_messages_content_tsv ON messages "
+    "USING GIN (to_tsvector('simple', content))"
+)
+
+_TERM_RE = re.compile(r"(\w+)(\*)?", re.UNICODE)
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+SNIPPET_WORDS = 12
+_enabled = {}
+
+
+def create_index(engine):
+    """
+    Creates the search index and indexes any messages not in it yet.
+    Returns False when the database has no full-text support.
+    """
+    if engine.dialect.name == "postgresql":
+        with engine.begin() as conn:
+            conn.execute(text(PG_INDEX_SQL))
+        return True
+    if engine.dialect.name != "sqlite":
+        return False
+    with engine.begin() as conn:
+        existing = conn.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'")).scalar()
+        if existing is not None and "content=''" not in existing:
+            # Older index holding its own copy of every message; rebuilt below
+            conn.execute(text("DROP TABLE messages_fts"))
+            print("Rebuilding the search index without its copy of the message text")
+        conn.execute(text(FTS_TABLE_SQL))
+        last = conn.execute(text("SELECT COALESCE(MAX(rowid), 0) FROM messages_fts")).scalar()
+        # Read through the ORM column so compressed content is indexed as text
+        rows = conn.execution_options(stream_results=True).execute(
+            select(Message.id, Message.content, Chat.user_id)
+            .join(Chat, Chat.id == Message.chat_id)
+            .where(Message.id > last)
+            .order_by(Message.id)
+        )
+        indexed = 0
+        for batch in rows.partitions(2000):
+            conn.execute(
+                text("INSERT INTO messages_fts(rowid, content, owner) VALUES (:id, :content, :owner)"),
+                [{"id": r.id, "content": r.content, "owner": f"u{r.user_id}"} for r in batch],
+            )
+            indexed += len(batch)
+        if indexed:
+            print(f"Indexed {indexed} messages for search")
+    _enabled.pop(engine, None)
+    return True
+
+
+def _has_fts_table(db):
+    bind = db.get_bind()
+    if bind not in _enabled:
+        _enabled[bind] = bind.dialect.name == "sqlite" and db.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'")
+        ).first() is not None
+    return _enabled[bind]
+
+
+def is_enabled(db):
+    return db.get_bind().dialect.name == "postgresql" or _has_fts_table(db)
+
+
+def index_messages(db, user_id, messages):
+    """
+    Adds flushed Message rows to the index, in the caller's transaction.
+    """
+    if messages and _has_fts_table(db):
+        db.execute(
+            text("INSERT INTO messages_fts(rowid, content, owner) VALUES (:id, :content, :owner)"),
+            [{"id": m.id, "content": m.content, "owner": f"u{user_id}"} for m in messages],
+        )
+
+
+def unindex_messages(db, message_ids_sql, params, batch_size=500):
+    """
+    Removes the messages selected by `message_ids_sql` (a SELECT of ids).
+    Must run before those rows are deleted: a contentless index forgets a
+    row only when given the same text it indexed.
+    """
+    if not _has_fts_table(db):
+        return
+    ids = [row[0] for row in db.execute(text(message_ids_sql), params)]
+    for i in range(0, len(ids), batch_size):
+        rows = db.execute(
+            select(Message.id, Message.content, Chat.user_id)
+            .join(Chat, Chat.id == Message.chat_id)
+            .where(Message.id.in_(ids[i:i + batch_size]))
+        ).all()
+        if rows:
+            db.execute(
+                text("INSERT INTO messages_fts(messages_fts, rowid, content, owner) VALUES ('delete', :id, :content, :owner)"),
+                [{"id": r.id, "content": r.content, "owner": f"u{r.user_id}"} for r in rows],
+            )
+
+
+def _terms(q: str):
+    return [(m.group(1), bool(m.group(2))) for m in _TERM_RE.finditer(q)]
+
+
+def _fold(word: str) -> str:
+    # Case and diacritics folded, like the unicode61 tokenizer does
+    return "".join(c for c in unicodedata.normalize("NFKD", word.lower()) if not unicodedata.combining(c))
+
+
+def make_snippet(content: str, q: str, size: int = SNIPPET_WORDS) -> str:
+    """
+    About `size` words of `content` around the first match of `q`, with the
+    matching words wrapped in <mark>, like FTS5's snippet().
+    """
+    terms = [(_fold(t), prefix) for t, prefix in _terms(q)]
+    words = list(_WORD_RE.finditer(content))
+    if not words:
+        return ""
+    hits = {
+        i for i, w in enumerate(words)
+        if any(_fold(w.group()).startswith(t) if prefix else _fold(w.group()) == t for t, prefix in terms)
+    }
+    first = min(hits) if hits else 0
+    start = max(0, min(first - size // 4, len(words) - size))
+    end = min(len(words), start + size)
+    parts, pos = [], words[start].start()
+    for i in range(start, end):
+        w = words[i]
+        parts.append(content[pos:w.start()])
+        parts.append(f"<mark>{w.group()}</mark>" if i in hits else w.group())
+        pos = w.end()
+    return ("…" if start > 0 else "") + "".join(parts) + ("…" if end < len(words) else "")
+
+
+def build_match_query(user_id, q: str):
+    """
+    Turns free text into an FTS5 query scoped to one user in which every
+    word must match. A word typed with a trailing * matches as a prefix.
+    Returns None if the text has no searchable words.
+    """
+    terms = _terms(q)
+    if not terms:
+        return None
+    quoted = " ".join(f'"{t}"*' if prefix else f'"{t}"' for t, prefix in terms)
+    return f"owner:u{int(user_id)} AND content:({quoted})"
+
+
+def _search_postgres(db, user_id, q: str, limit: int, offset: int):
+    terms = _terms(q)
+    if not terms:
+        return []
+    tsquery = " & ".join(f"'{t}':*" if prefix else f"'{t}'" for t, prefix in terms)
+    rows = db.execute(text(
+        "SELECT m.position, m.role, m.branch_id, m.active, c.chat_uuid, c.title, "
+        "ts_rank(to_tsvector('simple', m.content), query) AS score, "
+        "ts_headline('simple', m.content, query, 'StartSel=<mark>, StopSel=</mark>, MaxWords=24, MinWords=8') AS snippet "
+        "FROM messages m JOIN chats c ON c.id = m.chat_id, to_tsquery('simple', :tsquery) query "
+        "WHERE c.user_id = :user_id AND to_tsvector('simple', m.content) @@ query "
+        "ORDER BY score DESC LIMIT :limit OFFSET :offset"
+    ), {"tsquery": tsquery, "user_id": user_id, "limit": limit, "offset": offset}).all()
+    return [
+        {"chat_id": r.chat_uuid, "title": r.title, "position": r.position, "role": r.role,
+         "branch_id": r.branch_id, "active": bool(r.active), "snippet": r.snippet, "score": r.score}
+        for r in rows
+    ]
+
+
+def search_messages(db, user_id, q: str, limit: int, offset: int):
+    if db.get_bind().dialect.name == "postgresql":
+        return _search_postgres(db, user_id, q, limit, offset)
+    match = build_match_query(user_id, q)
+    if match is None:
+        return []
+    rows = db.execute(text(
+        # The owner column gets zero weight in the ranking
+        "SELECT rowid AS id, bm25(messages_fts, 1.0, 0.0) AS score "
+        "FROM messages_fts WHERE messages_fts MATCH :match "
+        "ORDER BY score LIMIT :limit OFFSET :offset"
+    ), {"match": match, "limit": limit, "offset": offset}).all()
+    if not rows:
+        return []
+
+    # Chat, position and (decompressed) text for just this page of hits
+    info = {
+        r.id: r
+        for r in db.execute(
+            select(Message.id, Message.position, Message.role, Message.branch_id, Message.active,
+                   Message.content, Chat.chat_uuid, Chat.title)
+            .join(Chat, Chat.id == Message.chat_id)
+            .where(Message.id.in_([r.id for r in rows]))
+        )
+    }
+    return [
+        {
+            "chat_id": info[r.id].chat_uuid,
+            "title": info[r.id].title,
+            "position": info[r.id].position,
+            "role": info[r.id].role,
+            # Hits on other branches need a switch before the position applies
+            "branch_id": info[r.id].branch_id,
+            "active": bool(info[r.id].active),
+            "snippet": make_snippet(info[r.id].content or "", q),
+            "score": -r.score,
+        }
+        for r in rows if r.id in info
+    ]
@@ -1,10 +1,12 @@
 from sqlalchemy.orm import Session
-from database import SessionLocal, engine
-from models import User, Base
+from database import SessionLocal, DB_SHARDS
+from models import User
 import bcrypt
+import migrate
+import rebalance_shards
 
 # Ensure tables exist
-Base.metadata.create_all(bind=engine)
+migrate.upgrade_schema()
 
 def create_demo_user():
     db = SessionLocal()
@@ -24,6 +26,9 @@ def create_demo_user():
         
         db.add(new_user)
         db.commit()
+        if DB_SHARDS:
+            # The user's shard keeps its own row for the history version
+            rebalance_shards.mirror_users(db)
         print(f"User '{username}' created successfully with password '{password}'.")
         
     except Exception as e:
@@ -0,0 +1,136 @@
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+import groq
+import ratelimit
+
+# Wire formats for /chat. text/plain (the default) is the bare reply text;
+# the structured formats carry event ids, token offsets, a final usage event
+# and typed errors, and can be resumed from an offset.
+TEXT = "text/plain"
+NDJSON = "application/x-ndjson"
+SSE = "text/event-stream"
+
+# Finished generations stay resumable this long
+CHAT_RESUME_TTL = float(os.getenv("CHAT_RESUME_TTL", "60"))
+CHAT_RESUME_MAX_ENTRIES = int(os.getenv("CHAT_RESUME_MAX_ENTRIES", "1024"))
+# Frame coalescing: wait up to LINGER ms to batch tokens, up to MAX_FRAME_CHARS per frame
+CHAT_STREAM_LINGER = float(os.getenv("CHAT_STREAM_LINGER_MS", "10")) / 1000.0
+CHAT_STREAM_MAX_FRAME_CHARS = int(os.getenv("CHAT_STREAM_MAX_FRAME_CHARS", "2048"))
+
+
+def negotiate(accept: str):
+    """
+    Picks the response format from an Accept header.
+    """
+    accept = (accept or "").lower()
+    if SSE in accept:
+        return SSE
+    if NDJSON in accept or "application/jsonl" in accept:
+        return NDJSON
+    return TEXT
+
+
+def describe_error(exc):
+    """
+    Maps a generation error to {"type", "message"} (+ upstream "status").
+    """
+    if isinstance(exc, asyncio.CancelledError):
+        return {"type": "cancelled", "message": "Generation was cancelled"}
+    if isinstance(exc, ratelimit.RateLimited):
+        return {"type": "overloaded", "message": "Server busy, please retry", "retry_after": exc.retry_after}
+    if isinstance(exc, groq.APITimeoutError):
+        return {"type": "upstream_timeout", "message": "Model did not respond in time"}
+    if isinstance(exc, groq.APIConnectionError):
+        return {"type": "upstream_unavailable", "message": "Could not reach the model"}
+    if isinstance(exc, groq.RateLimitError):
+        return {"type": "upstream_rate_limited", "message": str(exc), "status": exc.status_code}
+    if isinstance(exc, groq.APIStatusError):
+        return {"type": "upstream_error", "message": str(exc), "status": exc.status_code}
+    return {"type": "internal_error", "message": str(exc)}
+
+
+class GenerationStore:
+    """
+    Short-lived registry of generations by id, so a client that lost its
+    connection can resume reading. In-flight generations are kept until they
+    finish; finished ones for `ttl` seconds. Per process: with several
+    workers a resume only works on the worker that served the request.
+    """
+
+    def __init__(self, ttl=CHAT_RESUME_TTL, max_entries=CHAT_RESUME_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._items = OrderedDict()
+
+    def add(self, generation):
+        self._purge()
+        self._items[generation.id] = generation
+        while len(self._items) > self.max_entries:
+            self._items.popitem(last=False)
+
+    def get(self, generation_id):
+        self._purge()
+        return self._items.get(generation_id)
+
+    def _purge(self):
+        cutoff = time.monotonic() - self.ttl
+        expired = [k for k, g in self._items.items() if g.done and g.finished_at < cutoff]
+        for key in expired:
+            del self._items[key]
+
+    def __len__(self):
+        return len(self._items)
+
+
+def _frame(fmt, event, event_id, data):
+    if fmt == SSE:
+        return f"id: {event_id}\nevent: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+    return json.dumps({"event": event, "id": event_id, **data}, ensure_ascii=False) + "\n"
+
+
+def usage_summary(generation):
+    usage = dict(generation.usage or {})
+    usage.setdefault("completion_tokens", len(generation.chunks))
+    if generation.first_chunk_at is not None:
+        usage["ttft_ms"] = round((generation.first_chunk_at - generation.started_at) * 1000, 1)
+    usage["duration_ms"] = round((generation.finished_at - generation.started_at) * 1000, 1)
+    return usage
+
+
+async def text_stream(generation, start: int = 0):
+    """
+    Plain text body: reply text only, with a failure appended as "Error: ...".
+    """
+    async for _, chunks in generation.follow_frames(start, CHAT_STREAM_MAX_FRAME_CHARS):
+        yield "".join(chunks)
+    if generation.error is not None and not isinstance(generation.error, asyncio.CancelledError):
+        yield f"Error: {str(generation.error)}"
+
+
+async def event_stream(generation, fmt, start: int = 0, meta=None):
+    """
+    Structured body. Every event id is the token offset reached after it, so
+    a client resumes by sending the last id it saw as `offset` (or, for SSE,
+    as Last-Event-ID). Events:
+
+        start  {generation_id, offset, ...meta}
+        delta  {offset, tokens, text}   tokens [offset, offset + tokens)
+        usage  {prompt_tokens, completion_tokens, ttft_ms, duration_ms, ...}
+        error  {type, message[, status]}
+        done   {offset}
+    """
+    yield _frame(fmt, "start", start, {"generation_id": generation.id, "offset": start, **(meta or {})})
+    offset = start
+    async for offset, chunks in generation.follow_frames(start, CHAT_STREAM_MAX_FRAME_CHARS, CHAT_STREAM_LINGER):
+        end = offset + len(chunks)
+        yield _frame(fmt, "delta", end, {"offset": offset, "tokens": len(chunks), "text": "".join(chunks)})
+        offset = end
+    offset = len(generation.chunks)
+    if generation.error is not None:
+        yield _frame(fmt, "error", offset, describe_error(generation.error))
+        return
+    yield _frame(fmt, "usage", offset, usage_summary(generation))
+    yield _frame(fmt, "done", offset, {"offset": offset})
@@ -0,0 +1,217 @@
+import asyncio
+import json
+import logging
+import os
+from collections import OrderedDict
+from sqlalchemy import and_, bindparam, func, select, update
+from models import Chat, Message
+import crud
+import llm
+import metrics
+import routing
+
+logger = logging.getLogger(__name__)
+
+# Chats saved with the placeholder title get one generated in the background:
+#   "llm"      one model call titles a whole batch (truncation if it fails)
+#   "truncate" first user message, cut to 20 characters
+#   "off"      leave titles alone
+AUTO_TITLE = os.getenv("AUTO_TITLE", "llm")
+TITLE_BATCH_SIZE = int(os.getenv("TITLE_BATCH_SIZE", "8"))
+# How long the first chat of a batch waits for others to join it
+TITLE_BATCH_WAIT = float(os.getenv("TITLE_BATCH_WAIT", "0.5"))
+TITLE_PROVIDER = os.getenv("TITLE_PROVIDER", routing.PRIMARY_MODEL["provider"])
+TITLE_MODEL = os.getenv("TITLE_MODEL", routing.PRIMARY_MODEL["model"])
+TITLE_MAX_CHARS = 60
+# Model input per chat; the start of the first message is enough for a title
+TITLE_PROMPT_CHARS = 500
+
+TITLE_PROMPT = (
+    "Write a short, specific title (at most 6 words) for each conversation below, "
+    "based on its first message. Reply with only a JSON array of strings, one per "
+    "conversation, in the same order."
+)
+
+
+def truncate_title(text: str) -> str:
+    return (text[:20] + '..') if len(text) > 20 else text
+
+
+def _clean(title) -> str:
+    if not isinstance(title, str):
+        return ""
+    title = " ".join(title.split()).strip("\"'`*# ").rstrip(".")
+    return title[:TITLE_MAX_CHARS]
+
+
+async def llm_titles(texts):
+    """
+    Titles for `texts` from one model call, in order. Items the model did
+    not title come back as "".
+    """
+    numbered = "\n".join(f"{i + 1}. {text[:TITLE_PROMPT_CHARS]!r}" for i, text in enumerate(texts))
+    response = await llm.get_client(TITLE_PROVIDER).chat.completions.create(
+        model=TITLE_MODEL,
+        messages=[{"role": "system", "content": TITLE_PROMPT}, {"role": "user", "content": numbered}],
+        temperature=0.2,
+        max_tokens=24 * len(texts) + 16,
+    )
+    content = response.choices[0].message.content or ""
+    start, end = content.find("["), content.rfind("]")
+    titles = json.loads(content[start:end + 1]) if start != -1 and end > start else []
+    if not isinstance(titles, list):
+        titles = []
+    return [_clean(titles[i]) if i < len(titles) else "" for i in range(len(texts))]
+
+
+async def generate_titles(texts, method=AUTO_TITLE):
+    titles = [""] * len(texts)
+    if method == "llm":
+        try:
+            titles = await llm_titles(texts)
+        except Exception as e:
+            logger.warning("Title model call failed (%s), falling back to truncation.", e)
+    result = []
+    for text, title in zip(texts, titles):
+        metrics.chat_titles.inc(method="llm" if title else "truncate")
+        result.append(title or truncate_title(text))
+    return result
+
+
+class TitleQueue:
+    """
+    Chats waiting for a generated title, keyed by (user id, chat id). A background task
+    takes up to TITLE_BATCH_SIZE at a time, reads each chat's first user
+    message, titles the batch with one model call and writes the titles in
+    one transaction. A title is only written over the placeholder, so a
+    title set in the meantime is kept.
+    """
+
+    def __init__(self, session_factory, before_read=None, batch_size=TITLE_BATCH_SIZE, batch_wait=TITLE_BATCH_WAIT):
+        # user id -> async sessionmaker of the database holding that user's chats
+        self.session_factory = session_factory
+        # Awaited with the batch's user ids before reading, e.g. to flush queued saves
+        self.before_read = before_read
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        # Keyed by (user id, chat_uuid): chat ids are only unique within one shard
+        self._pending = OrderedDict() # keys of chats waiting, oldest first
+        self._done = OrderedDict() # recently titled chats, so repeat saves are not re-queued
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Whatever is left gets the quick title rather than none
+        while self._pending:
+            await self._process(self._take(), method="truncate")
+
+    def put(self, user_id: int, chat_uuid: str):
+        key = (user_id, chat_uuid)
+        if key in self._pending or key in self._done:
+            return
+        self._pending[key] = True
+        self._wakeup.set()
+
+    def _take(self):
+        batch = []
+        while self._pending and len(batch) < self.batch_size:
+            batch.append(self._pending.popitem(last=False)[0])
+        return batch
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            if len(self._pending) < self.batch_size:
+                await asyncio.sleep(self.batch_wait)
+            while self._pending:
+                try:
+                    await self._process(self._take())
+                except Exception:
+                    logger.exception("Auto-title batch failed")
+
+    def _mark_done(self, chat):
+        self._done[(chat.user_id, chat.chat_uuid)] = True
+        while len(self._done) > 10000:
+            self._done.popitem(last=False)
+
+    async def _process(self, batch, method=AUTO_TITLE):
+        if self.before_read is not None:
+            await self.before_read({user_id for user_id, _ in batch})
+        # Each chat is read and written in its owner's database (shard)
+        groups = {}
+        for user_id, chat_uuid in batch:
+            groups.setdefault(self.session_factory(user_id), []).append((user_id, chat_uuid))
+        items = []  # (session factory, chat, first user message)
+        for session_factory, keys in groups.items():
+            items += [(session_factory, chat, text) for chat, text in await self._read(session_factory, keys)]
+        if not items:
+            return
+
+        # The model call runs with no session open, so it holds no connection
+        titles = await generate_titles([text for _, _, text in items], method)
+        writes = {}
+        for (session_factory, chat, _), title in zip(items, titles):
+            writes.setdefault(session_factory, {}).setdefault(chat.user_id, []).append({"chat_id": chat.id, "new_title": title})
+        for session_factory, by_user in writes.items():
+            async with session_factory() as db:
+                # One history version per user, so clients pick the titles up in their next delta
+                for user_id, params in by_user.items():
+                    version = (await db.execute(crud.history_version_bump(user_id))).scalar_one()
+                    await db.execute(
+                        update(Chat.__table__)
+                        .where(Chat.__table__.c.id == bindparam("chat_id"), Chat.__table__.c.title == crud.DEFAULT_TITLE)
+                        .values(title=bindparam("new_title"), version=version),
+                        params,
+                    )
+                await db.commit()
+        for _, chat, _ in items:
+            self._mark_done(chat)
+
+    async def _read(self, session_factory, keys):
+        """
+        [(chat, first user message)] for the (user id, chat_uuid) chats still
+        to be titled.
+        """
+        keys = set(keys)
+        async with session_factory() as db:
+            chats = (await db.execute(select(Chat).where(Chat.chat_uuid.in_([chat_uuid for _, chat_uuid in keys])))).scalars().all()
+            chats = [c for c in chats if (c.user_id, c.chat_uuid) in keys]
+            for chat in chats:
+                if chat.title != crud.DEFAULT_TITLE:
+                    self._mark_done(chat)
+            chats = [c for c in chats if c.title == crud.DEFAULT_TITLE]
+            if not chats:
+                return []
+
+            # First user message of each chat, in one query
+            first = (
+                select(Message.chat_id, func.min(Message.position).label("position"))
+                .where(Message.chat_id.in_([c.id for c in chats]), Message.active == True, Message.role == "user")
+                .group_by(Message.chat_id)
+                .subquery()
+            )
+            rows = await db.execute(
+                select(Message.chat_id, Message.content)
+                .join(first, and_(Message.chat_id == first.c.chat_id, Message.position == first.c.position))
+                .where(Message.active == True)
+            )
+            first_messages = dict(rows.all())
+            for chat in chats:
+                if chat.id not in first_messages and chat.legacy_messages:
+                    text = next((m.get("content", "") for m in chat.legacy_messages if m.get("role") == "user"), "")
+                    if text:
+                        first_messages[chat.id] = text
+
+        # Chats with no user message yet are left for a later save
+        return [(c, first_messages[c.id]) for c in chats if first_messages.get(c.id)]
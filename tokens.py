@@ -0,0 +1,99 @@
+"""
+Signed session tokens. /login issues one; history and chat endpoints take
+it as "Authorization: Bearer <token>" and get the user's id and name from it
+without touching the database.
+
+A token is base64url(payload) + "." + base64url(HMAC-SHA256(payload)), where
+the payload is {"uid": user id, "sub": username, "exp": unix time}. Tokens
+that verified once are kept in a small in-process cache, so repeat requests
+with the same token skip the HMAC and JSON decoding too.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+SESSION_TTL = int(os.getenv("SESSION_TTL", str(24 * 3600)))
+VERIFY_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+
+SESSION_SECRET = os.getenv("SESSION_SECRET")
+if not SESSION_SECRET:
+    # Tokens signed by one worker would fail on the others
+    if int(os.getenv("WEB_CONCURRENCY", "1")) > 1:
+        raise RuntimeError("SESSION_SECRET must be set when running more than one worker (WEB_CONCURRENCY > 1)")
+    # Fine for one dev worker; tokens stop working after a restart
+    logger.warning("SESSION_SECRET is not set, using a random per-process secret.")
+    SESSION_SECRET = secrets.token_urlsafe(32)
+_key = SESSION_SECRET.encode("utf-8")
+
+
+class Claims(NamedTuple):
+    user_id: int
+    username: str
+    expires_at: int
+
+
+_verified = OrderedDict()  # token -> Claims, least recently used first
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _sign(payload: str) -> str:
+    return _b64encode(hmac.new(_key, payload.encode("utf-8"), hashlib.sha256).digest())
+
+
+def issue(user_id: int, username: str, ttl: int = SESSION_TTL) -> str:
+    expires_at = int(time.time()) + ttl
+    payload = _b64encode(json.dumps({"uid": user_id, "sub": username, "exp": expires_at}, separators=(",", ":")).encode("utf-8"))
+    return f"{payload}.{_sign(payload)}"
+
+
+def verify(token: str) -> Optional[Claims]:
+    """
+    The token's claims, or None if it is malformed, forged or expired.
+    """
+    claims = _verified.get(token)
+    if claims is None:
+        payload, _, signature = token.partition(".")
+        if not signature or not hmac.compare_digest(signature.encode("utf-8"), _sign(payload).encode("utf-8")):
+            return None
+        try:
+            data = json.loads(_b64decode(payload))
+            claims = Claims(int(data["uid"]), str(data["sub"]), int(data["exp"]))
+        except (ValueError, KeyError, TypeError):
+            return None
+        _verified[token] = claims
+        if len(_verified) > VERIFY_CACHE_SIZE:
+            _verified.popitem(last=False)
+    else:
+        _verified.move_to_end(token)
+    if claims.expires_at <= time.time():
+        _verified.pop(token, None)
+        return None
+    return claims
+
+
+def from_header(authorization: Optional[str]) -> Optional[Claims]:
+    """
+    Claims of an "Authorization: Bearer <token>" header value.
+    """
+    if not authorization:
+        return None
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    return verify(token.strip())
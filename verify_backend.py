@@ -1,6 +1,5 @@
 import requests
 import sys
-import json
 
 import os
 BASE_URL = os.getenv("API_URL", "http://127.0.0.1:8000")
@@ -15,18 +14,20 @@ try:
         print(f"Root connection failed: {e}")
 
     print("\nTesting chat endpoint...")
+    # Must match ChatRequest in main.py
     payload = {
-        "message": "Hello",
-        "history": []
+        "messages": [{"role": "user", "content": "Hello"}],
+        "mode": "Fast AI"
     }
     try:
-        r = requests.post(f"{BASE_URL}/chat", json=payload, timeout=10)
-        print(f"Chat status: {r.status_code}")
-        print(f"Chat response: {json.dumps(r.json(), indent=2)}")
+        with requests.post(f"{BASE_URL}/chat", json=payload, stream=True, timeout=10) as r:
+            print(f"Chat status: {r.status_code}")
+            print(f"Prompt tokens: {r.headers.get('X-Prompt-Tokens')}")
+            r.encoding = r.encoding or "utf-8"
+            reply = "".join(r.iter_content(chunk_size=None, decode_unicode=True))
+            print(f"Chat response: {reply}")
     except Exception as e:
          print(f"Chat request failed: {e}")
-         if 'r' in locals() and r:
-             print(f"Raw response: {r.text}")
 
 except Exception as e:
     print(f"\nCritical failure: {e}")
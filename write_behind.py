@@ -0,0 +1,117 @@
+import logging
+import os
+import threading
+import crud
+
+logger = logging.getLogger(__name__)
+
+# Opt-in: /history/save only queues the chat and a background thread writes
+# queued chats in batched transactions. Queues are per process, so with
+# several workers read-your-writes holds for reads served by the same worker.
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "0") == "1"
+WRITE_BEHIND_INTERVAL = float(os.getenv("WRITE_BEHIND_INTERVAL", "1.0"))
+WRITE_BEHIND_MAX_PENDING = int(os.getenv("WRITE_BEHIND_MAX_PENDING", "100"))
+
+
+class WriteBehindQueue:
+    """
+    Coalescing queue of full-chat saves keyed by user and chat id. Every
+    save carries the whole conversation, so only the latest one per chat
+    needs writing. The user is part of the key so that a save naming
+    someone else's chat cannot displace the owner's queued one.
+    """
+
+    def __init__(self, session_factory, interval=WRITE_BEHIND_INTERVAL, max_pending=WRITE_BEHIND_MAX_PENDING):
+        # user id -> sessionmaker of the database holding that user's chats
+        self.session_factory = session_factory
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending = {} # (user_id, chat_uuid) -> (title, messages)
+        self._lock = threading.Lock() # guards _pending
+        self._flush_lock = threading.Lock() # one flush at a time, so a reader waits for in-progress writes
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the flusher and writes everything still queued.
+        """
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def put(self, user_id, chat_uuid, title, messages):
+        with self._lock:
+            self._pending[(user_id, chat_uuid)] = (title, messages)
+            full = len(self._pending) >= self.max_pending
+        if full:
+            self._wake.set()
+
+    def flush(self, user_id=None):
+        """
+        Writes queued chats (only `user_id`'s if given), one transaction
+        per database, and returns how many were written.
+        """
+        with self._flush_lock:
+            with self._lock:
+                if user_id is None:
+                    batch, self._pending = self._pending, {}
+                else:
+                    # Plus other users' saves of the same chats, in queue order:
+                    # the first save of a chat decides who owns it
+                    chats = {chat_uuid for owner_id, chat_uuid in self._pending if owner_id == user_id}
+                    batch = {k: v for k, v in self._pending.items() if k[1] in chats}
+                    for key in batch:
+                        del self._pending[key]
+            if not batch:
+                return 0
+
+            groups = {}
+            for key, entry in batch.items():
+                groups.setdefault(self.session_factory(key[0]), {})[key] = entry
+            failed = None
+            for session_factory, entries in groups.items():
+                try:
+                    self._write(session_factory, entries)
+                except Exception as e:
+                    # Requeue, unless a newer save for the chat arrived meanwhile
+                    with self._lock:
+                        for key, entry in entries.items():
+                            self._pending.setdefault(key, entry)
+                    failed = e
+            if failed is not None:
+                raise failed
+            return len(batch)
+
+    def _write(self, session_factory, entries):
+        db = session_factory()
+        try:
+            for (owner_id, chat_uuid), (title, messages) in entries.items():
+                try:
+                    crud.store_chat(db, owner_id, chat_uuid, title, messages)
+                except crud.ForeignChat:
+                    logger.warning("Dropping queued save of chat %s, it belongs to another user.", chat_uuid)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Write-behind flush failed, will retry")